@@ -0,0 +1,109 @@
+"""Compare the previous character-based `DocumentParser.simple_parse` with the
+streaming token-aware chunker on a synthetic 1,000-page document.
+
+Run inside the `ai` container:
+
+    cd /app/src && python ../benchmarks/bench_chunker.py --pages 1000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from repository.document_parser import ChunkingConfig, DocumentParser  # noqa: E402
+from repository.helpers import get_token_encoding  # noqa: E402
+
+_WORDS = (
+    "the invoice payment contract delivery customer service account report"
+    " quarterly revenue 売上 請求書 契約 hợp đồng khách hàng ใบแจ้งหนี้"
+).split()
+
+
+def make_elements(pages: int, elements_per_page: int) -> list[dict]:
+    rng = random.Random(42)
+    return [
+        {
+            "text": "\t".join(rng.choices(_WORDS, k=rng.randint(10, 120))) + "\n\n  \n",
+            "metadata": {"page_number": page},
+        }
+        for page in range(1, pages + 1)
+        for _ in range(elements_per_page)
+    ]
+
+
+def legacy_simple_parse(unstructured_docs: list[dict], split_length: int):
+    """The previous implementation, returning the texts of the chunks."""
+    docs: list[str] = []
+    for d in unstructured_docs:
+        content = d.get("text", "")
+
+        content = content.replace("\t", " ")
+        content = re.sub(r"^(?:[\t ]*(?:\r?\n|\r))+", "\\n", content, 0, re.MULTILINE)
+        content = re.sub(r"\s\s*", " ", content, 0, re.MULTILINE)
+
+        if len(docs) == 0:
+            docs.append(content)
+            continue
+
+        if len(docs[-1]) > split_length:
+            overlap_words_amount = 100
+            previous_text = ""
+            if len(docs) > 2:
+                previous_text = " ".join(docs[-2].split()[-overlap_words_amount:])
+            next_text = " ".join(content.split()[:overlap_words_amount])
+            docs[-1] = previous_text + "\n\n" + docs[-1] + "\n\n" + next_text
+            docs.append(content)
+            continue
+
+        docs[-1] += "\n\n" + content
+
+    if len(docs) > 2 and len(docs[-1]) < split_length / 2:
+        docs[-2] += docs[-1]
+        docs = docs[:-2]
+
+    return docs
+
+
+def print_result(name: str, duration: float, texts: list[str]):
+    encoding = get_token_encoding()
+    tokens = [len(encoding.encode_ordinary(t)) for t in texts]
+    print(
+        f"{name:>9}: {duration * 1000:.0f}ms, {len(texts)} chunks,"
+        f" tokens avg={sum(tokens) / len(tokens):.0f} max={max(tokens)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--elements-per-page", type=int, default=30)
+    parser.add_argument("--split-length", type=int, default=2000)
+    parser.add_argument("--chunk-tokens", type=int, default=500)
+    parser.add_argument("--overlap-tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    elements = make_elements(args.pages, args.elements_per_page)
+    print(f"pages: {args.pages}, elements: {len(elements)}")
+
+    start = time.perf_counter()
+    legacy_texts = legacy_simple_parse(elements, args.split_length)
+    print_result("legacy", time.perf_counter() - start, legacy_texts)
+
+    document_parser = DocumentParser("", "")
+    # Load the encoding outside of the measure
+    get_token_encoding()
+    start = time.perf_counter()
+    chunks = document_parser.simple_parse(
+        elements,
+        ChunkingConfig(chunk_size=args.chunk_tokens, overlap=args.overlap_tokens),
+    )
+    print_result("streaming", time.perf_counter() - start, [c.text for c in chunks])
+
+
+if __name__ == "__main__":
+    main()
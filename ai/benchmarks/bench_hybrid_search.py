@@ -0,0 +1,148 @@
+"""Compare the recall and latency of the vector and hybrid search modes of
+`VectorStoreRepo` on the documents of a namespace.
+
+Each random chunk gives two queries, and the expected result is that chunk:
+
+- `exact`: a span of text copied from the chunk (identifiers, names and keywords
+  are what the vector search misses).
+- `paraphrase`: the chunk rewritten by the chat model as a short question with
+  other words, which the lexical search misses.
+
+The queries are embedded with OpenAI.
+
+Run inside the `ai` container:
+
+    cd /app/src && python ../benchmarks/bench_hybrid_search.py --namespace my-org --queries 100
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from repository import llm_facade, vector_store_repo  # noqa: E402
+from repository.llm_facade import ChatModelEnum  # noqa: E402
+
+PARAPHRASE_PROMPT = (
+    "Write one short question, in the language of the text below, that the text"
+    " answers. Use other words than the text: no names, numbers or phrases copied"
+    " from it. Answer with the question only.\n\n{text}"
+)
+
+
+def sample_queries(
+    namespace: str, num_queries: int, query_words: int, query_chars: int
+) -> list[tuple[str, str, str]]:
+    """(document, content of the chunk, query) for random chunks of the namespace."""
+    results = vector_store_repo._execute(
+        f"""
+        SELECT document, content
+        FROM {vector_store_repo._TABLE_NAME}
+        WHERE status = 'active' AND namespace = %s
+        ORDER BY random() LIMIT %s
+        """,
+        (namespace, num_queries),
+    )
+
+    rng = random.Random(42)
+    queries = []
+    for document, content in results or []:
+        words = content.split()
+        if len(words) >= query_words * 2:
+            start = rng.randrange(len(words) - query_words)
+            query = " ".join(words[start : start + query_words])
+        else:
+            # Languages written without spaces: take a span of characters
+            start = rng.randrange(max(1, len(content) - query_chars))
+            query = content[start : start + query_chars]
+
+        queries.append((document, content, query))
+
+    return queries
+
+
+def paraphrase(contents: list[str]) -> list[str]:
+    chat = llm_facade.create_chat(model=ChatModelEnum.Chat_3_5, temperature=0)
+    return [
+        chat.predict(PARAPHRASE_PROMPT.format(text=content)).strip()
+        for content in contents
+    ]
+
+
+def run(search, queries, vectors, limit: int) -> tuple[float, list[float]]:
+    hits = 0
+    latencies = []
+    for (_, content, query), vector in zip(queries, vectors):
+        start = time.perf_counter()
+        results = search(vector, query, limit)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += any(r.metadata.content == content for r in results)
+
+    return hits / len(queries), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--namespace", required=True)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--query-words", type=int, default=4)
+    parser.add_argument("--query-chars", type=int, default=12)
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    queries = sample_queries(
+        args.namespace, args.queries, args.query_words, args.query_chars
+    )
+    if len(queries) == 0:
+        print(f"no vectors in namespace {args.namespace}")
+        return
+
+    documents = list({document for (document, _, _) in queries})
+    paraphrases = paraphrase([content for (_, content, _) in queries])
+    query_sets = {
+        "exact": queries,
+        "paraphrase": [
+            (document, content, query)
+            for (document, content, _), query in zip(queries, paraphrases)
+        ],
+    }
+    query_vectors = {
+        kind: llm_facade.embed_documents([query for (_, _, query) in kind_queries])
+        for kind, kind_queries in query_sets.items()
+    }
+
+    modes = {
+        "vector": lambda vector, query, limit: (
+            vector_store_repo.similarity_search_by_documents(
+                vector, documents, limit=limit
+            )
+        ),
+        "hybrid": lambda vector, query, limit: (
+            vector_store_repo.hybrid_search_by_documents(
+                vector, query, documents, limit=limit
+            )
+        ),
+    }
+
+    print(f"queries: {len(queries)}, documents: {len(documents)}, k: {args.limit}")
+    for kind, kind_queries in query_sets.items():
+        vectors = query_vectors[kind]
+        for name, search in modes.items():
+            # Warm up the caches and the connection
+            search(vectors[0], kind_queries[0][2], args.limit)
+
+            recall, latencies = run(search, kind_queries, vectors, args.limit)
+            latencies = sorted(latencies)
+            print(
+                f"{kind:>10} {name:>6}: recall@{args.limit}={recall:.2f}"
+                f" p50={statistics.median(latencies):.1f}ms"
+                f" p95={latencies[int(len(latencies) * 0.95)]:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare the previous selection of the summary chunks (full `KMeans` on a list of
+lists, one distance loop per cluster) with `get_representative_indices` on random
+embeddings of a 10,000-chunk document.
+
+Run inside the `ai` container:
+
+    cd /app/src && python ../benchmarks/bench_summary_clustering.py --chunks 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from repository.clustering import (  # noqa: E402
+    SummaryClusteringConfig,
+    get_representative_indices,
+)
+
+
+def make_embeddings(chunks: int, dimensions: int, topics: int) -> list[list[float]]:
+    """Unit vectors around `topics` random directions, like OpenAI embeddings."""
+    rng = np.random.default_rng(42)
+    centers = rng.normal(size=(topics, dimensions))
+    vectors = centers[rng.integers(topics, size=chunks)]
+    vectors += rng.normal(scale=0.5, size=(chunks, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.tolist()
+
+
+def legacy_representative_indices(vectors: list[list[float]], num_clusters: int):
+    """The previous implementation."""
+    num_clusters = min(len(vectors), num_clusters)
+    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init="auto").fit(
+        vectors
+    )
+    closest_indices = []
+    for i in range(num_clusters):
+        distances = np.linalg.norm(vectors - kmeans.cluster_centers_[i], axis=1)
+        closest_indices.append(int(np.argmin(distances)))
+
+    return sorted(closest_indices)
+
+
+def measure(name: str, select):
+    tracemalloc.start()
+    start = time.perf_counter()
+    indices = select()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>10}: {elapsed:.2f}s, peak {peak / 1024 / 1024:.0f} MiB,"
+        f" {len(indices)} chunks"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=10000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=30)
+    args = parser.parse_args()
+
+    embeddings = make_embeddings(args.chunks, args.dimensions, args.topics)
+    config = SummaryClusteringConfig()
+    print(
+        f"chunks: {args.chunks}, dimensions: {args.dimensions},"
+        f" clusters: {config.num_clusters(args.chunks)}"
+    )
+
+    measure("legacy", lambda: legacy_representative_indices(embeddings, 5))
+    measure(
+        "same k",
+        lambda: get_representative_indices(
+            embeddings, config.copy(update={"max_clusters": 5})
+        ),
+    )
+    measure("scaled k", lambda: get_representative_indices(embeddings, config))
+
+
+if __name__ == "__main__":
+    main()
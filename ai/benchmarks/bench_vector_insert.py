@@ -0,0 +1,90 @@
+"""Compare the old multi-statement INSERT with the binary COPY path of
+`VectorStoreRepo.insert_vectors`.
+
+Run inside the `ai` container:
+
+    cd /app/src && python ../benchmarks/bench_vector_insert.py --rows 5000
+"""
+
+import argparse
+import os
+import sys
+import time
+from uuid import uuid4
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from repository.helpers import make_chunks  # noqa: E402
+from repository.vector_store_repo import VectorMetadata, VectorStoreRepo  # noqa: E402
+
+_TABLE_NAME = "vectorstore_bench_insert"
+_VECTOR_SIZE = 1536
+
+
+def legacy_insert_vectors(
+    repo: VectorStoreRepo,
+    namespace: str,
+    document: str,
+    vectors: list[list[float]],
+    metadatas: list[VectorMetadata],
+):
+    """The previous implementation: 20 INSERT statements per round trip."""
+    rows = [(str(uuid4()), v, m) for v, m in zip(vectors, metadatas)]
+    for chunk in make_chunks(rows, 20):
+        query_str = ""
+        query_args = ()
+        for vector_id, vector, metadata in chunk:
+            query_str += f"""
+                INSERT INTO {_TABLE_NAME}
+                    (namespace, document, vector_id, vector, content, page_number, status)
+                VALUES (%s, %s, %s, %s, %s, %s, 'active');
+                """
+            query_args += (
+                namespace,
+                document,
+                vector_id,
+                vector,
+                metadata.content,
+                metadata.page_number,
+            )
+
+        repo._execute(query_str, query_args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    vectors = rng.random((args.rows, _VECTOR_SIZE), dtype=np.float32).tolist()
+    metadatas = [
+        VectorMetadata(content="lorem ipsum " * 150, page_number=i)
+        for i in range(args.rows)
+    ]
+
+    repo = VectorStoreRepo(_TABLE_NAME, _VECTOR_SIZE)
+    try:
+        start = time.perf_counter()
+        legacy_insert_vectors(repo, "bench", "legacy", vectors, metadatas)
+        legacy_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        repo.insert_vectors("bench", "copy", vectors, metadatas)
+        copy_duration = time.perf_counter() - start
+
+    finally:
+        repo._drop_table()
+
+    print(f"rows: {args.rows}")
+    print(
+        f"INSERT x20: {legacy_duration:.2f}s ({args.rows / legacy_duration:.0f} rows/s)"
+    )
+    print(f"COPY binary: {copy_duration:.2f}s ({args.rows / copy_duration:.0f} rows/s)")
+    print(f"speedup: {legacy_duration / copy_duration:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
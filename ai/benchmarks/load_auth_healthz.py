@@ -0,0 +1,199 @@
+"""Measure the `/healthz` latency while the API is flooded with authenticated requests.
+
+An auth storm must not stall the event loop: every request to an authenticated
+endpoint verifies its id_token, and before the async auth path that blocked the
+loop for the whole call to the LINE verify API.
+
+By default the script starts a stub of the LINE verify API, which answers after
+`--verify-latency` seconds, and an API on `--port` that uses it
+(`AUTH_VERIFY_URL`). Run it inside the `ai` container, with the database up:
+
+    cd /app/src && python ../benchmarks/load_auth_healthz.py --requests 2000
+
+With `--url` it loads an API that is already running instead. That API calls the
+verify API it is configured with: start it with
+`AUTH_VERIFY_URL=http://<this host>:<--stub-port>/verify` to keep the load off the
+real LINE verify API.
+
+Without `--token` every request carries a distinct random token. These tokens are
+never cached, so each one goes to the verify API, which rejects it (401 is expected).
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+from uuid import uuid4
+
+import httpx
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def run_verify_stub(port: int, latency: float):
+    """LINE verify API that rejects every token after `latency` seconds."""
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI()
+
+    @app.post("/verify")
+    async def verify():
+        await asyncio.sleep(latency)
+        return JSONResponse(
+            {"error": "invalid_request", "error_description": "Invalid IdToken."},
+            status_code=400,
+        )
+
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="warning")
+
+
+def start_api(port: int, verify_url: str) -> subprocess.Popen:
+    env = {**os.environ, "AUTH_VERIFY_URL": verify_url}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=SRC_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(url: str, timeout: float = 60):
+    async with httpx.AsyncClient() as client:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} is not ready")
+
+            await asyncio.sleep(0.2)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def probe_healthz(
+    client: httpx.AsyncClient, stop: asyncio.Event, interval: float
+) -> list[float]:
+    latencies: list[float] = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = await client.get("/healthz")
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(interval)
+
+    return latencies
+
+
+async def auth_storm(
+    client: httpx.AsyncClient,
+    path: str,
+    token: str | None,
+    num_requests: int,
+    concurrency: int,
+) -> dict[int, int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    status_codes: dict[int, int] = {}
+
+    async def request():
+        async with semaphore:
+            headers = {"Authorization": f"Bearer {token or uuid4().hex}"}
+            try:
+                response = await client.get(path, headers=headers)
+                code = response.status_code
+            except httpx.HTTPError:
+                code = 0
+
+            status_codes[code] = status_codes.get(code, 0) + 1
+
+    await asyncio.gather(*[request() for _ in range(num_requests)])
+    return status_codes
+
+
+def print_latencies(name: str, latencies: list[float]):
+    print(
+        f"{name:>12}: n={len(latencies)}"
+        f" p50={statistics.median(latencies):.1f}ms"
+        f" p95={percentile(latencies, 0.95):.1f}ms"
+        f" max={max(latencies):.1f}ms"
+    )
+
+
+async def main(args: argparse.Namespace):
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=60, limits=limits
+    ) as client:
+        # Baseline without load
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_healthz(client, stop, args.interval))
+        await asyncio.sleep(args.baseline_seconds)
+        stop.set()
+        baseline = await probe
+
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_healthz(client, stop, args.interval))
+        start = time.perf_counter()
+        status_codes = await auth_storm(
+            client, args.path, args.token, args.requests, args.concurrency
+        )
+        duration = time.perf_counter() - start
+        stop.set()
+        under_load = await probe
+
+    print(
+        f"auth storm: {args.requests} requests in {duration:.1f}s"
+        f" ({args.requests / duration:.0f} req/s), status codes {status_codes}"
+    )
+    print_latencies("idle", baseline)
+    print_latencies("auth storm", under_load)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None, help="an API that is already running")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--stub-port", type=int, default=8099)
+    parser.add_argument("--verify-latency", type=float, default=0.1)
+    parser.add_argument("--path", default="/document/list_my/")
+    parser.add_argument("--token", default=None, help="a valid LIFF id_token")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--baseline-seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(
+        target=run_verify_stub,
+        args=(args.stub_port, args.verify_latency),
+        daemon=True,
+    )
+    stub.start()
+    api = None
+    if args.url is None:
+        args.url = f"http://localhost:{args.port}"
+        api = start_api(args.port, f"http://localhost:{args.stub_port}/verify")
+
+    try:
+        asyncio.run(wait_ready(f"http://localhost:{args.stub_port}/docs"))
+        asyncio.run(wait_ready(f"{args.url}/healthz"))
+        asyncio.run(main(args))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+        stub.terminate()
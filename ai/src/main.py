@@ -1,6 +1,8 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from repository import auth_repo
+from repository.base_db import close_async_pool
 from router import router_attach
 
 app = FastAPI()
@@ -18,6 +20,12 @@ app.add_middleware(
 router_attach(app)
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_async_pool()
+    await auth_repo.aclose()
+
+
 @app.get("/healthz")
 async def healthz():
     return "healthy"
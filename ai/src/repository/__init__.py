@@ -4,14 +4,28 @@ from dotenv import load_dotenv
 from minio import Minio
 from systems.simple_ai_system import SimpleAISystem
 
-from repository.auth_repo import AuthRepo
+from repository.admin_repo import AdminRepo
+from repository.auth_repo import LINE_VERIFY_URL, AuthRepo
+from repository.chunking_config_repo import ChunkingConfigRepo
+from repository.clustering import SummaryClusteringConfig
 from repository.document_download import DocumentDownload
-from repository.document_parser import DocumentParser
+from repository.document_parser import (
+    ChunkingConfig,
+    ChunkStrategyEnum,
+    DocumentParser,
+    UnstructuredConfig,
+)
 from repository.document_repo import DocumentRepo
+from repository.embedding_cache import EmbeddingCache
+from repository.job_queue_repo import JobQueueRepo
 from repository.llm_facade import LLMFacade
 from repository.storage_facade import StorageFacade
 from repository.usage_repo import UsageRepo
-from repository.vector_store_repo import VectorStoreRepo
+from repository.vector_store_repo import (
+    VectorIndexConfig,
+    VectorIndexTypeEnum,
+    VectorStoreRepo,
+)
 from repository.workspace_repo import WorkspaceRepo
 
 load_dotenv()
@@ -24,6 +38,47 @@ LIFF_CLIENT_ID = os.environ["LIFF_CLIENT_ID"]
 UNSTRUCTURED_ENDPOINT = os.environ["UNSTRUCTURED_ENDPOINT"]
 SUPPORT_TYPES = os.environ["SUPPORT_TYPES"]
 OPENAI_KEY = os.environ["OPENAI_KEY"]
+ADMIN_USER_IDS = os.environ.get("ADMIN_USER_IDS", "")
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_LOCAL_VERIFY = os.environ.get("AUTH_LOCAL_VERIFY", "false").lower() == "true"
+AUTH_JWKS_LIFESPAN_SECONDS = int(os.environ.get("AUTH_JWKS_LIFESPAN_SECONDS", "3600"))
+AUTH_HTTP_TIMEOUT_SECONDS = float(os.environ.get("AUTH_HTTP_TIMEOUT_SECONDS", "10"))
+AUTH_HTTP_MAX_CONNECTIONS = int(os.environ.get("AUTH_HTTP_MAX_CONNECTIONS", "100"))
+AUTH_VERIFY_URL = os.environ.get("AUTH_VERIFY_URL", LINE_VERIFY_URL)
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", VectorIndexTypeEnum.HNSW.value)
+VECTOR_INDEX_HNSW_M = int(os.environ.get("VECTOR_INDEX_HNSW_M", "16"))
+VECTOR_INDEX_HNSW_EF_CONSTRUCTION = int(
+    os.environ.get("VECTOR_INDEX_HNSW_EF_CONSTRUCTION", "64")
+)
+VECTOR_INDEX_HNSW_EF_SEARCH = int(os.environ.get("VECTOR_INDEX_HNSW_EF_SEARCH", "40"))
+VECTOR_INDEX_IVFFLAT_LISTS = int(os.environ.get("VECTOR_INDEX_IVFFLAT_LISTS", "100"))
+VECTOR_INDEX_IVFFLAT_PROBES = int(os.environ.get("VECTOR_INDEX_IVFFLAT_PROBES", "1"))
+VECTOR_EXACT_SEARCH_MAX_ROWS = int(
+    os.environ.get("VECTOR_EXACT_SEARCH_MAX_ROWS", "10000")
+)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", "50000"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+SUMMARY_CONCURRENCY = int(os.environ.get("SUMMARY_CONCURRENCY", "5"))
+SUMMARY_TIMEOUT_SECONDS = float(os.environ.get("SUMMARY_TIMEOUT_SECONDS", "120"))
+SUMMARY_MIN_CLUSTERS = int(os.environ.get("SUMMARY_MIN_CLUSTERS", "5"))
+SUMMARY_MAX_CLUSTERS = int(os.environ.get("SUMMARY_MAX_CLUSTERS", "20"))
+SUMMARY_CHUNKS_PER_CLUSTER = int(os.environ.get("SUMMARY_CHUNKS_PER_CLUSTER", "100"))
+SUMMARY_MINIBATCH_THRESHOLD = int(os.environ.get("SUMMARY_MINIBATCH_THRESHOLD", "2000"))
+UNSTRUCTURED_PAGES_PER_REQUEST = int(
+    os.environ.get("UNSTRUCTURED_PAGES_PER_REQUEST", "10")
+)
+UNSTRUCTURED_CONCURRENCY = int(os.environ.get("UNSTRUCTURED_CONCURRENCY", "4"))
+UNSTRUCTURED_TIMEOUT_SECONDS = float(
+    os.environ.get("UNSTRUCTURED_TIMEOUT_SECONDS", "300")
+)
+UNSTRUCTURED_MAX_RETRIES = int(os.environ.get("UNSTRUCTURED_MAX_RETRIES", "3"))
+CHUNK_STRATEGY = os.environ.get("CHUNK_STRATEGY", ChunkStrategyEnum.Tokens.value)
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "100"))
+EXTRACT_MAX_ANSWER_TOKENS = int(os.environ.get("EXTRACT_MAX_ANSWER_TOKENS", "1024"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY_SECONDS = int(os.environ.get("JOB_RETRY_DELAY_SECONDS", "30"))
 
 minio_client = Minio(
     S3_ENDPOINT,
@@ -33,22 +88,85 @@ minio_client = Minio(
     secure=False,
 )
 
-llm_facade = LLMFacade(OPENAI_KEY)
-document_parser = DocumentParser(UNSTRUCTURED_ENDPOINT, SUPPORT_TYPES)
+llm_facade = LLMFacade(
+    OPENAI_KEY,
+    embedding_cache=EmbeddingCache(maxsize=EMBEDDING_CACHE_SIZE),
+    embedding_batch_tokens=EMBEDDING_BATCH_TOKENS,
+    embedding_concurrency=EMBEDDING_CONCURRENCY,
+)
+document_parser = DocumentParser(
+    UNSTRUCTURED_ENDPOINT,
+    SUPPORT_TYPES,
+    unstructured_config=UnstructuredConfig(
+        pages_per_request=UNSTRUCTURED_PAGES_PER_REQUEST,
+        concurrency=UNSTRUCTURED_CONCURRENCY,
+        timeout_seconds=UNSTRUCTURED_TIMEOUT_SECONDS,
+        max_retries=UNSTRUCTURED_MAX_RETRIES,
+    ),
+)
+chunking_config_repo = ChunkingConfigRepo(
+    default_config=ChunkingConfig(
+        strategy=ChunkStrategyEnum(CHUNK_STRATEGY),
+        chunk_size=CHUNK_SIZE,
+        overlap=CHUNK_OVERLAP,
+    )
+)
 
-auth_repo = AuthRepo(client_id=LIFF_CLIENT_ID)
+auth_repo = AuthRepo(
+    client_id=LIFF_CLIENT_ID,
+    token_cache_size=AUTH_TOKEN_CACHE_SIZE,
+    local_verify=AUTH_LOCAL_VERIFY,
+    jwks_lifespan_seconds=AUTH_JWKS_LIFESPAN_SECONDS,
+    http_timeout_seconds=AUTH_HTTP_TIMEOUT_SECONDS,
+    http_max_connections=AUTH_HTTP_MAX_CONNECTIONS,
+    verify_url=AUTH_VERIFY_URL,
+)
 usage_repo = UsageRepo(llm=llm_facade)
-vector_store_repo = VectorStoreRepo(table_name="vectorstore", vector_size=1536)
+vector_store_repo = VectorStoreRepo(
+    table_name="vectorstore",
+    vector_size=1536,
+    index_config=VectorIndexConfig(
+        index_type=VectorIndexTypeEnum(VECTOR_INDEX_TYPE),
+        m=VECTOR_INDEX_HNSW_M,
+        ef_construction=VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+        lists=VECTOR_INDEX_IVFFLAT_LISTS,
+        ef_search=VECTOR_INDEX_HNSW_EF_SEARCH,
+        probes=VECTOR_INDEX_IVFFLAT_PROBES,
+        exact_search_max_rows=VECTOR_EXACT_SEARCH_MAX_ROWS,
+    ),
+)
 storage_facade = StorageFacade(minio_client, "lvn-ai-demo")
 document_repo = DocumentRepo(
     llm=llm_facade,
     vector_store_repo=vector_store_repo,
     storage_facade=storage_facade,
     document_parser=document_parser,
+    chunking_config_repo=chunking_config_repo,
+    summary_concurrency=SUMMARY_CONCURRENCY,
+    summary_timeout_seconds=SUMMARY_TIMEOUT_SECONDS,
+    summary_clustering_config=SummaryClusteringConfig(
+        min_clusters=SUMMARY_MIN_CLUSTERS,
+        max_clusters=SUMMARY_MAX_CLUSTERS,
+        chunks_per_cluster=SUMMARY_CHUNKS_PER_CLUSTER,
+        minibatch_threshold=SUMMARY_MINIBATCH_THRESHOLD,
+    ),
 )
 document_download = DocumentDownload()
-simple_ai_system = SimpleAISystem(llm_facade, document_repo, vector_store_repo)
+job_queue_repo = JobQueueRepo(
+    max_attempts=JOB_MAX_ATTEMPTS, retry_delay_seconds=JOB_RETRY_DELAY_SECONDS
+)
+simple_ai_system = SimpleAISystem(
+    llm_facade,
+    document_repo,
+    vector_store_repo,
+    extract_max_answer_tokens=EXTRACT_MAX_ANSWER_TOKENS,
+)
 workspace_repo = WorkspaceRepo()
+admin_repo = AdminRepo(
+    vector_store_repo=vector_store_repo,
+    chunking_config_repo=chunking_config_repo,
+    admin_user_ids=ADMIN_USER_IDS,
+)
 
 __all__ = [
     "auth_repo",
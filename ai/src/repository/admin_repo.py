@@ -1,5 +1,69 @@
+from fastapi import HTTPException, status
+
+from repository.auth_repo import LineUserInfo
+from repository.base_db import async_pool_stats, get_db
+from repository.chunking_config_repo import ChunkingConfigRepo
+from repository.document_parser import ChunkingConfig
+from repository.vector_store_repo import VectorStatusEnum, VectorStoreRepo
 
 
 class AdminRepo:
-    def __init__(self) -> None:
-        pass
+    def __init__(
+        self,
+        vector_store_repo: VectorStoreRepo,
+        chunking_config_repo: ChunkingConfigRepo,
+        admin_user_ids: str,
+    ) -> None:
+        self._vector_store_repo = vector_store_repo
+        self._chunking_config_repo = chunking_config_repo
+        self._admin_user_ids = [i for i in admin_user_ids.split(",") if i != ""]
+
+    def check_admin_or_forbidden(self, user: LineUserInfo):
+        if user.sub not in self._admin_user_ids:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="user is not admin",
+            )
+
+    def build_vector_indexes(self):
+        self._vector_store_repo.build_indexes(concurrently=True)
+
+    def rebuild_vector_index(self):
+        self._vector_store_repo.rebuild_vector_index()
+
+    def set_vector_status(
+        self, namespace: str, vector_status: VectorStatusEnum, document: str = ""
+    ):
+        try:
+            self._vector_store_repo.set_vector_status_in_document(
+                namespace, vector_status, document
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
+
+    def get_chunking_config(self, namespace: str) -> ChunkingConfig:
+        return self._chunking_config_repo.get_config(namespace)
+
+    def set_chunking_config(self, namespace: str, config: ChunkingConfig):
+        try:
+            self._chunking_config_repo.set_config(namespace, config)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
+
+    def delete_chunking_config(self, namespace: str):
+        self._chunking_config_repo.delete_config(namespace)
+
+    def list_vector_indexes(self):
+        return self._vector_store_repo.list_indexes()
+
+    def get_db_pool_stats(self):
+        return {
+            "sync": get_db().pool_stats(),
+            "async": async_pool_stats(),
+        }
@@ -1,18 +1,33 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+import hashlib
 import json
+import time
 from typing import Annotated, List
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+import httpx
+import jwt
 from peewee import CharField, IntegerField, TextField
 
 import requests
 from pydantic import BaseModel
 
 from repository.base_db import BaseDBModel, from_int, from_str, get_db
-from repository.helpers import cprint_warn, get_timestamp
+from repository.helpers import LRUCache, cprint_warn, get_timestamp
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+LINE_VERIFY_URL = "https://api.line.me/oauth2/v2.1/verify"
+LINE_ISSUER = "https://access.line.me"
+LINE_JWKS_URL = "https://api.line.me/oauth2/v2.1/certs"
+# Tokens expiring within this window are verified again instead of served from cache.
+_TOKEN_EXPIRE_LEEWAY_SECONDS = 10
+# A user row is rewritten when its profile changed or its iat is older than this.
+_USER_REFRESH_INTERVAL = timedelta(minutes=5)
+_USER_PROFILE_FIELDS = ["iss", "aud", "amr", "name", "picture"]
+
 
 class LineUserInfoDB(BaseDBModel):
     iss = CharField()
@@ -61,9 +76,44 @@ class LineUserInfo(BaseModel):
         )
 
 
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 class AuthRepo:
-    def __init__(self, client_id: str) -> None:
+    """Verify LINE id_tokens.
+
+    Verified tokens are cached by hash until their `exp`, so the LINE verify API is
+    called once per token rather than once per request. With `local_verify` the
+    ES256 tokens are verified against the LINE JWKS (cached `jwks_lifespan_seconds`),
+    other tokens still go through the verify API.
+    The `LineUserInfoDB` row is written in the background and only when it changed.
+    `get_current_user` uses the async path, so it does not block the event loop.
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        token_cache_size: int = 10000,
+        local_verify: bool = False,
+        jwks_lifespan_seconds: int = 3600,
+        http_timeout_seconds: float = 10,
+        http_max_connections: int = 100,
+        verify_url: str = LINE_VERIFY_URL,
+    ) -> None:
         self.client_id = client_id
+        self._verify_url = verify_url
+        self._http_timeout_seconds = http_timeout_seconds
+        self._http_max_connections = http_max_connections
+        self._http_client: httpx.AsyncClient | None = None
+        self._local_verify = local_verify
+        self._token_cache: LRUCache[LineUserInfo] = LRUCache(token_cache_size)
+        # Last known fields of the user rows, by sub
+        self._user_rows: LRUCache[dict] = LRUCache(token_cache_size)
+        self._user_writer = ThreadPoolExecutor(max_workers=1)
+        self._jwks_client = jwt.PyJWKClient(
+            LINE_JWKS_URL, cache_jwk_set=True, lifespan=jwks_lifespan_seconds
+        )
 
     def verify_access_token(self, token: str):
         response = requests.get(
@@ -72,14 +122,42 @@ class AuthRepo:
 
         return response.text
 
+    def _parse_verify_response(self, resp_obj: dict) -> LineUserInfo:
+        resp_err = resp_obj.get("error")
+        if resp_err is not None:
+            cprint_warn(f"unauthorized {str(resp_obj)}")
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="cannot verify id_token",
+            )
+
+        try:
+            user = LineUserInfo.parse_obj(resp_obj)
+
+        except Exception as e:
+            print(">>> ERR parsing LineUserInfo", e)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="unable to parse LineUserInfo",
+            )
+
+        if user.aud != self.client_id:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="aud is not client_id. you are in incorrect liff app.",
+            )
+
+        return user
+
     def verify_id_token(self, id_token: str):
         try:
             response = requests.post(
-                "https://api.line.me/oauth2/v2.1/verify",
+                self._verify_url,
                 data={
                     "id_token": id_token,
                     "client_id": self.client_id,
                 },
+                timeout=self._http_timeout_seconds,
             )
 
         except Exception as e:
@@ -89,17 +167,92 @@ class AuthRepo:
                 detail="unable to connect to auth server",
             )
 
-        resp_obj = response.json()
-        resp_err = resp_obj.get("error")
-        if resp_err is not None:
-            cprint_warn(f"unauthorized {str(resp_obj)}")
+        return self._parse_verify_response(response.json())
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        # Created on first use so that it belongs to the running event loop.
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(
+                timeout=self._http_timeout_seconds,
+                limits=httpx.Limits(
+                    max_connections=self._http_max_connections,
+                    max_keepalive_connections=self._http_max_connections,
+                ),
+            )
+
+        return self._http_client
+
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    async def averify_id_token(self, id_token: str) -> LineUserInfo:
+        """Async version of `verify_id_token` on a shared httpx connection pool."""
+        try:
+            response = await self._get_http_client().post(
+                self._verify_url,
+                data={
+                    "id_token": id_token,
+                    "client_id": self.client_id,
+                },
+            )
+
+        except Exception as e:
+            print(">>> ERR connect to auth server", e)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="unable to connect to auth server",
+            )
+
+        return self._parse_verify_response(response.json())
+
+    def _verify_id_token_local(self, id_token: str) -> LineUserInfo | None:
+        """Verify the JWT signature with the LINE JWKS. Returns None when the token
+        cannot be verified locally (not ES256, unknown key, JWKS unavailable).
+        """
+        try:
+            header = jwt.get_unverified_header(id_token)
+            if header.get("alg") != "ES256":
+                return None
+
+            signing_key = self._jwks_client.get_signing_key_from_jwt(id_token)
+
+        except jwt.PyJWKClientError as e:
+            cprint_warn(f"cannot verify id_token locally {e}")
+            return None
+
+        except jwt.InvalidTokenError as e:
+            cprint_warn(f"unauthorized {e}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="cannot verify id_token",
             )
 
         try:
-            user = LineUserInfo.parse_obj(resp_obj)
+            claims = jwt.decode(
+                id_token,
+                signing_key.key,
+                algorithms=["ES256"],
+                audience=self.client_id,
+                issuer=LINE_ISSUER,
+            )
+
+        except jwt.InvalidAudienceError:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="aud is not client_id. you are in incorrect liff app.",
+            )
+
+        except jwt.InvalidTokenError as e:
+            cprint_warn(f"unauthorized {e}")
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="cannot verify id_token",
+            )
+
+        try:
+            return LineUserInfo.parse_obj(claims)
 
         except Exception as e:
             print(">>> ERR parsing LineUserInfo", e)
@@ -108,14 +261,96 @@ class AuthRepo:
                 detail="unable to parse LineUserInfo",
             )
 
-        if user.aud != self.client_id:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="aud is not client_id. you are in incorrect liff app.",
-            )
+    def _get_cached_user(self, key: str) -> LineUserInfo | None:
+        user = self._token_cache.get(key)
+        if user is None:
+            return None
 
+        if user.exp > time.time() + _TOKEN_EXPIRE_LEEWAY_SECONDS:
+            return user
+
+        self._token_cache.delete(key)
+        return None
+
+    def _set_cached_user(self, key: str, user: LineUserInfo):
+        self._token_cache.set(key, user)
+        self._save_user_background(user)
+
+    def verify_id_token_cached(self, id_token: str) -> LineUserInfo:
+        """`verify_id_token` with the verified-token cache. The user row is saved
+        in the background when the token was not in the cache."""
+        key = hash_token(id_token)
+        user = self._get_cached_user(key)
+        if user is not None:
+            return user
+
+        if self._local_verify:
+            user = self._verify_id_token_local(id_token)
+
+        if user is None:
+            user = self.verify_id_token(id_token)
+
+        self._set_cached_user(key, user)
         return user
 
+    async def averify_id_token_cached(self, id_token: str) -> LineUserInfo:
+        """Async version of `verify_id_token_cached`. Nothing blocks the event loop:
+        the local verification (JWKS fetch) runs in a worker thread and the verify
+        API is called with httpx."""
+        key = hash_token(id_token)
+        user = self._get_cached_user(key)
+        if user is not None:
+            return user
+
+        if self._local_verify:
+            user = await asyncio.to_thread(self._verify_id_token_local, id_token)
+
+        if user is None:
+            user = await self.averify_id_token(id_token)
+
+        self._set_cached_user(key, user)
+        return user
+
+    def _save_user(self, user: LineUserInfo):
+        fields = user.to_db().__data__
+        fields.pop("id", None)
+
+        saved = self._user_rows.get(user.sub)
+        if saved is None:
+            saved = (
+                LineUserInfoDB.select()
+                .where(LineUserInfoDB.sub == user.sub)
+                .dicts()
+                .first()
+            )
+
+        if saved is not None:
+            saved_timestamp = datetime.fromtimestamp(float(saved["iat"])).replace(
+                tzinfo=timezone.utc
+            )
+            changed = any(saved[k] != fields[k] for k in _USER_PROFILE_FIELDS)
+            if (
+                not changed
+                and get_timestamp() - saved_timestamp <= _USER_REFRESH_INTERVAL
+            ):
+                self._user_rows.set(user.sub, saved)
+                return
+
+        LineUserInfoDB.insert(**fields).on_conflict(
+            conflict_target=[LineUserInfoDB.sub],
+            preserve=[getattr(LineUserInfoDB, k) for k in fields if k != "sub"],
+        ).execute()
+        self._user_rows.set(user.sub, fields)
+
+    def _save_user_background(self, user: LineUserInfo):
+        def save():
+            try:
+                self._save_user(user)
+            except Exception as e:
+                print(">>> ERR saving LineUserInfo", e)
+
+        self._user_writer.submit(save)
+
     def get_users(self, user_ids: List[str]):
         users_db = LineUserInfoDB.select().where(LineUserInfoDB.sub.in_(user_ids))
         return [LineUserInfo.from_db(user_db) for user_db in users_db]
@@ -123,33 +358,7 @@ class AuthRepo:
     async def get_current_user(
         self, token: Annotated[str, Depends(oauth2_scheme)]
     ) -> LineUserInfo:
-        user_data_jwk = self.verify_id_token(token)
-        user_data_db = LineUserInfoDB.get_or_none(
-            LineUserInfoDB.sub == user_data_jwk.sub
-        )
-        user_data = (
-            LineUserInfo.from_db(user_data_db) if user_data_db is not None else None
-        )
-
-        if user_data_db is None or user_data is None:
-            user_data_jwk.to_db().save()
-        else:
-            # Check if the record in db is old one. If it is too old then we need to update it.
-            user_data_timestamp = datetime.fromtimestamp(float(user_data.iat)).replace(
-                tzinfo=timezone.utc
-            )
-            delta_user_issue_at_timestamp = get_timestamp() - user_data_timestamp
-            if delta_user_issue_at_timestamp > timedelta(minutes=5):
-                print(
-                    "nanii >>",
-                    user_data_db.get_id(),
-                    delta_user_issue_at_timestamp,
-                    user_data.iat,
-                    user_data_jwk.iat,
-                )
-                LineUserInfoDB.set_by_id(user_data_db.get_id(), user_data_jwk.dict())
-
-        return user_data_jwk
+        return await self.averify_id_token_cached(token)
 
 
 # Create table if not exists
@@ -1,20 +1,225 @@
+import asyncio
+import os
+import threading
+import time
 from datetime import datetime, timezone
 from typing import Any, List
-from peewee import Field, Model, PostgresqlDatabase
+
+import asyncpg
+from peewee import Field, Model, ProgrammingError
+from pgvector.asyncpg import register_vector as register_vector_async
 from pgvector.psycopg2 import register_vector
+from psycopg2 import InterfaceError, OperationalError
+from playhouse.migrate import PostgresqlMigrator, migrate
+from playhouse.pool import MaxConnectionsExceeded, PooledPostgresqlDatabase
+
+DB_NAME = "line-ai-demo"
+DB_USER = "root"
+DB_PASSWORD = "password"
+DB_HOST = "database"
+DB_PORT = 5432
+
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_IDLE_CHECK_SECONDS = float(os.environ.get("DB_POOL_IDLE_CHECK_SECONDS", "30"))
+ASYNC_DB_POOL_MIN_SIZE = int(os.environ.get("ASYNC_DB_POOL_MIN_SIZE", "1"))
+ASYNC_DB_POOL_MAX_SIZE = int(os.environ.get("ASYNC_DB_POOL_MAX_SIZE", "20"))
+
+
+class PooledDatabase(PooledPostgresqlDatabase):
+    """Peewee pool of psycopg2 connections, shared by the models and the raw SQL
+    repositories.
+
+    Peewee keeps the connection state per thread: a thread checks a connection out of
+    the pool when it needs one and gives it back on `close()`. Statements run outside
+    of `connection_context()` / `atomic()` check out a connection for the statement only
+    (see `execute_sql`), so idle threads do not hold connections.
+    When all `max_connections` are in use, `connect()` waits up to `timeout` seconds
+    for one to be returned, without holding the lock of the database.
+
+    Health: a connection idle in the pool for more than `idle_check` seconds is checked
+    with `SELECT 1` on checkout and replaced when broken. Connections found broken while
+    running a query are dropped with `reconnect`. Both are counted in `reconnects`.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        max_connections: int,
+        timeout: float,
+        idle_check: float,
+        **kwargs,
+    ):
+        self._idle_check = idle_check
+        self._idle_since: dict[int, float] = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {"checkouts": 0, "wait_timeouts": 0, "reconnects": 0}
+        super().__init__(
+            database, max_connections=max_connections, timeout=timeout, **kwargs
+        )
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def connect(self, reuse_if_open=False):
+        try:
+            return super().connect(reuse_if_open)
+        except MaxConnectionsExceeded as e:
+            self._count("wait_timeouts")
+            raise e
+
+    def _is_closed(self, conn) -> bool:
+        if super()._is_closed(conn):
+            return True
+
+        idle_since = self._idle_since.pop(id(conn), None)
+        if idle_since is None or time.monotonic() - idle_since < self._idle_check:
+            return False
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return False
+
+        except (OperationalError, InterfaceError) as e:
+            print("Reconnected db", e)
+            self._count("reconnects")
+            conn.close()
+            return True
+
+    def _connect(self):
+        conn = super()._connect()
+        self._count("checkouts")
+        return conn
+
+    def _close(self, conn, close_conn=False):
+        if not close_conn and not conn.closed:
+            self._idle_since[id(conn)] = time.monotonic()
+
+        super()._close(conn, close_conn)
+
+    def execute_sql(self, sql, params=None, commit=None):
+        if not self.is_closed():
+            return super().execute_sql(sql, params)
+
+        # NOTE: the rows of a (non named) psycopg2 cursor are fetched by `execute`,
+        # so the connection can go back to the pool before the caller reads them.
+        self.connect()
+        try:
+            return super().execute_sql(sql, params)
+        finally:
+            if not self.in_transaction():
+                self.close()
+
+    def reconnect(self, error: Exception):
+        """Drop the connection of the current thread after `error`. The next statement
+        checks out another one."""
+        print("Reconnected db", error)
+        self._count("reconnects")
+        self.manual_close()
+
+    def pool_stats(self) -> dict:
+        with self._lock:
+            in_use = len(self._in_use)
+            idle = len(self._connections)
+
+        with self._stats_lock:
+            return {
+                "max_size": self._max_connections,
+                "size": in_use + idle,
+                "idle": idle,
+                "in_use": in_use,
+                **self._stats,
+            }
 
 
-def get_db():
-    return PostgresqlDatabase(
-        "line-ai-demo",
-        user="root",
-        password="password",
-        host="database",
-        port=5432,
-    )
+_db = PooledDatabase(
+    DB_NAME,
+    max_connections=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT_SECONDS,
+    idle_check=DB_POOL_IDLE_CHECK_SECONDS,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    host=DB_HOST,
+    port=DB_PORT,
+)
+
+
+def get_db() -> PooledDatabase:
+    return _db
 
 
 register_vector(get_db())
+get_db().close()
+
+
+_async_pool: asyncpg.Pool | None = None
+_async_pool_lock = asyncio.Lock()
+_async_server_settings: dict[str, str] = {}
+# Session settings the connections of the pool were created with
+_async_pool_settings: dict[str, str] = {}
+_async_stats = {"reconnects": 0}
+
+
+def set_async_server_settings(settings: dict[str, int]):
+    """Default session settings of the asyncpg connections, sent when they connect.
+    Settings set after the pool is created are ignored: call it at startup."""
+    _async_server_settings.update({name: str(v) for name, v in settings.items()})
+
+
+def async_server_settings() -> dict[str, str]:
+    """Session settings the asyncpg connections start with. The pool restores them
+    (`RESET ALL`) when a connection is released."""
+    return _async_pool_settings
+
+
+async def get_async_pool() -> asyncpg.Pool:
+    """asyncpg pool of the process, created on first use inside the event loop."""
+    global _async_pool, _async_pool_settings
+    async with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool_settings = dict(_async_server_settings)
+            _async_pool = await asyncpg.create_pool(
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=DB_PORT,
+                min_size=ASYNC_DB_POOL_MIN_SIZE,
+                max_size=ASYNC_DB_POOL_MAX_SIZE,
+                init=register_vector_async,
+                server_settings=_async_pool_settings,
+            )
+
+    return _async_pool
+
+
+def async_reconnect(error: Exception):
+    """Count an asyncpg connection lost while running a query. The pool drops closed
+    connections when they are released."""
+    print("Reconnected async db", error)
+    _async_stats["reconnects"] += 1
+
+
+def async_pool_stats() -> dict:
+    if _async_pool is None:
+        return {}
+
+    return {
+        "min_size": _async_pool.get_min_size(),
+        "max_size": _async_pool.get_max_size(),
+        "size": _async_pool.get_size(),
+        "idle": _async_pool.get_idle_size(),
+        **_async_stats,
+    }
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
 
 
 class BaseDBModel(Model):
@@ -22,6 +227,27 @@ class BaseDBModel(Model):
         database = get_db()
 
 
+def add_missing_columns(model: type[Model]):
+    """Add the fields of `model` that are missing in its existing table, since
+    `create_tables` does not alter tables. New fields must be nullable or have a default.
+    """
+    db = model._meta.database
+    table_name = model._meta.table_name
+    columns = [c.name for c in db.get_columns(table_name)]
+    migrator = PostgresqlMigrator(db)
+    for field in model._meta.sorted_fields:
+        if field.column_name in columns:
+            continue
+
+        try:
+            migrate(migrator.add_column(table_name, field.column_name, field))
+            print(f"Added column {table_name}.{field.column_name}")
+
+        except ProgrammingError as e:
+            # Another process (api / worker) added it at the same time
+            print(f"Unable to add column {table_name}.{field.column_name}", e)
+
+
 def from_str(x: Any) -> str:
     assert isinstance(x, str)
     return x
@@ -0,0 +1,64 @@
+from peewee import CharField, DateTimeField, IntegerField
+
+from repository.base_db import BaseDBModel, from_int, from_str, get_db
+from repository.document_parser import ChunkingConfig, ChunkStrategyEnum
+from repository.helpers import get_timestamp
+
+
+class NamespaceChunkingDB(BaseDBModel):
+    namespace = CharField(unique=True)
+    strategy = CharField()
+    chunk_size = IntegerField()
+    overlap = IntegerField()
+    update_at = DateTimeField()
+
+
+class ChunkingConfigRepo:
+    """Chunking of the documents of a namespace. The namespaces without a row use
+    `default_config`."""
+
+    def __init__(self, default_config: ChunkingConfig) -> None:
+        default_config.check()
+        self._default_config = default_config
+
+    def get_default_config(self) -> ChunkingConfig:
+        return self._default_config.copy()
+
+    def get_config(self, namespace: str) -> ChunkingConfig:
+        row = NamespaceChunkingDB.get_or_none(
+            NamespaceChunkingDB.namespace == namespace
+        )
+        if row is None:
+            return self.get_default_config()
+
+        return ChunkingConfig(
+            strategy=ChunkStrategyEnum(from_str(row.strategy)),
+            chunk_size=from_int(row.chunk_size),
+            overlap=from_int(row.overlap),
+        )
+
+    def set_config(self, namespace: str, config: ChunkingConfig):
+        """Raise ValueError for an invalid config. The documents already processed
+        keep their chunks until they are processed again."""
+        config.check()
+
+        data = {
+            NamespaceChunkingDB.strategy: config.strategy.value,
+            NamespaceChunkingDB.chunk_size: config.chunk_size,
+            NamespaceChunkingDB.overlap: config.overlap,
+            NamespaceChunkingDB.update_at: get_timestamp(),
+        }
+        NamespaceChunkingDB.insert(
+            {NamespaceChunkingDB.namespace: namespace, **data}
+        ).on_conflict(
+            conflict_target=[NamespaceChunkingDB.namespace], update=data
+        ).execute()
+
+    def delete_config(self, namespace: str):
+        NamespaceChunkingDB.delete().where(
+            NamespaceChunkingDB.namespace == namespace
+        ).execute()
+
+
+# Create table if not exists
+get_db().create_tables([NamespaceChunkingDB])
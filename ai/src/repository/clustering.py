@@ -0,0 +1,62 @@
+"""Selection of the chunks that represent a document in its summary: the chunk
+closest to the center of each cluster of embeddings."""
+
+import math
+from typing import List, Sequence
+
+import numpy as np
+from pydantic import BaseModel
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances_argmin
+
+
+class SummaryClusteringConfig(BaseModel):
+    """Clustering of the chunk embeddings of a document.
+
+    - `chunks_per_cluster`: one cluster per this many chunks, between
+      `min_clusters` and `max_clusters`. Each cluster is one summary request.
+    - `minibatch_threshold`: documents with at least this many chunks are clustered
+      with `MiniBatchKMeans` on batches of `batch_size` chunks; its k-means++ init
+      runs on a sample of `3 * batch_size` chunks.
+    """
+
+    min_clusters: int = 5
+    max_clusters: int = 20
+    chunks_per_cluster: int = 100
+    minibatch_threshold: int = 2000
+    batch_size: int = 1024
+
+    def num_clusters(self, num_chunks: int) -> int:
+        num_clusters = math.ceil(num_chunks / max(1, self.chunks_per_cluster))
+        num_clusters = max(self.min_clusters, min(self.max_clusters, num_clusters))
+        return min(num_chunks, num_clusters)
+
+
+def get_representative_indices(
+    embeddings: Sequence[Sequence[float]], config: SummaryClusteringConfig
+) -> List[int]:
+    """Sorted indices of the chunks closest to the cluster centers. A chunk closest
+    to several centers is returned once."""
+    if len(embeddings) == 0:
+        return []
+
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    num_clusters = config.num_clusters(len(vectors))
+
+    if len(vectors) >= config.minibatch_threshold:
+        kmeans = MiniBatchKMeans(
+            n_clusters=num_clusters,
+            batch_size=config.batch_size,
+            init_size=min(len(vectors), 3 * config.batch_size),
+            n_init=3,
+            random_state=42,
+        )
+    else:
+        kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init="auto")
+    kmeans.fit(vectors)
+
+    # The centers are float32 like the vectors: no float64 copy of the matrix
+    closest_indices = pairwise_distances_argmin(
+        kmeans.cluster_centers_.astype(np.float32, copy=False), vectors
+    )
+    return sorted({int(i) for i in closest_indices})
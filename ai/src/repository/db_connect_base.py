@@ -1,34 +1,119 @@
-from repository.base_db import get_db
+from contextlib import contextmanager
+
+import asyncpg
+from psycopg2 import InterfaceError, OperationalError
+
+from repository.base_db import (
+    async_reconnect,
+    async_server_settings,
+    get_async_pool,
+    get_db,
+)
 
 
 class DbConnectBase:
-    _conn = None
+    # Errors of an asyncpg connection closed by the server or the network
+    _ASYNC_CONNECTION_LOST = (
+        asyncpg.PostgresConnectionError,
+        asyncpg.AdminShutdownError,
+        OSError,
+    )
 
-    def _execute(self, sql, args=None):
-        """Below is a wrapper for the normal psycopg2 execute
-        to fix the issue when psycopg2 unable to handle connection
-        disconnected by the server by timeout or other unknown causes:
-        - First check the current connection success.
-        - If not close it and open new connection.
-        - Then proceed to execute the query.
+    @contextmanager
+    def _cursor(self):
+        """Cursor on the connection of the current thread, checked out of the pool
+        for the duration of the block when the thread does not hold one already.
         """
+        db = get_db()
+        opened = db.is_closed()
+        if opened:
+            db.connect()
+
         try:
-            if self._conn is None:
-                self._conn = get_db()
+            with db.cursor() as cursor:
+                yield cursor
+
+        finally:
+            if opened and not db.is_closed():
+                db.close()
+
+    def _with_reconnect(self, fn):
+        """Run `fn` and retry it once on a new connection when the connection was
+        disconnected by the server (timeout, restart, ...). The health of idle
+        connections is checked by the pool, so a query costs a single round trip.
+
+        Other errors (statement timeout, deadlock, serialization failure, ...) leave
+        the connection open and are raised: the statement may not be safe to run twice.
+        """
+        try:
+            return fn()
+
+        except (OperationalError, InterfaceError) as e:
+            # Inside a transaction the earlier statements are lost with the connection.
+            if get_db().in_transaction() or not self._connection_lost(e):
+                raise e
+
+            get_db().reconnect(e)
+            return fn()
+
+    @staticmethod
+    def _connection_lost(error: Exception) -> bool:
+        if isinstance(error, InterfaceError):
+            return True
+
+        cursor = getattr(error, "cursor", None)
+        return cursor is None or cursor.connection.closed != 0
+
+    def _execute(self, sql, args=None):
+        def execute():
+            with self._cursor() as cursor:
+                cursor.execute(sql, args)
+                if cursor is not None and cursor.pgresult_ptr is not None:
+                    return cursor.fetchall()
+
+        return self._with_reconnect(execute)
+
+    def _copy_expert(self, sql, file):
+        """Run a `COPY ... FROM STDIN` reading from the file-like object.
+
+        A COPY is a single statement so the whole load is committed or rolled back at once.
+        """
+
+        def copy_expert():
+            file.seek(0)
+            with self._cursor() as cursor:
+                cursor.copy_expert(sql, file)
+                return cursor.rowcount
+
+        return self._with_reconnect(copy_expert)
+
+    async def _aexecute(self, sql, *args, settings: dict | None = None):
+        """Async version of `_execute` on the asyncpg pool. Query args use `$1, $2, ...`.
+
+        `settings` that differ from the session settings of the pool
+        (`set_async_server_settings`) are set on the connection before the query. The
+        pool resets them when the connection is released. A query whose connection was
+        lost is retried once on another connection.
+        """
+        pool = await get_async_pool()
+        defaults = async_server_settings()
+
+        async def fetch(retry: bool):
+            async with pool.acquire() as conn:
+                try:
+                    for name, value in (settings or {}).items():
+                        if defaults.get(name) != str(int(value)):
+                            await conn.execute(f"SET {name} = {int(value)}")
+
+                    return await conn.fetch(sql, *args)
 
-            with self._conn.cursor() as cursor:
-                # Atempt to connect
-                cursor.execute("SELECT 1 + 1;")
+                except self._ASYNC_CONNECTION_LOST as e:
+                    if not retry:
+                        raise e
 
-        except Exception as e:
-            if self._conn is not None:
-                self._conn.close()
+                    async_reconnect(e)
 
-            self._conn = get_db()
-            print("Reconnected db", e)
-            pass
+            # The closed connection went back to the pool, which replaces it.
+            return await fetch(retry=False)
 
-        with self._conn.cursor() as cursor:
-            cursor.execute(sql, args)
-            if cursor is not None and cursor.pgresult_ptr is not None:
-                return cursor.fetchall()
+        return await fetch(retry=True)
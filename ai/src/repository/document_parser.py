@@ -1,9 +1,48 @@
+import codecs
+import io
+import random
 import re
-from typing import Any, List
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 import trafilatura
 
 import requests
+import tiktoken
 from pydantic import BaseModel
+from pypdf import PdfReader, PdfWriter
+from requests.adapters import HTTPAdapter
+
+from repository.helpers import cprint_warn, get_token_encoding
+from repository.local_parsers import DEFAULT_LOCAL_PARSERS, LocalParser
+
+# Chunk size of `simple_parse`, in tokens of the embedding model
+DEFAULT_CHUNK_TOKENS = 500
+# Tokens of the end of a chunk repeated at the start of the next one
+DEFAULT_OVERLAP_TOKENS = 100
+# Input limit of the embedding model
+MAX_CHUNK_SIZE = 8191
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+# After ". ", "! ", "? " and after the CJK full stops, which are not followed by a space
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])")
+_CHUNK_SEPARATOR = "\n\n"
+# Unstructured element type of the titles
+_TITLE_ELEMENT_TYPE = "Title"
+_CHARSET_PATTERN = re.compile(r"charset=\"?([\w.:-]+)", re.IGNORECASE)
 
 
 class DocumentParseResult(BaseModel):
@@ -11,83 +50,419 @@ class DocumentParseResult(BaseModel):
     metadata: dict
 
 
+class ChunkStrategyEnum(str, Enum):
+    # `chunk_size` characters
+    Characters = "characters"
+    # `chunk_size` tokens of the embedding model
+    Tokens = "tokens"
+    # `chunk_size` tokens, ending at the end of a sentence
+    Sentences = "sentences"
+    # A new chunk at each title, of at most `chunk_size` tokens
+    Headings = "headings"
+
+
+class ChunkingConfig(BaseModel):
+    strategy: ChunkStrategyEnum = ChunkStrategyEnum.Tokens
+    # In characters for the `characters` strategy, in tokens for the others
+    chunk_size: int = DEFAULT_CHUNK_TOKENS
+    # End of a chunk repeated at the start of the next one, in the same unit
+    overlap: int = DEFAULT_OVERLAP_TOKENS
+
+    def check(self):
+        if self.chunk_size <= 0 or self.chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError(f"chunk_size must be in (0, {MAX_CHUNK_SIZE}]")
+
+        if self.overlap < 0 or self.overlap >= self.chunk_size:
+            raise ValueError("overlap must be in [0, chunk_size)")
+
+
+class UnstructuredConfig(BaseModel):
+    """Calls to the Unstructured API.
+
+    - `pages_per_request`: a PDF with more pages is split into page ranges, parsed
+      by concurrent requests.
+    - `concurrency`: maximum requests at the same time, for all documents.
+    - `max_retries`: retries of a request (page range) that failed.
+    """
+
+    pages_per_request: int = 10
+    concurrency: int = 4
+    timeout_seconds: float = 300
+    max_retries: int = 3
+
+
+# Errors of the Unstructured API worth retrying
+_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
 class DocumentParser:
-    def __init__(self, unstructured_endpoint: str, support_types: str):
+    def __init__(
+        self,
+        unstructured_endpoint: str,
+        support_types: str,
+        unstructured_config: Optional[UnstructuredConfig] = None,
+    ):
         self._unstructured_endpoint = unstructured_endpoint
         self._support_types = support_types.split(",")
-        pass
+        self._unstructured_config = unstructured_config or UnstructuredConfig()
+        # Content types parsed in the process instead of by Unstructured
+        self._local_parsers: Dict[str, LocalParser] = dict(DEFAULT_LOCAL_PARSERS)
+
+        # One pool of connections to the Unstructured API, shared by the threads
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self._unstructured_config.concurrency)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._unstructured_executor = ThreadPoolExecutor(
+            max_workers=self._unstructured_config.concurrency
+        )
 
     def check_support_content_type(self, content_type: str):
         return content_type in self._support_types
 
+    def register_local_parser(self, content_type: str, parser: LocalParser):
+        self._local_parsers[content_type] = parser
+
+    def parse_elements(
+        self, document_id: str, file_bytes: bytes, content_type: str
+    ) -> List[Any]:
+        """Elements of the document, from its local parser if its content type has
+        one, from the Unstructured API otherwise."""
+        media_type, _, params = content_type.partition(";")
+        parser = self._local_parsers.get(media_type.strip().lower())
+        if parser is None:
+            return self.call_unstructured_api(document_id, file_bytes, content_type)
+
+        charset_match = _CHARSET_PATTERN.search(params)
+        charset = charset_match.group(1) if charset_match is not None else "utf-8"
+        try:
+            text = file_bytes.decode(charset, errors="replace")
+        except LookupError:
+            text = file_bytes.decode("utf-8", errors="replace")
+
+        return parser(text)
+
     def call_unstructured_api(
         self, document_id: str, file_bytes: bytes, content_type: str
     ) -> List[Any]:
+        """Elements of the document. A PDF is parsed by page ranges in parallel, and
+        the elements are merged in page order."""
         _content_type = content_type.split(";")[0]
+
+        page_ranges: List[Tuple[int, bytes]] = []
+        if _content_type == "application/pdf":
+            page_ranges = self._split_pdf(
+                document_id, file_bytes, self._unstructured_config.pages_per_request
+            )
+
+        if len(page_ranges) <= 1:
+            return self._post_unstructured(document_id, file_bytes, _content_type)
+
+        futures = [
+            self._unstructured_executor.submit(
+                self._post_unstructured,
+                f"{document_id}-{first_page}",
+                range_bytes,
+                _content_type,
+                first_page - 1,
+            )
+            for (first_page, range_bytes) in page_ranges
+        ]
+        elements: List[Any] = []
+        try:
+            for future in futures:
+                elements.extend(future.result())
+        except Exception as e:
+            # A range failed after its retries: do not parse the pending ones
+            for future in futures:
+                future.cancel()
+            raise e
+
+        return elements
+
+    def _split_pdf(
+        self, document_id: str, file_bytes: bytes, pages_per_range: int
+    ) -> List[Tuple[int, bytes]]:
+        """(first page number, PDF bytes) of the ranges of `pages_per_range` pages.
+        Empty if the PDF cannot be read: it is sent whole to Unstructured."""
+        try:
+            reader = PdfReader(io.BytesIO(file_bytes))
+            num_pages = len(reader.pages)
+            if num_pages <= pages_per_range:
+                return []
+
+            page_ranges: List[Tuple[int, bytes]] = []
+            for start in range(0, num_pages, pages_per_range):
+                writer = PdfWriter()
+                for page in reader.pages[start : start + pages_per_range]:
+                    writer.add_page(page)
+
+                buffer = io.BytesIO()
+                writer.write(buffer)
+                page_ranges.append((start + 1, buffer.getvalue()))
+
+            return page_ranges
+
+        except Exception as e:
+            cprint_warn(f"cannot split PDF {document_id}, parsed whole: {e}")
+            return []
+
+    def _post_unstructured(
+        self,
+        document_id: str,
+        file_bytes: bytes,
+        content_type: str,
+        page_offset: int = 0,
+    ) -> List[Any]:
+        """Parse a file, retrying with backoff. `page_offset` is added to the page
+        numbers, for a page range of a document."""
         url = self._unstructured_endpoint + "/general/v0/general"
-        r = requests.post(
-            url,
-            files={"files": (document_id, file_bytes, _content_type)},
-        )
+        config = self._unstructured_config
+        for attempt in range(config.max_retries + 1):
+            try:
+                r = self._session.post(
+                    url,
+                    files={"files": (document_id, file_bytes, content_type)},
+                    timeout=config.timeout_seconds,
+                )
+                if r.status_code in _RETRYABLE_STATUS_CODES:
+                    r.raise_for_status()
+
+                break
+
+            except requests.RequestException as e:
+                if attempt >= config.max_retries:
+                    raise e
+
+                # Exponential backoff with jitter, capped at 60s.
+                backoff = min(60.0, 2.0**attempt) + random.uniform(0, 1)
+                cprint_warn(
+                    f"Unstructured {document_id} retry {attempt + 1}"
+                    f" in {backoff:.1f}s: {e}"
+                )
+                time.sleep(backoff)
+
         try:
-            return r.json()
+            r.raise_for_status()
+            elements = r.json()
         except Exception as e:
             print("Error from Unstructured", e)
             print(r.text)
             raise e
 
+        if page_offset > 0:
+            for element in elements:
+                metadata = element.get("metadata") or {}
+                if metadata.get("page_number") is not None:
+                    metadata["page_number"] = int(metadata["page_number"]) + page_offset
+
+        return elements
+
     def html_to_text(self, html: str):
         return trafilatura.extract(html)
 
     def simple_parse(
-        self, unstructured_docs: List[dict], split_length
+        self,
+        unstructured_docs: Iterable[dict],
+        config: Optional[ChunkingConfig] = None,
     ) -> List[DocumentParseResult]:
-        docs: List[DocumentParseResult] = []
-        for d in unstructured_docs:
-            content = d.get("text", "")
+        return list(self.iter_chunks(unstructured_docs, config))
+
+    def iter_chunks(
+        self,
+        unstructured_docs: Iterable[dict],
+        config: Optional[ChunkingConfig] = None,
+        encoding_name: str = "cl100k_base",
+    ) -> Generator[DocumentParseResult, None, None]:
+        """Stream the Unstructured elements into chunks of about `config.chunk_size`,
+        in one pass: each element is normalized and measured once.
+
+        - A chunk starts with the last `config.overlap` tokens (or characters) of the
+          previous one, except at a title with the `headings` strategy.
+        - A chunk ends at the end of an element (a sentence with the `sentences`
+          strategy). An element larger than a chunk is split.
+        - A last chunk smaller than half a chunk is merged into the previous one.
+        - `page_number` and `section` (the titles above it) are the ones of the
+          first element of the chunk.
+        """
+        _config = config or ChunkingConfig()
+        _config.check()
 
-            content = content.replace("\t", " ")
-            content = re.sub(
-                r"^(?:[\t ]*(?:\r?\n|\r))+", "\\n", content, 0, re.MULTILINE
+        if _config.strategy == ChunkStrategyEnum.Characters:
+            measure: _Measure = _CharacterMeasure()
+        else:
+            measure = _TokenMeasure(get_token_encoding(encoding_name))
+        separator = measure.encode(_CHUNK_SEPARATOR)
+
+        # Current chunk: overlap text, then the texts of its own elements
+        overlap = ""
+        overlap_size = 0
+        parts: List[str] = []
+        parts_size = 0
+        page_number = 0
+        section: Optional[str] = None
+        # The current chunk starts at a title (`headings` strategy)
+        starts_section = False
+        # Last tokens (or characters) of the current chunk, for the overlap
+        tail: Deque = deque(maxlen=_config.overlap)
+        # Held back until the next chunk, to merge a small last chunk into it
+        previous: Optional[DocumentParseResult] = None
+
+        def make_chunk() -> DocumentParseResult:
+            return DocumentParseResult(
+                text=_CHUNK_SEPARATOR.join([overlap] + parts if overlap else parts),
+                metadata={"page_number": page_number, "section": section},
             )
-            content = re.sub(r"\s\s*", " ", content, 0, re.MULTILINE)
-            metadata = d.get("metadata", {})
-            page_number = metadata.get("page_number", 0)
-            metadata = {"page_number": int(page_number)}
-
-            # First element
-            if len(docs) == 0:
-                docs.append(
-                    DocumentParseResult(text=content or "", metadata=metadata or {})
-                )
-                continue
 
-            # Handling next doc condition
-            last_page = docs[-1]
-            if len(last_page.text) > split_length:
-                # Add overlap
-                overlap_words_amount = 100
-                previous_text = ""
-                if len(docs) > 2:
-                    previous_text = " ".join(
-                        docs[-2].text.split()[-overlap_words_amount:]
-                    )
-                next_text = " ".join(content.split()[:overlap_words_amount])
-                docs[-1].text = (
-                    previous_text + "\n\n" + last_page.text + "\n\n" + next_text
-                )
+        for text, element_page_number, is_title, element_section in self._iter_units(
+            unstructured_docs, _config.strategy
+        ):
+            section_start = is_title and _config.strategy == ChunkStrategyEnum.Headings
+            if section_start:
+                tail.clear()
+
+            for piece, symbols in measure.split(
+                text, _config.chunk_size - _config.overlap
+            ):
+                if len(parts) > 0 and (
+                    section_start
+                    or overlap_size + parts_size + len(symbols) > _config.chunk_size
+                ):
+                    if previous is not None:
+                        yield previous
+                    previous = make_chunk()
+
+                    overlap = measure.decode(tail).strip()
+                    overlap_size = len(tail) if overlap else 0
+                    parts = []
+                    parts_size = 0
+                    starts_section = section_start
+
+                if len(parts) == 0:
+                    page_number = element_page_number
+                    section = element_section
+
+                section_start = False
+                parts.append(piece)
+                parts_size += len(separator) + len(symbols)
+                tail.extend(separator)
+                tail.extend(symbols)
+
+        if len(parts) == 0:
+            # No text in the document
+            return
+
+        if (
+            previous is not None
+            and not starts_section
+            and parts_size < _config.chunk_size / 2
+        ):
+            # The overlap of the last chunk is already the end of the previous one
+            previous.text = _CHUNK_SEPARATOR.join([previous.text] + parts)
+            yield previous
+            return
 
-                # Add new chunk
-                docs.append(DocumentParseResult(text=content, metadata=metadata))
+        if previous is not None:
+            yield previous
+        yield make_chunk()
 
+    def _iter_units(
+        self, unstructured_docs: Iterable[dict], strategy: ChunkStrategyEnum
+    ) -> Generator[Tuple[str, int, bool, Optional[str]], None, None]:
+        """(text, page_number, is_title, section) of the non-empty elements, or of
+        their sentences with the `sentences` strategy. The section is set by the
+        local parsers; for Unstructured it is the last title."""
+        last_title: Optional[str] = None
+        for d in unstructured_docs:
+            content = _WHITESPACE_PATTERN.sub(" ", d.get("text") or "").strip()
+            if content == "":
+                continue
+
+            metadata = d.get("metadata") or {}
+            page_number = int(metadata.get("page_number") or 0)
+            is_title = d.get("type") == _TITLE_ELEMENT_TYPE
+            if is_title:
+                last_title = content
+            section = metadata.get("section") or last_title
+
+            if strategy != ChunkStrategyEnum.Sentences:
+                yield content, page_number, is_title, section
                 continue
 
-            # Just add content to text
-            docs[-1].text += "\n\n" + content
+            for sentence in _SENTENCE_END_PATTERN.split(content):
+                if sentence != "":
+                    yield sentence, page_number, is_title, section
+
+
+class _Measure(ABC):
+    """Size of the texts in a chunking strategy: texts are encoded into sequences
+    of symbols (tokens or characters), the size of a text is its number of symbols."""
+
+    @abstractmethod
+    def encode(self, text: str) -> Sequence:
+        ...
+
+    @abstractmethod
+    def decode(self, symbols: Iterable) -> str:
+        ...
+
+    @abstractmethod
+    def split(
+        self, text: str, max_size: int
+    ) -> Generator[Tuple[str, Sequence], None, None]:
+        """(text, symbols) of `text`, split into pieces of at most `max_size`."""
+
+
+class _CharacterMeasure(_Measure):
+    def encode(self, text: str) -> Sequence:
+        return text
+
+    def decode(self, symbols: Iterable) -> str:
+        return "".join(symbols)
+
+    def split(
+        self, text: str, max_size: int
+    ) -> Generator[Tuple[str, Sequence], None, None]:
+        for i in range(0, len(text), max_size):
+            piece = text[i : i + max_size]
+            yield piece, piece
+
+
+class _TokenMeasure(_Measure):
+    def __init__(self, encoding: tiktoken.Encoding):
+        self._encoding = encoding
+
+    def encode(self, text: str) -> Sequence:
+        return self._encoding.encode_ordinary(text)
+
+    def decode(self, symbols: Iterable) -> str:
+        return _decode_tokens(self._encoding, symbols)
+
+    def split(
+        self, text: str, max_size: int
+    ) -> Generator[Tuple[str, Sequence], None, None]:
+        return _split_tokens(self._encoding, text, max_size)
+
+
+def _decode_tokens(encoding: tiktoken.Encoding, tokens: Iterable[int]) -> str:
+    # A token slice can start in the middle of a UTF-8 character: drop its bytes
+    return encoding.decode_bytes(list(tokens)).decode("utf-8", errors="ignore")
+
 
-        # Handle when last doc has small length, We will add it to the previous doc
-        if len(docs) > 2 and len(docs[-1].text) < split_length / 2:
-            docs[-2].text += docs[-1].text
-            docs = docs[:-2]
+def _split_tokens(
+    encoding: tiktoken.Encoding, text: str, max_tokens: int
+) -> Generator[Tuple[str, List[int]], None, None]:
+    """(text, tokens) of `text`, split into pieces of at most `max_tokens` tokens.
+    The bytes of a character split between two pieces go to the second one."""
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        yield text, tokens
+        return
 
-        return docs
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for i in range(0, len(tokens), max_tokens):
+        piece_tokens = tokens[i : i + max_tokens]
+        last = i + max_tokens >= len(tokens)
+        piece = decoder.decode(encoding.decode_bytes(piece_tokens), final=last)
+        if piece != "":
+            yield piece, piece_tokens
@@ -1,33 +1,54 @@
+import hashlib
 import json
-import multiprocessing
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
-from typing import BinaryIO, List, Tuple
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
 from uuid import uuid4
 
 import numpy as np
 import yaml
 from fastapi import HTTPException, status
-from peewee import CharField, DateTimeField, IntegerField, TextField
+from langchain.schema import BaseMessage
+from minio.datatypes import Object
+from minio.helpers import MIN_PART_SIZE
+from peewee import SQL, CharField, DateTimeField, IntegerField, TextField
 from pydantic import BaseModel
-from sklearn.cluster import KMeans
 from systems.base_ai_ystem import BaseAISystem
 
 from repository.base_db import (
     BaseDBModel,
     VectorField,
+    add_missing_columns,
     from_datetime,
     from_int,
     from_str,
     get_db,
 )
 from repository.db_connect_base import DbConnectBase
+from repository.chunking_config_repo import ChunkingConfigRepo
+from repository.clustering import SummaryClusteringConfig, get_representative_indices
 from repository.document_parser import DocumentParser
-from repository.helpers import cprint_cyan, cprint_green, get_timestamp, messages_to_str
-from repository.llm_facade import ChatModelEnum, LLMFacade
+from repository.helpers import (
+    HashingReader,
+    cprint_cyan,
+    cprint_green,
+    get_timestamp,
+    get_token_encoding,
+    messages_to_str,
+    num_tokens_from_messages,
+    truncate_to_tokens,
+)
+from repository.llm_facade import CHAT_CONTEXT_TOKENS, ChatModelEnum, LLMFacade
 from repository.storage_facade import StorageFacade
-from repository.vector_store_repo import VectorMetadata, VectorStoreRepo
+from repository.vector_store_repo import (
+    VectorMetadata,
+    VectorStatusEnum,
+    VectorStoreRepo,
+    make_fingerprint,
+)
 
 
 class DocumentDB(BaseDBModel):
@@ -43,6 +64,13 @@ class DocumentDB(BaseDBModel):
     process_status = CharField()
     visibility = CharField()
     metadata = TextField()
+    content_hash = CharField(null=True, index=True)
+    # Key of the file in the storage. None for the documents stored by doc_id.
+    object_name = CharField(null=True, index=True)
+    # Fingerprint of the chunks the summary was made from
+    summary_fingerprint = CharField(null=True)
+    # JSON of the chunking config the vectors were made with
+    chunking_config = TextField(null=True)
 
 
 class DocumentProcessStatusEnum(Enum):
@@ -82,6 +110,8 @@ class Document(BaseModel):
     process_status: DocumentProcessStatusEnum
     visibility: DocumentVisibilityEnum
     metadata: DocumentMetadata
+    content_hash: str | None = None
+    object_name: str | None = None
 
     def to_db(self) -> DocumentDB:
         if self.metadata is None:
@@ -101,6 +131,8 @@ class Document(BaseModel):
             process_status=self.process_status.value,
             visibility=self.visibility.value,
             metadata=metadata,
+            content_hash=self.content_hash,
+            object_name=self.object_name,
         )
 
     @staticmethod
@@ -119,44 +151,62 @@ class Document(BaseModel):
             metadata=DocumentMetadata.parse_obj(
                 json.loads(from_str(db_document.metadata))
             ),
+            content_hash=db_document.content_hash,
+            object_name=db_document.object_name,
         )
 
 
-def get_closest_indices(vectors: List[List[float]], num_clusters: int, kmeans: KMeans):
-    closest_indices: List[int] = []
-
-    # Loop through the number of clusters you have
-    for i in range(num_clusters):
-        # Get the list of distances from that particular cluster center
-        distances = np.linalg.norm(vectors - kmeans.cluster_centers_[i], axis=1)
-
-        # Find the list position of the closest one (using argmin to find the smallest distance)
-        closest_index = np.argmin(distances)
+class ChunkDiff(BaseModel):
+    """Chunks of a document compared with its stored vectors.
 
-        # Append that position to your closest indices list
-        closest_indices.append(int(closest_index))
+    - `fingerprints`: fingerprint of each chunk.
+    - `new_indices`: chunks without a stored vector.
+    - `kept_ids`: index of chunk -> id of its stored vector.
+    - `vanished_ids`: stored vectors without a chunk.
+    """
 
-    return closest_indices
+    fingerprints: List[str]
+    new_indices: List[int]
+    kept_ids: dict[int, str]
+    vanished_ids: List[str]
 
 
 class DocumentRepo(DbConnectBase):
     _EMBEDDING_NAMESPACE = "document"
-    _CHUNK_SIZE = 1000
-    _CHUNK_OVERLAP = 200
     _BUCKET_NAME = "document"
 
     MAX_PART_SIZE = 30 * 1024 * 1024
     MAX_SIZE_TEXT = "30MB"
+    # Part buffer of MinIO when the size of the upload is unknown (minimum allowed)
+    UNKNOWN_SIZE_PART_SIZE = MIN_PART_SIZE
+    # Files are stored once per content, under the sha256 of the content
+    BLOB_PREFIX = "blobs/sha256/"
+    # Files being uploaded, before they are copied to their blob
+    UPLOAD_PREFIX = "uploads/"
+    # Answer of a SummaryAll request, the summaries fill the rest of the context
+    _SUMMARY_ALL_ANSWER_TOKENS = 1024
+    _SUMMARY_SEPARATOR = "\n---\n"
 
     def __init__(
         self,
         llm: LLMFacade,
         document_parser: DocumentParser,
+        chunking_config_repo: ChunkingConfigRepo,
         vector_store_repo: VectorStoreRepo,
         storage_facade: StorageFacade,
+        summary_concurrency: int = 5,
+        summary_timeout_seconds: float = 120,
+        summary_clustering_config: Optional[SummaryClusteringConfig] = None,
     ):
         self._llm = llm
+        self._summary_clustering_config = (
+            summary_clustering_config or SummaryClusteringConfig()
+        )
+        self._summary_concurrency = summary_concurrency
+        self._vector_gc_executor = ThreadPoolExecutor(max_workers=1)
+        self._summary_timeout_seconds = summary_timeout_seconds
         self._document_parser = document_parser
+        self._chunking_config_repo = chunking_config_repo
         self._vector_store_repo = vector_store_repo
         self._storage_facade = storage_facade
 
@@ -184,6 +234,34 @@ class DocumentRepo(DbConnectBase):
 
         return [Document.from_db(i) for i in items]
 
+    async def aget_docs_or_raise_not_found(self, ids: List[str]) -> List[Document]:
+        """Async version of `get_docs_or_raise_not_found`."""
+        query_str = f"""
+        SELECT
+            namespace,
+            doc_id,
+            filename,
+            content_type,
+            bytesize,
+            upload_by,
+            upload_at,
+            summary,
+            process_status,
+            visibility,
+            metadata,
+            content_hash,
+            object_name
+        FROM {DocumentDB._meta.table_name}
+        WHERE doc_id = ANY($1)
+        """
+        results = await self._aexecute(query_str, ids)
+        if len(results) == 0:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="not found document"
+            )
+
+        return [Document.from_db(DocumentDB(**dict(r))) for r in results]
+
     def create(
         self,
         namespace: str,
@@ -195,32 +273,171 @@ class DocumentRepo(DbConnectBase):
         visibility: DocumentVisibilityEnum,
         metadata: DocumentMetadata,
     ):
+        """Upload `blob` and create the document. `bytesize` is the length of the blob
+        (-1 when unknown)."""
         doc_id = str(uuid4())
+
+        def save(object_name: str, content_hash: str, bytesize: int):
+            Document(
+                namespace=namespace,
+                doc_id=doc_id,
+                filename=filename,
+                content_type=content_type,
+                bytesize=bytesize,
+                upload_by=upload_by,
+                upload_at=get_timestamp(),
+                summary="",
+                process_status=DocumentProcessStatusEnum.Uploaded,
+                visibility=visibility,
+                metadata=metadata,
+                content_hash=content_hash,
+                object_name=object_name,
+            ).to_db().save()
+
+        self._store_blob(content_type, blob, bytesize, save)
+        return doc_id
+
+    def replace_content(
+        self,
+        doc_id: str,
+        filename: str,
+        content_type: str,
+        blob: BinaryIO,
+        bytesize: int,
+        metadata: DocumentMetadata,
+    ):
+        """Upload a new version of the file of a document. The vectors and the summary
+        are kept until the document is processed again, which only updates the chunks
+        that changed."""
+        item = self.get_doc_or_not_found(doc_id)
+        previous_object_name = self._get_object_name(item)
+
+        def save(object_name: str, content_hash: str, bytesize: int):
+            DocumentDB.update(
+                {
+                    DocumentDB.filename: filename,
+                    DocumentDB.content_type: content_type,
+                    DocumentDB.bytesize: bytesize,
+                    DocumentDB.metadata: metadata.json(),
+                    DocumentDB.content_hash: content_hash,
+                    DocumentDB.object_name: object_name,
+                    DocumentDB.process_status: DocumentProcessStatusEnum.Uploaded.value,
+                }
+            ).where(DocumentDB.doc_id == doc_id).execute()
+
+        object_name = self._store_blob(content_type, blob, bytesize, save)
+        if object_name != previous_object_name:
+            self._delete_blob_if_unused(previous_object_name)
+
+    def find_document_by_source(
+        self,
+        namespace: str,
+        upload_by: str,
+        source_type: DocumentSourceTypeEnum,
+        source_link: str,
+    ) -> DocumentDB | None:
+        return (
+            DocumentDB.select()
+            .where(
+                (DocumentDB.namespace == namespace)
+                & (DocumentDB.upload_by == upload_by)
+                & SQL("metadata::jsonb ->> 'source_type' = %s", (source_type.value,))
+                & SQL("metadata::jsonb ->> 'source_link' = %s", (source_link,))
+            )
+            .order_by(DocumentDB.upload_at.desc())
+            .first()
+        )
+
+    @contextmanager
+    def _lock_blob(self, object_name: str):
+        """Transaction holding a lock on a shared blob. The check that a blob exists
+        and the write of the row that uses it, or the check that no row uses it and its
+        deletion, run under the lock: a blob is not deleted while being reused."""
+        with get_db().connection_context(), get_db().atomic():
+            self._execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (object_name,))
+            yield
+
+    def _store_blob(
+        self,
+        content_type: str,
+        blob: BinaryIO,
+        bytesize: int,
+        save: Callable[[str, str, int], None],
+    ) -> str:
+        """Upload the file of a document, then `save(object_name, sha256, size)` the
+        document row. Returns the object name.
+
+        The file is hashed while it is uploaded under a temporary name, then copied
+        to `BLOB_PREFIX` + hash, so identical files are stored once (no copy when the
+        blob exists). Only the copy and the save run under the lock of the blob, not
+        the upload.
+        """
+        upload_name = self.UPLOAD_PREFIX + uuid4().hex
+        reader = HashingReader(blob)
         self._storage_facade.upload(
-            object_name=doc_id,
+            object_name=upload_name,
             content_type=content_type,
-            part_size=self.MAX_PART_SIZE,
-            blob=blob,
+            blob=reader,
+            length=bytesize,
+            part_size=0 if bytesize >= 0 else self.UNKNOWN_SIZE_PART_SIZE,
             metadata=None,
         )
-        item = Document(
-            namespace=namespace,
-            doc_id=doc_id,
-            filename=filename,
-            content_type=content_type,
-            bytesize=bytesize,
-            upload_by=upload_by,
-            upload_at=get_timestamp(),
-            summary="",
-            process_status=DocumentProcessStatusEnum.Uploaded,
-            visibility=visibility,
-            metadata=metadata,
+        object_name = self.BLOB_PREFIX + reader.hexdigest()
+        try:
+            with self._lock_blob(object_name):
+                created = self._storage_facade.stat(object_name) is None
+                if created:
+                    self._storage_facade.copy(upload_name, object_name)
+                else:
+                    cprint_cyan(f"Reuse stored blob {object_name}")
+
+                try:
+                    save(object_name, reader.hexdigest(), reader.bytes_read)
+                except Exception:
+                    if created:
+                        self._storage_facade.delete(object_name)
+                    raise
+
+        finally:
+            self._storage_facade.delete(upload_name)
+
+        return object_name
+
+    def _delete_blob_if_unused(self, object_name: str):
+        # A blob is shared by the documents with the same content
+        with self._lock_blob(object_name):
+            in_use = DocumentDB.select().where(
+                (DocumentDB.object_name == object_name)
+                | (
+                    (DocumentDB.object_name.is_null())
+                    & (DocumentDB.doc_id == object_name)
+                )
+            )
+            if not in_use.exists():
+                self._storage_facade.delete(object_name)
+
+    def _get_object_name(self, doc: Document | DocumentDB) -> str:
+        return doc.object_name or doc.doc_id
+
+    def stat_file_or_not_found(self, doc: Document | DocumentDB) -> Object:
+        stat = self._storage_facade.stat(self._get_object_name(doc))
+        if stat is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="not found document file",
+            )
+
+        return stat
+
+    def stream_file(
+        self, doc: Document | DocumentDB, offset: int = 0, length: int = 0
+    ) -> Iterator[bytes]:
+        return self._storage_facade.stream(
+            self._get_object_name(doc), offset=offset, length=length
         )
-        item.to_db().save()
-        return doc_id
 
-    def get_file_or_not_found(self, doc_id: str):
-        blob = self._storage_facade.get(doc_id)
+    def get_file_or_not_found(self, doc: Document | DocumentDB):
+        blob = self._storage_facade.get(self._get_object_name(doc))
         if blob is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -229,33 +446,81 @@ class DocumentRepo(DbConnectBase):
 
         return blob
 
-    def _get_document_embbedings(self, doc_results: List[str]) -> List[List[float]]:
-        doc_embeddings: List[List[float]] = []
-        with multiprocessing.Pool(processes=5) as pool:
-            workers = [
-                pool.apply_async(self._llm.openai_embeddings, (doc,))
-                for doc in doc_results
-            ]
-            for result in workers:
-                doc_embeddings.append(result.get())
+    def reuse_processed_content(self, doc_id: str) -> bool:
+        """Copy the vectors and the summary of an already processed document with the
+        same content into `doc_id`, so identical uploads skip parsing, embeddings and
+        summaries. The source must have been chunked with the chunking config of the
+        namespace of `doc_id`. Returns False when there is no such document.
+        """
+        item = self.get_doc_or_not_found(id=doc_id)
+        if item.content_hash is None:
+            return False
+
+        chunking_config = self._chunking_config_repo.get_config(item.namespace)
+        source = (
+            DocumentDB.select()
+            .where(
+                (DocumentDB.content_hash == item.content_hash)
+                & (DocumentDB.content_type == item.content_type)
+                & (DocumentDB.chunking_config == chunking_config.json())
+                & (
+                    DocumentDB.process_status
+                    == DocumentProcessStatusEnum.Processed.value
+                )
+                & (DocumentDB.doc_id != item.doc_id)
+            )
+            .order_by(DocumentDB.upload_at.desc())
+            .first()
+        )
+        if source is None:
+            return False
+
+        cprint_cyan(f"Reuse processed content of {source.doc_id} for {doc_id}")
+        generation = self._vector_store_repo.next_generation(
+            item.namespace, item.doc_id
+        )
+        self._vector_store_repo.copy_document_vectors(
+            source_namespace=source.namespace,
+            source_document=source.doc_id,
+            namespace=item.namespace,
+            document=item.doc_id,
+            generation=generation,
+            status=VectorStatusEnum.Inactive,
+        )
+        self._swap_vector_generation(item.namespace, item.doc_id, generation)
+        self._execute(
+            f"""
+            UPDATE {DocumentDB._meta.table_name} AS d
+            SET
+                summary = s.summary,
+                summary_vector = s.summary_vector,
+                chunking_config = s.chunking_config,
+                process_status = %s
+            FROM {DocumentDB._meta.table_name} AS s
+            WHERE d.doc_id = %s AND s.doc_id = %s
+            """,
+            (DocumentProcessStatusEnum.Processed.value, item.doc_id, source.doc_id),
+        )
+        return True
 
-        return doc_embeddings
+    def _get_document_embbedings(self, doc_results: List[str]) -> List[List[float]]:
+        return self._llm.embed_documents(doc_results)
 
     def _get_document_cluster_for_summary(
-        self, doc_embeddings: List[List[float]], num_clusters: int = 5
-    ):
-        _num_clusters = min(len(doc_embeddings), num_clusters)
-        kmeans = KMeans(n_clusters=_num_clusters, random_state=42, n_init="auto").fit(
-            doc_embeddings
+        self, doc_embeddings: np.ndarray
+    ) -> List[int]:
+        return get_representative_indices(
+            doc_embeddings, self._summary_clustering_config
         )
-        closest_indices = get_closest_indices(doc_embeddings, _num_clusters, kmeans)
-        closest_indices = sorted(closest_indices)
-        return closest_indices
 
     def _get_summary_of_text(self, text: str):
         messages = self._summary_prompt.format_prompt(text=text).to_messages()
         cprint_cyan(messages_to_str(messages))
-        chat = self._llm.create_chat(model=ChatModelEnum.Chat_3_5, temperature=0.1)
+        chat = self._llm.create_chat(
+            model=ChatModelEnum.Chat_3_5,
+            temperature=0.1,
+            request_timeout=self._summary_timeout_seconds,
+        )
         summary = chat(messages=messages).content
         cprint_green(">" * 80)
         cprint_green(summary)
@@ -263,32 +528,169 @@ class DocumentRepo(DbConnectBase):
 
         return summary
 
-    def _get_combined_summary(self, texts: List[str]):
-        combined_summary_list = "\n---\n".join(texts)
-        messages = self._summary_all_prompt.format_prompt(
-            text=combined_summary_list
+    def _format_summary_all_messages(self, summaries: List[str]) -> List[BaseMessage]:
+        return self._summary_all_prompt.format_prompt(
+            text=self._SUMMARY_SEPARATOR.join(summaries)
         ).to_messages()
+
+    def _get_summary_of_summaries(self, summaries: List[str]) -> str:
+        messages = self._format_summary_all_messages(summaries)
         cprint_cyan(messages_to_str(messages))
-        chat = self._llm.create_chat(model=ChatModelEnum.Chat_3_5, temperature=0.1)
+        chat = self._llm.create_chat(
+            model=ChatModelEnum.Chat_3_5,
+            temperature=0.1,
+            request_timeout=self._summary_timeout_seconds,
+            max_tokens=self._SUMMARY_ALL_ANSWER_TOKENS,
+        )
         summary_all = chat(messages=messages).content
         cprint_cyan(summary_all)
 
         return summary_all
 
+    def _group_summaries(self, summaries: List[str], budget: int) -> List[List[str]]:
+        """Consecutive summaries grouped so that each group, joined, fits in
+        `budget` tokens."""
+        encoding = get_token_encoding()
+        separator_size = len(encoding.encode_ordinary(self._SUMMARY_SEPARATOR))
+        groups: List[List[str]] = []
+        group_size = 0
+        for summary in summaries:
+            size = len(encoding.encode_ordinary(summary))
+            if len(groups) > 0 and group_size + separator_size + size <= budget:
+                groups[-1].append(summary)
+                group_size += separator_size + size
+            else:
+                groups.append([summary])
+                group_size = size
+
+        return groups
+
+    def _get_combined_summary(self, texts: List[str]) -> str:
+        """Reduce step: the summaries are consolidated by one `SummaryAll` request
+        when they fit in the context of the chat model next to its answer. Otherwise
+        groups of them that fit are consolidated first, level by level.
+
+        A summary is cut to half of the budget, so that every group but the last one
+        holds two summaries at least and each level has fewer of them."""
+        budget = (
+            CHAT_CONTEXT_TOKENS[ChatModelEnum.Chat_3_5]
+            - self._SUMMARY_ALL_ANSWER_TOKENS
+            - num_tokens_from_messages(self._format_summary_all_messages([]))
+        )
+        separator_size = len(
+            get_token_encoding().encode_ordinary(self._SUMMARY_SEPARATOR)
+        )
+        max_summary_tokens = (budget - separator_size) // 2
+
+        def reduce(group: List[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            return self._get_summary_of_summaries(group)
+
+        summaries = [truncate_to_tokens(t, max_summary_tokens) for t in texts]
+        groups = self._group_summaries(summaries, budget)
+        while len(groups) > 1:
+            max_workers = max(1, min(self._summary_concurrency, len(groups)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                summaries = list(executor.map(reduce, groups))
+
+            summaries = [truncate_to_tokens(t, max_summary_tokens) for t in summaries]
+            groups = self._group_summaries(summaries, budget)
+
+        return self._get_summary_of_summaries(groups[0])
+
     def summary_texts(self, texts: List[str]) -> Tuple[str, List[float]]:
-        summaries: List[str] = []
-        for text in texts:
-            summary = self._get_summary_of_text(text)
-            summaries.append(summary)
+        # Map step: summaries of the cluster representatives are independent requests.
+        max_workers = max(1, min(self._summary_concurrency, len(texts)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            summaries: List[str] = list(executor.map(self._get_summary_of_text, texts))
 
         summary_all = self._get_combined_summary(summaries)
         summary_vector = self._llm.openai_embeddings(summary_all)
 
         return summary_all, summary_vector
 
-    def process_vector_and_summary(self, doc_id: str):
-        data = self.get_file_or_not_found(doc_id)
+    def _diff_chunks(
+        self, namespace: str, doc_id: str, metadatas: List[VectorMetadata]
+    ) -> ChunkDiff:
+        """Match the chunks with the stored vectors of the document by fingerprint."""
+        fingerprints = [make_fingerprint(m) for m in metadatas]
+
+        stored: dict[str, List[str]] = {}
+        vanished_ids: List[str] = []
+        for vector_id, fingerprint in self._vector_store_repo.get_document_fingerprints(
+            namespace, doc_id
+        ):
+            if fingerprint is None:
+                vanished_ids.append(vector_id)
+            else:
+                stored.setdefault(fingerprint, []).append(vector_id)
+
+        new_indices: List[int] = []
+        kept_ids: dict[int, str] = {}
+        for i, fingerprint in enumerate(fingerprints):
+            vector_ids = stored.get(fingerprint)
+            if vector_ids:
+                kept_ids[i] = vector_ids.pop()
+            else:
+                new_indices.append(i)
+
+        for vector_ids in stored.values():
+            vanished_ids.extend(vector_ids)
+
+        return ChunkDiff(
+            fingerprints=fingerprints,
+            new_indices=new_indices,
+            kept_ids=kept_ids,
+            vanished_ids=vanished_ids,
+        )
+
+    def _get_chunk_embeddings(
+        self, metadatas: List[VectorMetadata], chunk_diff: ChunkDiff
+    ) -> np.ndarray:
+        """Embeddings of all the chunks, as a float32 matrix: only the new chunks
+        are embedded, the others are read from the vector store."""
+        new_embeddings = self._get_document_embbedings(
+            [metadatas[i].content for i in chunk_diff.new_indices]
+        )
+        stored_vectors = self._vector_store_repo.get_vectors_by_ids(
+            list(chunk_diff.kept_ids.values())
+        )
+
+        dimensions = len(new_embeddings[0]) if len(new_embeddings) > 0 else 0
+        if len(stored_vectors) > 0:
+            dimensions = len(next(iter(stored_vectors.values())))
+
+        embeddings = np.empty((len(metadatas), dimensions), dtype=np.float32)
+        for i, embedding in zip(chunk_diff.new_indices, new_embeddings):
+            embeddings[i] = embedding
+        for i, vector_id in chunk_diff.kept_ids.items():
+            embeddings[i] = stored_vectors[vector_id]
+
+        return embeddings
+
+    def _swap_vector_generation(self, namespace: str, doc_id: str, generation: int):
+        """Activate the vectors of `generation` and delete the previous ones in the
+        background."""
+        self._vector_store_repo.activate_generation(namespace, doc_id, generation)
+
+        def delete_old_generations():
+            try:
+                self._vector_store_repo.delete_old_generations(
+                    namespace, doc_id, generation
+                )
+            except Exception as e:
+                print(f">>> ERR delete old vectors doc_id={doc_id}", e)
+
+        self._vector_gc_executor.submit(delete_old_generations)
+
+    def process_vector_and_summary(self, doc_id: str) -> DocumentProcessStatusEnum:
+        # The same content may have been processed since the upload
+        if self.reuse_processed_content(doc_id):
+            return DocumentProcessStatusEnum.Processed
+
         item = self.get_doc_or_not_found(id=doc_id)
+        data = self.get_file_or_not_found(item)
 
         process_status: DocumentProcessStatusEnum = DocumentProcessStatusEnum.Processing
 
@@ -301,54 +703,79 @@ class DocumentRepo(DbConnectBase):
 
         summary_all = ""
         summary_vector: List[float] = []
+        summary_fingerprint: str | None = None
+        chunking_config_str: str | None = item.chunking_config
 
         try:
-            if item.content_type in ["text/markdown", "text/plain"]:
-                unstructured_docs = [
-                    {"text": t} for t in data.decode("utf-8").split("\n")
-                ]
-                doc_results = self._document_parser.simple_parse(
-                    unstructured_docs, split_length=2000
-                )
-            else:
-                unstructured_docs = self._document_parser.call_unstructured_api(
-                    document_id=item.doc_id,
-                    file_bytes=data,
-                    content_type=item.content_type,
-                )
-                doc_results = self._document_parser.simple_parse(
-                    unstructured_docs, split_length=2000
+            chunking_config = self._chunking_config_repo.get_config(item.namespace)
+            unstructured_docs = self._document_parser.parse_elements(
+                document_id=item.doc_id,
+                file_bytes=data,
+                content_type=item.content_type,
+            )
+            doc_results = self._document_parser.simple_parse(
+                unstructured_docs, chunking_config
+            )
+
+            metadatas = [
+                VectorMetadata(
+                    content=d.text,
+                    page_number=d.metadata.get("page_number", 0),
+                    section=d.metadata.get("section"),
                 )
+                for d in doc_results
+            ]
+            chunk_diff = self._diff_chunks(item.namespace, item.doc_id, metadatas)
 
-            doc_embeddings = self._get_document_embbedings(
-                list(map(lambda d: d.text, doc_results))
-            )
+            doc_embeddings = self._get_chunk_embeddings(metadatas, chunk_diff)
 
             cluster_indices = self._get_document_cluster_for_summary(doc_embeddings)
+            summary_fingerprint = hashlib.sha256(
+                "\n".join(chunk_diff.fingerprints[i] for i in cluster_indices).encode()
+            ).hexdigest()
+
+            if (
+                summary_fingerprint == item.summary_fingerprint
+                and item.summary
+                and item.summary_vector is not None
+            ):
+                cprint_cyan(f"Summary of {doc_id} is unchanged")
+                summary_all, summary_vector = item.summary, item.summary_vector
+            else:
+                summary_all, summary_vector = self.summary_texts(
+                    [doc_results[i].text for i in cluster_indices]
+                )
 
-            summary_all, summary_vector = self.summary_texts(
-                [doc_results[i].text for i in cluster_indices]
-            )
-
-            # Clean up existing vectors for idempotent processing.
-            self._vector_store_repo.delete_vectors_in_document(
-                item.namespace, item.doc_id
+            cprint_cyan(
+                f"Chunks of {doc_id}: {len(chunk_diff.new_indices)} new,"
+                f" {len(chunk_diff.vanished_ids)} deleted, {len(metadatas)} total"
             )
+            if len(chunk_diff.new_indices) > 0 or len(chunk_diff.vanished_ids) > 0:
+                # Build the new generation next to the active one: the unchanged
+                # vectors are copied inside the database, the new chunks are inserted.
+                generation = self._vector_store_repo.next_generation(
+                    item.namespace, item.doc_id
+                )
+                self._vector_store_repo.copy_document_vectors(
+                    source_namespace=item.namespace,
+                    source_document=item.doc_id,
+                    namespace=item.namespace,
+                    document=item.doc_id,
+                    vector_ids=list(chunk_diff.kept_ids.values()),
+                    generation=generation,
+                    status=VectorStatusEnum.Inactive,
+                )
+                self._vector_store_repo.insert_vectors(
+                    namespace=item.namespace,
+                    document=item.doc_id,
+                    vectors=[doc_embeddings[i] for i in chunk_diff.new_indices],
+                    metadatas=[metadatas[i] for i in chunk_diff.new_indices],
+                    generation=generation,
+                    status=VectorStatusEnum.Inactive,
+                )
+                self._swap_vector_generation(item.namespace, item.doc_id, generation)
 
-            self._vector_store_repo.insert_vectors(
-                namespace=item.namespace,
-                document=item.doc_id,
-                vectors=doc_embeddings,
-                metadatas=list(
-                    map(
-                        lambda d: VectorMetadata(
-                            content=d.text,
-                            page_number=d.metadata.get("page_number", 0),
-                        ),
-                        doc_results,
-                    )
-                ),
-            )
+            chunking_config_str = chunking_config.json()
             process_status = DocumentProcessStatusEnum.Processed
 
         except Exception as e:
@@ -364,13 +791,17 @@ class DocumentRepo(DbConnectBase):
                     DocumentDB.summary_vector: summary_vector
                     if len(summary_vector) > 0
                     else None,
+                    DocumentDB.summary_fingerprint: summary_fingerprint,
+                    DocumentDB.chunking_config: chunking_config_str,
                 }
             ).where(DocumentDB.doc_id == doc_id).execute()
 
+        return process_status
+
     def delete_document(self, doc: Document):
-        self._storage_facade.delete(doc.doc_id)
         self._vector_store_repo.delete_vectors_in_document(doc.namespace, doc.doc_id)
         DocumentDB.delete().where(DocumentDB.doc_id == doc.doc_id).execute()
+        self._delete_blob_if_unused(self._get_object_name(doc))
 
     def set_visibility(self, document: Document, visibility: DocumentVisibilityEnum):
         document.to_db().update(
@@ -478,3 +909,4 @@ class DocumentRepo(DbConnectBase):
 
 # Create table if not exists
 get_db().create_tables([DocumentDB])
+add_missing_columns(DocumentDB)
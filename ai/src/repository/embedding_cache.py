@@ -0,0 +1,142 @@
+import hashlib
+from array import array
+from typing import List, Optional
+
+from peewee import CharField, DateTimeField
+
+from repository.base_db import BaseDBModel, VectorField, get_async_pool, get_db
+from repository.helpers import LRUCache, get_timestamp
+
+
+class EmbeddingCacheDB(BaseDBModel):
+    key = CharField(unique=True)
+    model = CharField()
+    vector = VectorField(length=1536)
+    create_at = DateTimeField()
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+_TABLE_NAME = EmbeddingCacheDB._meta.table_name
+
+
+class EmbeddingCache:
+    """Embeddings keyed by sha256 of model + text.
+
+    An in-process LRU sits in front of the `EmbeddingCacheDB` table, so a repeated text
+    costs neither an API call nor, most of the time, a database round trip.
+    Vectors are kept as float32 `array` in memory (~6KB per 1536-dim embedding).
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._lru: LRUCache[array] = LRUCache(maxsize)
+
+    def _get_many_from_lru(
+        self, keys: List[str]
+    ) -> tuple[List[Optional[List[float]]], List[str]]:
+        results: List[Optional[List[float]]] = [None] * len(keys)
+        missing_keys: List[str] = []
+        for i, key in enumerate(keys):
+            cached = self._lru.get(key)
+            if cached is not None:
+                results[i] = cached.tolist()
+            else:
+                missing_keys.append(key)
+
+        return results, list(set(missing_keys))
+
+    def _fill_from_db(
+        self, keys: List[str], results: List[Optional[List[float]]], rows: List[tuple]
+    ):
+        found = {}
+        for key, db_vector in rows:
+            vector = array("f", db_vector)
+            self._lru.set(key, vector)
+            found[key] = vector
+
+        for i, key in enumerate(keys):
+            if results[i] is None and key in found:
+                results[i] = found[key].tolist()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [embedding_cache_key(model, t) for t in texts]
+        results, missing_keys = self._get_many_from_lru(keys)
+        if len(missing_keys) == 0:
+            return results
+
+        items = EmbeddingCacheDB.select(
+            EmbeddingCacheDB.key, EmbeddingCacheDB.vector
+        ).where(EmbeddingCacheDB.key.in_(missing_keys))
+
+        self._fill_from_db(keys, results, [(i.key, i.vector) for i in items])
+        return results
+
+    async def aget_many(
+        self, model: str, texts: List[str]
+    ) -> List[Optional[List[float]]]:
+        """Async version of `get_many` on the asyncpg pool."""
+        keys = [embedding_cache_key(model, t) for t in texts]
+        results, missing_keys = self._get_many_from_lru(keys)
+        if len(missing_keys) == 0:
+            return results
+
+        pool = await get_async_pool()
+        rows = await pool.fetch(
+            f"SELECT key, vector FROM {_TABLE_NAME} WHERE key = ANY($1)",
+            missing_keys,
+        )
+
+        self._fill_from_db(keys, results, [(r["key"], r["vector"]) for r in rows])
+        return results
+
+    def _set_many_to_lru(
+        self, model: str, texts: List[str], vectors: List[List[float]]
+    ) -> List[dict]:
+        if len(texts) != len(vectors):
+            raise Exception("len(texts) must match len(vectors)")
+
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            key = embedding_cache_key(model, text)
+            self._lru.set(key, array("f", vector))
+            rows[key] = dict(
+                key=key,
+                model=model,
+                vector=list(vector),
+                create_at=get_timestamp(),
+            )
+
+        return list(rows.values())
+
+    def set_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        rows = self._set_many_to_lru(model, texts, vectors)
+        if len(rows) == 0:
+            return
+
+        EmbeddingCacheDB.insert_many(rows).on_conflict_ignore().execute()
+
+    async def aset_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """Async version of `set_many` on the asyncpg pool."""
+        rows = self._set_many_to_lru(model, texts, vectors)
+        if len(rows) == 0:
+            return
+
+        pool = await get_async_pool()
+        await pool.executemany(
+            f"""
+            INSERT INTO {_TABLE_NAME} (key, model, vector, create_at)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT DO NOTHING
+            """,
+            [
+                # `timestamp` column: asyncpg only accepts naive (UTC) datetimes.
+                (r["key"], r["model"], r["vector"], r["create_at"].replace(tzinfo=None))
+                for r in rows
+            ],
+        )
+
+
+# Create table if not exists
+get_db().create_tables([EmbeddingCacheDB])
@@ -1,6 +1,18 @@
 import datetime
+import hashlib
 import os
-from typing import Generator, List, TypeVar
+import threading
+from collections import OrderedDict
+from typing import (
+    BinaryIO,
+    Generator,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 from langchain.schema import BaseMessage
 import tiktoken
 
@@ -25,13 +37,116 @@ def make_chunks(lst: List[T], n) -> Generator[List[T], None, None]:
         yield lst[i : i + n]
 
 
+def get_token_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """The tiktoken encoding of the OpenAI models (cached by tiktoken)."""
+    return tiktoken.get_encoding(encoding_name)
+
+
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_token_encoding(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
+# Tokens added by the chat format to each message, and to prime the answer.
+# Ref: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_ANSWER = 3
+
+
+def num_tokens_from_messages(messages: List[BaseMessage]) -> int:
+    """Returns the number of tokens of a chat prompt, without its answer."""
+    encoding = get_token_encoding()
+    return _TOKENS_PER_ANSWER + sum(
+        _TOKENS_PER_MESSAGE + len(encoding.encode_ordinary(m.content)) for m in messages
+    )
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """The start of `text` that fits in `max_tokens` tokens."""
+    encoding = get_token_encoding()
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+
+    return encoding.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+
+
+class LRUCache(Generic[T]):
+    """Thread-safe in-process LRU cache bounded by the number of items."""
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._items: OrderedDict[Hashable, T] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[T]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+
+            return value
+
+    def set(self, key: Hashable, value: T):
+        if self._maxsize <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def make_token_batches(
+    texts: List[str],
+    max_tokens: int,
+    max_items: int,
+    max_item_tokens: Optional[int] = None,
+) -> List[List[int]]:
+    """Group consecutive texts into batches (lists of indices) so that each batch has
+    at most `max_items` texts and at most `max_tokens` tokens.
+    A single text larger than `max_tokens` or `max_item_tokens` gets a batch of its
+    own, for the caller to split it.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        num_tokens = num_tokens_from_string(text)
+        if max_item_tokens is not None and num_tokens > max_item_tokens:
+            if len(batch) > 0:
+                batches.append(batch)
+            batches.append([i])
+            batch = []
+            batch_tokens = 0
+            continue
+
+        if len(batch) > 0 and (
+            batch_tokens + num_tokens > max_tokens or len(batch) >= max_items
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+
+        batch.append(i)
+        batch_tokens += num_tokens
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
 def messages_to_str(msg: List[BaseMessage]):
     return "\n".join([f"{m.type}:\n{m.content}" for m in msg])
 
@@ -74,3 +189,56 @@ def cprint_orange(text: str):
 
 def cprint_cyan(text: str):
     cprint(text, bcolors.OKCYAN)
+
+
+def parse_byte_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a HTTP `Range: bytes=...` header for an object of `size` bytes.
+
+    Returns the inclusive `(start, end)` of the range, or None when the header is not
+    a single byte range (the whole object is served then).
+    Raises ValueError when the range is not satisfiable.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    start_str, sep, end_str = ranges.strip().partition("-")
+    if sep != "-" or not (start_str + end_str).isdigit():
+        return None
+
+    if start_str == "":
+        # Suffix range: the last N bytes
+        suffix = int(end_str)
+        if suffix == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+
+        return max(size - suffix, 0), size - 1
+
+    start = int(start_str)
+    end = int(end_str) if end_str != "" else size - 1
+    if end_str != "" and start > end:
+        return None
+
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+
+    return start, min(end, size - 1)
+
+
+class HashingReader:
+    """File-like wrapper that hashes the bytes while they are read, so a stream can be
+    uploaded and hashed in a single pass without being copied."""
+
+    def __init__(self, raw: BinaryIO, algorithm: str = "sha256") -> None:
+        self._raw = raw
+        self._hash = hashlib.new(algorithm)
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        self._hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
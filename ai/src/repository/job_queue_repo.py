@@ -0,0 +1,279 @@
+from datetime import timedelta
+from enum import Enum
+from uuid import uuid4
+
+from peewee import CharField, DateTimeField, IntegerField, IntegrityError, TextField
+from pydantic import BaseModel
+
+from repository.base_db import BaseDBModel, get_db
+from repository.db_connect_base import DbConnectBase
+from repository.document_repo import DocumentDB, DocumentProcessStatusEnum
+from repository.helpers import cprint_warn, get_timestamp
+
+
+class IngestionJobStatusEnum(Enum):
+    Queued = "queued"
+    Running = "running"
+    Done = "done"
+    Failed = "failed"
+
+
+class IngestionJobDB(BaseDBModel):
+    job_id = CharField(unique=True)
+    doc_id = CharField(index=True)
+    status = CharField(index=True)
+    attempts = IntegerField()
+    max_attempts = IntegerField()
+    run_after = DateTimeField()
+    locked_by = CharField(null=True)
+    locked_at = DateTimeField(null=True)
+    last_error = TextField(null=True)
+    create_at = DateTimeField()
+    update_at = DateTimeField()
+
+
+class IngestionJob(BaseModel):
+    job_id: str
+    doc_id: str
+    attempts: int
+    max_attempts: int
+
+
+class JobQueueRepo(DbConnectBase):
+    """Postgres-backed queue of document processing jobs.
+
+    Workers claim jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of
+    worker processes can poll the same table without handing out a job twice.
+
+    A document has at most one queued job (unique index) and one running job: a job
+    is not claimed while another job of its document runs. A document changed
+    during a run gets one queued job, processed after the run.
+    """
+
+    _TABLE_NAME = IngestionJobDB._meta.table_name
+    _QUEUED_INDEX_NAME = f"{_TABLE_NAME}_doc_id_queued"
+
+    def __init__(self, max_attempts: int = 3, retry_delay_seconds: int = 30):
+        self._max_attempts = max_attempts
+        self._retry_delay_seconds = retry_delay_seconds
+        self._create_queued_index()
+
+    def _create_queued_index(self):
+        """Unique index of the queued jobs by document. The duplicates queued before
+        it existed are failed first. The api and worker processes run this at the
+        same time, hence the lock."""
+        queued = IngestionJobStatusEnum.Queued.value
+        self._execute(
+            f"""
+            SELECT pg_advisory_xact_lock(hashtext(%s));
+            UPDATE {self._TABLE_NAME}
+            SET status = %s, last_error = 'duplicate', update_at = now()
+            WHERE status = '{queued}' AND id NOT IN (
+                SELECT min(id) FROM {self._TABLE_NAME}
+                WHERE status = '{queued}'
+                GROUP BY doc_id
+            ) AND to_regclass(%s) IS NULL;
+            CREATE UNIQUE INDEX IF NOT EXISTS {self._QUEUED_INDEX_NAME}
+            ON {self._TABLE_NAME} (doc_id) WHERE status = '{queued}';
+            """,
+            (
+                self._QUEUED_INDEX_NAME,
+                IngestionJobStatusEnum.Failed.value,
+                self._QUEUED_INDEX_NAME,
+            ),
+        )
+
+    def enqueue(self, doc_id: str) -> str:
+        """Queue a job for the document, or return its queued job."""
+        now = get_timestamp()
+        queued = IngestionJobStatusEnum.Queued.value
+        query_str = f"""
+        INSERT INTO {self._TABLE_NAME} (
+            job_id, doc_id, status, attempts, max_attempts, run_after, create_at,
+            update_at
+        )
+        VALUES (%s, %s, %s, 0, %s, %s, %s, %s)
+        ON CONFLICT (doc_id) WHERE status = '{queued}' DO NOTHING
+        RETURNING job_id
+        """
+        query_args = (
+            str(uuid4()),
+            doc_id,
+            queued,
+            self._max_attempts,
+            now,
+            now,
+            now,
+        )
+        results = self._execute(query_str, query_args) or []
+        if len(results) > 0:
+            return results[0][0]
+
+        # The queued job may have been claimed since: it processes the new content.
+        existing = (
+            IngestionJobDB.select(IngestionJobDB.job_id)
+            .where(
+                IngestionJobDB.doc_id == doc_id,
+                IngestionJobDB.status.in_(
+                    [queued, IngestionJobStatusEnum.Running.value]
+                ),
+            )
+            .order_by(IngestionJobDB.id.desc())
+            .first()
+        )
+        return existing.job_id if existing is not None else ""
+
+    def claim(self, worker_id: str) -> IngestionJob | None:
+        now = get_timestamp()
+        query_str = f"""
+        UPDATE {self._TABLE_NAME}
+        SET
+            status = %s,
+            attempts = attempts + 1,
+            locked_by = %s,
+            locked_at = %s,
+            update_at = %s
+        WHERE id = (
+            SELECT id FROM {self._TABLE_NAME} AS j
+            WHERE status = %s AND run_after <= %s AND NOT EXISTS (
+                SELECT 1 FROM {self._TABLE_NAME} AS r
+                WHERE r.doc_id = j.doc_id AND r.status = %s
+            )
+            ORDER BY run_after
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING job_id, doc_id, attempts, max_attempts
+        """
+        query_args = (
+            IngestionJobStatusEnum.Running.value,
+            worker_id,
+            now,
+            now,
+            IngestionJobStatusEnum.Queued.value,
+            now,
+            IngestionJobStatusEnum.Running.value,
+        )
+
+        results = self._execute(query_str, query_args) or []
+        if len(results) == 0:
+            return None
+
+        job_id, doc_id, attempts, max_attempts = results[0]
+        return IngestionJob(
+            job_id=job_id, doc_id=doc_id, attempts=attempts, max_attempts=max_attempts
+        )
+
+    def heartbeat(self, worker_id: str):
+        """Refresh the lock of the running jobs of a worker, so long jobs are not
+        taken for crashed ones by `recover_stale`."""
+        IngestionJobDB.update({IngestionJobDB.locked_at: get_timestamp()}).where(
+            IngestionJobDB.locked_by == worker_id,
+            IngestionJobDB.status == IngestionJobStatusEnum.Running.value,
+        ).execute()
+
+    def complete(self, job: IngestionJob):
+        IngestionJobDB.update(
+            {
+                IngestionJobDB.status: IngestionJobStatusEnum.Done.value,
+                IngestionJobDB.update_at: get_timestamp(),
+            }
+        ).where(IngestionJobDB.job_id == job.job_id).execute()
+
+    def fail(self, job: IngestionJob, error: str, retry: bool = True):
+        now = get_timestamp()
+        if retry and job.attempts < job.max_attempts:
+            # Exponential backoff: delay, 2 * delay, 4 * delay, ...
+            delay = self._retry_delay_seconds * 2 ** (job.attempts - 1)
+            status = IngestionJobStatusEnum.Queued
+            run_after = now + timedelta(seconds=delay)
+        else:
+            status = IngestionJobStatusEnum.Failed
+            run_after = now
+
+        def update(status: IngestionJobStatusEnum, run_after):
+            IngestionJobDB.update(
+                {
+                    IngestionJobDB.status: status.value,
+                    IngestionJobDB.run_after: run_after,
+                    IngestionJobDB.locked_by: None,
+                    IngestionJobDB.locked_at: None,
+                    IngestionJobDB.last_error: error,
+                    IngestionJobDB.update_at: now,
+                }
+            ).where(IngestionJobDB.job_id == job.job_id).execute()
+
+        try:
+            update(status, run_after)
+        except IntegrityError:
+            # Another job of the document is queued: it processes it again.
+            status = IngestionJobStatusEnum.Failed
+            update(status, now)
+
+        cprint_warn(f"job {job.job_id} doc_id={job.doc_id} {status.value}: {error}")
+
+    def recover_stale(self, stale_after: timedelta) -> int:
+        """Crash recovery sweep.
+
+        - Running jobs whose worker stopped sending heartbeats go back to the queue,
+          or fail (and their document goes to `error`) when out of attempts. They
+          also fail when another job of their document is queued.
+        - Documents left in `processing` without any pending job get a new job.
+        """
+        now = get_timestamp()
+        requeue_str = f"""
+        UPDATE {self._TABLE_NAME} AS j
+        SET
+            status = CASE
+                WHEN attempts >= max_attempts OR EXISTS (
+                    SELECT 1 FROM {self._TABLE_NAME} AS q
+                    WHERE q.doc_id = j.doc_id AND q.status = %s
+                ) THEN %s
+                ELSE %s
+            END,
+            locked_by = NULL,
+            locked_at = NULL,
+            last_error = 'worker lost',
+            update_at = %s
+        WHERE j.status = %s AND j.locked_at < %s
+        RETURNING j.doc_id, j.attempts >= j.max_attempts
+        """
+        requeue_args = (
+            IngestionJobStatusEnum.Queued.value,
+            IngestionJobStatusEnum.Failed.value,
+            IngestionJobStatusEnum.Queued.value,
+            now,
+            IngestionJobStatusEnum.Running.value,
+            now - stale_after,
+        )
+        requeued = self._execute(requeue_str, requeue_args) or []
+
+        failed_doc_ids = [
+            doc_id for (doc_id, out_of_attempts) in requeued if out_of_attempts
+        ]
+        if len(failed_doc_ids) > 0:
+            DocumentDB.update(
+                {DocumentDB.process_status: DocumentProcessStatusEnum.Error.value}
+            ).where(DocumentDB.doc_id.in_(failed_doc_ids)).execute()
+
+        stuck_str = f"""
+        SELECT d.doc_id FROM {DocumentDB._meta.table_name} d
+        WHERE d.process_status = %s AND NOT EXISTS (
+            SELECT 1 FROM {self._TABLE_NAME} j
+            WHERE j.doc_id = d.doc_id AND j.status IN (%s, %s)
+        )
+        """
+        stuck_args = (
+            DocumentProcessStatusEnum.Processing.value,
+            IngestionJobStatusEnum.Queued.value,
+            IngestionJobStatusEnum.Running.value,
+        )
+        stuck_docs = self._execute(stuck_str, stuck_args) or []
+        for (doc_id,) in stuck_docs:
+            self.enqueue(doc_id)
+
+        return len(requeued) + len(stuck_docs)
+
+
+# Create table if not exists
+get_db().create_tables([IngestionJobDB])
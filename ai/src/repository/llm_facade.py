@@ -1,26 +1,246 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import List
 
+import openai
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.chat_models import ChatOpenAI
 
+from repository.embedding_cache import EmbeddingCache
+from repository.helpers import cprint_warn, make_token_batches, num_tokens_from_string
+
 
 class ChatModelEnum(str, Enum):
     Chat_3_5 = "gpt-3.5-turbo"
     Chat_4 = "gpt-4"
 
 
+# Context window of the chat models, prompt and answer included
+CHAT_CONTEXT_TOKENS = {
+    ChatModelEnum.Chat_3_5: 4096,
+    ChatModelEnum.Chat_4: 8192,
+}
+
+
+# Errors worth retrying with backoff. Ref: https://platform.openai.com/docs/guides/error-codes
+_RETRYABLE_OPENAI_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+
 class LLMFacade:
-    def __init__(self, openai_key: str) -> None:
-        self._embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
+    _EMBEDDING_MODEL = "text-embedding-ada-002"
+    _EMBEDDING_MAX_INPUT_TOKENS = 8191
+    # The embedding API accepts up to 2048 inputs per request.
+    _EMBEDDING_MAX_BATCH_ITEMS = 2048
+
+    def __init__(
+        self,
+        openai_key: str,
+        embedding_cache: EmbeddingCache | None = None,
+        embedding_batch_tokens: int = 50_000,
+        embedding_concurrency: int = 4,
+        embedding_max_retries: int = 6,
+    ) -> None:
+        self._embeddings = OpenAIEmbeddings(
+            openai_api_key=openai_key, model=self._EMBEDDING_MODEL
+        )
         self._openai_key = openai_key
+        self._embedding_cache = embedding_cache
+        self._embedding_batch_tokens = embedding_batch_tokens
+        self._embedding_max_retries = embedding_max_retries
+
+        # Shared by all callers so the number of in-flight batch requests of this
+        # process is bounded, not only the ones of a single document.
+        self._embedding_executor = ThreadPoolExecutor(
+            max_workers=embedding_concurrency, thread_name_prefix="embeddings"
+        )
+        self._embedding_concurrency = embedding_concurrency
+        self._async_embedding_semaphore: asyncio.Semaphore | None = None
 
-    def create_chat(self, model: ChatModelEnum, temperature: float) -> ChatOpenAI:
+    def create_chat(
+        self,
+        model: ChatModelEnum,
+        temperature: float,
+        request_timeout: float | None = None,
+        max_tokens: int | None = None,
+    ) -> ChatOpenAI:
         return ChatOpenAI(
             temperature=temperature,
             openai_api_key=self._openai_key,
             model=model,
+            request_timeout=request_timeout,
+            max_tokens=max_tokens,
+        )
+
+    def get_cached_embeddings(self, texts: List[str]) -> List[List[float] | None]:
+        if self._embedding_cache is None:
+            return [None for _ in texts]
+
+        return self._embedding_cache.get_many(self._EMBEDDING_MODEL, texts)
+
+    def set_cached_embeddings(self, texts: List[str], vectors: List[List[float]]):
+        if self._embedding_cache is None:
+            return
+
+        self._embedding_cache.set_many(self._EMBEDDING_MODEL, texts, vectors)
+
+    def _is_too_long_input(self, texts: List[str]) -> bool:
+        return len(texts) == 1 and (
+            num_tokens_from_string(texts[0]) > self._EMBEDDING_MAX_INPUT_TOKENS
+        )
+
+    def _get_retry_backoff(self, attempt: int, error: Exception) -> float:
+        if attempt >= self._embedding_max_retries:
+            raise error
+
+        # Exponential backoff with jitter, capped at 60s.
+        backoff = min(60.0, 2.0**attempt) + random.uniform(0, 1)
+        cprint_warn(f"embeddings retry {attempt + 1} in {backoff:.1f}s: {error}")
+        return backoff
+
+    def _get_batches(self, texts: List[str]) -> List[List[str]]:
+        return [
+            [texts[i] for i in batch]
+            for batch in make_token_batches(
+                texts,
+                max_tokens=self._embedding_batch_tokens,
+                max_items=self._EMBEDDING_MAX_BATCH_ITEMS,
+                # The too long texts are split by `_embed_batch`
+                max_item_tokens=self._EMBEDDING_MAX_INPUT_TOKENS,
+            )
+        ]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self._is_too_long_input(texts):
+            # langchain splits the too long text and averages the embeddings.
+            return [self._embeddings.embed_query(texts[0])]
+
+        for attempt in range(self._embedding_max_retries + 1):
+            try:
+                response = openai.Embedding.create(
+                    api_key=self._openai_key,
+                    model=self._EMBEDDING_MODEL,
+                    input=texts,
+                )
+                data = sorted(response["data"], key=lambda d: d["index"])
+                return [d["embedding"] for d in data]
+
+            except _RETRYABLE_OPENAI_ERRORS as e:
+                time.sleep(self._get_retry_backoff(attempt, e))
+
+        raise Exception("unreachable")
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self._is_too_long_input(texts):
+            return [await self._embeddings.aembed_query(texts[0])]
+
+        # Created lazily so it belongs to the running event loop.
+        if self._async_embedding_semaphore is None:
+            self._async_embedding_semaphore = asyncio.Semaphore(
+                self._embedding_concurrency
+            )
+
+        for attempt in range(self._embedding_max_retries + 1):
+            try:
+                async with self._async_embedding_semaphore:
+                    response = await openai.Embedding.acreate(
+                        api_key=self._openai_key,
+                        model=self._EMBEDDING_MODEL,
+                        input=texts,
+                    )
+                data = sorted(response["data"], key=lambda d: d["index"])
+                return [d["embedding"] for d in data]
+
+            except _RETRYABLE_OPENAI_ERRORS as e:
+                await asyncio.sleep(self._get_retry_backoff(attempt, e))
+
+        raise Exception("unreachable")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed the texts with batched requests.
+
+        Cached texts are skipped, the rest is grouped into batches by token budget and
+        the batches are sent concurrently.
+        """
+        results = self.get_cached_embeddings(texts)
+
+        missing_texts = list(
+            dict.fromkeys(t for t, r in zip(texts, results) if r is None)
         )
+        if len(missing_texts) > 0:
+            batches = self._get_batches(missing_texts)
+            futures = [
+                self._embedding_executor.submit(self._embed_batch, batch)
+                for batch in batches
+            ]
+
+            vectors_by_text = {}
+            for batch, future in zip(batches, futures):
+                vectors_by_text.update(zip(batch, future.result()))
+
+            self.set_cached_embeddings(
+                list(vectors_by_text.keys()), list(vectors_by_text.values())
+            )
+            results = [
+                r if r is not None else vectors_by_text[t]
+                for t, r in zip(texts, results)
+            ]
+
+        return results
 
     def openai_embeddings(self, text: str) -> List[float]:
-        return self._embeddings.embed_query(text)
+        """Embedding of a single text (search query, summary), requested from the
+        calling thread: it does not wait behind the document batches of the executor.
+        """
+        vector = self.get_cached_embeddings([text])[0]
+        if vector is None:
+            vector = self._embed_batch([text])[0]
+            self.set_cached_embeddings([text], [vector])
+
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Async version of `embed_documents`."""
+        results = (
+            await self._embedding_cache.aget_many(self._EMBEDDING_MODEL, texts)
+            if self._embedding_cache is not None
+            else [None for _ in texts]
+        )
+
+        missing_texts = list(
+            dict.fromkeys(t for t, r in zip(texts, results) if r is None)
+        )
+        if len(missing_texts) > 0:
+            batches = self._get_batches(missing_texts)
+            batch_vectors = await asyncio.gather(
+                *[self._aembed_batch(batch) for batch in batches]
+            )
+
+            vectors_by_text = {}
+            for batch, vectors in zip(batches, batch_vectors):
+                vectors_by_text.update(zip(batch, vectors))
+
+            if self._embedding_cache is not None:
+                await self._embedding_cache.aset_many(
+                    self._EMBEDDING_MODEL,
+                    list(vectors_by_text.keys()),
+                    list(vectors_by_text.values()),
+                )
+
+            results = [
+                r if r is not None else vectors_by_text[t]
+                for t, r in zip(texts, results)
+            ]
+
+        return results
+
+    async def aopenai_embeddings(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
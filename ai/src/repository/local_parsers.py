@@ -0,0 +1,194 @@
+"""Parsers of the common text formats that run in the process, without a call to the
+Unstructured API. They return elements shaped like the ones of Unstructured:
+
+    {"type": "Title" | "NarrativeText" | "ListItem", "text": str,
+     "metadata": {"section": "Title > Subtitle"}}
+
+`section` is the path of the headings above the element (the heading itself for a
+"Title" element).
+"""
+
+import re
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, List, Optional, Tuple
+
+import trafilatura
+
+LocalParser = Callable[[str], List[dict]]
+
+_MD_ATX_HEADING_PATTERN = re.compile(r"^ {0,3}(#{1,6})[ \t]+(.*?)[ \t#]*$")
+_MD_SETEXT_UNDERLINE_PATTERN = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+_MD_FENCE_PATTERN = re.compile(r"^ {0,3}(```|~~~)")
+_MD_LIST_ITEM_PATTERN = re.compile(r"^ {0,3}(?:[-*+]|\d+[.)])[ \t]+")
+_BLANK_LINES_PATTERN = re.compile(r"\n(?:[ \t]*\n)+")
+_HTML_HEADING_PATTERN = re.compile(r"^h([1-6])$")
+# Elements of the trafilatura XML that start a new line in the text of their parent
+_XML_LINE_TAGS = {"lb", "p", "head", "item", "row"}
+
+
+class _SectionTracker:
+    """Stack of the headings above the current element."""
+
+    def __init__(self) -> None:
+        self._headings: List[Tuple[int, str]] = []
+
+    def push(self, level: int, title: str):
+        while len(self._headings) > 0 and self._headings[-1][0] >= level:
+            self._headings.pop()
+        self._headings.append((level, title))
+
+    def section(self) -> Optional[str]:
+        if len(self._headings) == 0:
+            return None
+
+        return " > ".join(title for (_, title) in self._headings)
+
+
+def _make_element(element_type: str, text: str, section: Optional[str]) -> dict:
+    return {"type": element_type, "text": text, "metadata": {"section": section}}
+
+
+def parse_text(text: str) -> List[dict]:
+    """One element per paragraph (separated by blank lines)."""
+    paragraphs = _BLANK_LINES_PATTERN.split(text.replace("\r\n", "\n"))
+    return [
+        _make_element("NarrativeText", paragraph.strip(), None)
+        for paragraph in paragraphs
+        if paragraph.strip() != ""
+    ]
+
+
+def parse_markdown(text: str) -> List[dict]:
+    """Headings (ATX `#` and setext underlines), paragraphs, list items and fenced
+    code blocks. A `#` line inside a code block is not a heading."""
+    elements: List[dict] = []
+    sections = _SectionTracker()
+    lines: List[str] = []
+    element_type = "NarrativeText"
+    fence: Optional[str] = None
+
+    def flush():
+        nonlocal lines, element_type
+        if len(lines) > 0:
+            elements.append(
+                _make_element(element_type, "\n".join(lines), sections.section())
+            )
+        lines = []
+        element_type = "NarrativeText"
+
+    def add_heading(level: int, title: str):
+        sections.push(level, title)
+        elements.append(_make_element("Title", title, sections.section()))
+
+    for line in text.replace("\r\n", "\n").split("\n"):
+        fence_match = _MD_FENCE_PATTERN.match(line)
+        if fence is not None:
+            lines.append(line)
+            if fence_match is not None and fence_match.group(1) == fence:
+                fence = None
+                flush()
+            continue
+
+        if fence_match is not None:
+            flush()
+            fence = fence_match.group(1)
+            lines.append(line)
+            continue
+
+        if line.strip() == "":
+            flush()
+            continue
+
+        heading_match = _MD_ATX_HEADING_PATTERN.match(line)
+        if heading_match is not None:
+            flush()
+            add_heading(len(heading_match.group(1)), heading_match.group(2))
+            continue
+
+        underline_match = _MD_SETEXT_UNDERLINE_PATTERN.match(line)
+        if underline_match is not None:
+            if len(lines) == 1 and element_type == "NarrativeText":
+                title = lines[0].strip()
+                lines = []
+                add_heading(1 if underline_match.group(1)[0] == "=" else 2, title)
+            else:
+                # Thematic break
+                flush()
+            continue
+
+        if _MD_LIST_ITEM_PATTERN.match(line) is not None:
+            flush()
+            element_type = "ListItem"
+
+        lines.append(line)
+
+    flush()
+    return elements
+
+
+def _xml_text(node: ET.Element) -> str:
+    """Text of an element of the trafilatura XML, one line per line break, nested
+    list item or table row, the cells separated by spaces. `itertext()` would glue
+    "Line one<lb/>line two" into "Line oneline two"."""
+
+    def text(value: Optional[str]) -> str:
+        # Whitespace only: the indentation of the tables and lists
+        if value is None:
+            return ""
+        return value if value.strip() != "" else " "
+
+    def parts(node: ET.Element):
+        yield text(node.text)
+        for child in node:
+            if child.tag in _XML_LINE_TAGS:
+                yield "\n"
+            elif child.tag == "cell":
+                yield " "
+            yield from parts(child)
+            yield text(child.tail)
+
+    lines = (" ".join(line.split()) for line in "".join(parts(node)).split("\n"))
+    return "\n".join(line for line in lines if line != "")
+
+
+def parse_html(html: str) -> List[dict]:
+    """Main content of the page (without menus, footers, ...) extracted by
+    trafilatura, with its headings. Falls back to all the text of the page, for
+    the pages too short for trafilatura."""
+    xml = trafilatura.extract(html, output_format="xml", include_comments=False)
+    main = ET.fromstring(xml).find("main") if xml is not None else None
+
+    elements: List[dict] = []
+    sections = _SectionTracker()
+    for node in main if main is not None else []:
+        text = _xml_text(node)
+        if text == "":
+            continue
+
+        if node.tag == "head":
+            heading_match = _HTML_HEADING_PATTERN.match(node.get("rend", ""))
+            level = int(heading_match.group(1)) if heading_match is not None else 2
+            sections.push(level, text)
+            elements.append(_make_element("Title", text, sections.section()))
+        elif node.tag == "list":
+            # The nested lists are in the text of their item
+            for item in node.findall("item"):
+                item_text = _xml_text(item)
+                if item_text != "":
+                    elements.append(
+                        _make_element("ListItem", item_text, sections.section())
+                    )
+        else:
+            elements.append(_make_element("NarrativeText", text, sections.section()))
+
+    if len(elements) == 0:
+        return parse_text(trafilatura.html2txt(html) or "")
+
+    return elements
+
+
+DEFAULT_LOCAL_PARSERS: Dict[str, LocalParser] = {
+    "text/plain": parse_text,
+    "text/markdown": parse_markdown,
+    "text/html": parse_html,
+}
@@ -1,5 +1,9 @@
-from typing import BinaryIO
+from typing import BinaryIO, Iterator
 from minio import Minio
+from minio.commonconfig import CopySource
+from minio.datatypes import Object
+
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class StorageFacade:
@@ -12,14 +16,19 @@ class StorageFacade:
         object_name: str,
         content_type: str,
         blob: BinaryIO,
-        part_size: int,
+        length: int = -1,
+        part_size: int = 0,
         metadata: dict | None = None,
     ):
+        """Stream `blob` to the bucket. With a known `length` MinIO picks the part
+        size itself; an unknown length (-1) requires `part_size`, the size of the
+        buffer MinIO fills for each part.
+        """
         return self._client.put_object(
             bucket_name=self._bucket_name,
             object_name=object_name,
             data=blob,
-            length=-1,
+            length=length,
             part_size=part_size,
             content_type=content_type,
             metadata=metadata,
@@ -43,6 +52,46 @@ class StorageFacade:
                 response.close()
                 response.release_conn()
 
+    def stat(self, object_name: str) -> Object | None:
+        try:
+            return self._client.stat_object(
+                bucket_name=self._bucket_name,
+                object_name=object_name,
+            )
+
+        except Exception:
+            return None
+
+    def stream(
+        self,
+        object_name: str,
+        offset: int = 0,
+        length: int = 0,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """Read the object (or `length` bytes from `offset`, 0 means until the end)
+        chunk by chunk, without holding it in memory."""
+        response = self._client.get_object(
+            bucket_name=self._bucket_name,
+            object_name=object_name,
+            offset=offset,
+            length=length,
+        )
+        try:
+            yield from response.stream(chunk_size)
+
+        finally:
+            response.close()
+            response.release_conn()
+
+    def copy(self, source_object_name: str, object_name: str):
+        """Server-side copy of an object of the bucket (up to 5 GiB)."""
+        return self._client.copy_object(
+            bucket_name=self._bucket_name,
+            object_name=object_name,
+            source=CopySource(self._bucket_name, source_object_name),
+        )
+
     def delete(self, object_name: str):
         self._client.remove_object(
             bucket_name=self._bucket_name,
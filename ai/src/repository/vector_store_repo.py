@@ -1,15 +1,23 @@
-from typing import Optional
+import hashlib
+import io
+import re
+import struct
+from enum import Enum
+from typing import Iterable, Optional
 from uuid import uuid4
 
+import numpy as np
 from pydantic import BaseModel
 
+from repository.base_db import get_db, set_async_server_settings
 from repository.db_connect_base import DbConnectBase
-from repository.helpers import make_chunks
 
 
 class VectorMetadata(BaseModel):
     content: str
     page_number: Optional[int]
+    # Titles above the chunk, "Title > Subtitle"
+    section: Optional[str] = None
 
 
 class VectorQueryResult(BaseModel):
@@ -26,15 +34,169 @@ class Vector(BaseModel):
     metadata: VectorMetadata
 
 
+# Ref: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+_COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_BINARY_TRAILER = struct.pack("!h", -1)
+_COPY_BINARY_NULL = struct.pack("!i", -1)
+
+
+def _copy_binary_text(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _copy_binary_vector(vector: Iterable[float]) -> bytes:
+    # pgvector binary format: int16 dim, int16 unused, float4[dim] big-endian.
+    # Ref: https://github.com/pgvector/pgvector/blob/master/src/vector.c (vector_recv)
+    data = np.asarray(vector, dtype=">f4")
+    return struct.pack("!ihh", 4 + data.nbytes, len(data), 0) + data.tobytes()
+
+
+def make_copy_binary(rows: Iterable[tuple]) -> io.BytesIO:
+    """Encode rows in the binary COPY format.
+
+    Each field of a row is a `str`, an `int` (int4), None (NULL) or a vector
+    (list of float / numpy array).
+    """
+    buffer = io.BytesIO()
+    buffer.write(_COPY_BINARY_HEADER)
+    for row in rows:
+        buffer.write(struct.pack("!h", len(row)))
+        for field in row:
+            if field is None:
+                buffer.write(_COPY_BINARY_NULL)
+            elif isinstance(field, str):
+                buffer.write(_copy_binary_text(field))
+            elif isinstance(field, int):
+                buffer.write(struct.pack("!ii", 4, field))
+            else:
+                buffer.write(_copy_binary_vector(field))
+
+    buffer.write(_COPY_BINARY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def make_metadata(
+    content: str, page_number: Optional[int], section: Optional[str] = None
+) -> VectorMetadata:
+    """`VectorMetadata` of a row, without validation: the columns are already typed."""
+    return VectorMetadata.construct(
+        content=content, page_number=page_number, section=section
+    )
+
+
+def make_query_result(
+    namespace: str,
+    document: str,
+    content: str,
+    page_number: Optional[int],
+    section: Optional[str],
+    distance: float,
+) -> VectorQueryResult:
+    return VectorQueryResult.construct(
+        namespace=namespace,
+        document=document,
+        metadata=make_metadata(content, page_number, section),
+        similarity=1 - distance,
+    )
+
+
+def make_fingerprint(metadata: VectorMetadata) -> str:
+    """Fingerprint of a chunk: a chunk with the same fingerprint has the same row.
+    `section` is left out when None, so the chunks stored before it keep their
+    fingerprint."""
+    exclude = {"section"} if metadata.section is None else None
+    return hashlib.sha256(metadata.json(exclude=exclude).encode("utf-8")).hexdigest()
+
+
+class VectorStatusEnum(str, Enum):
+    Active = "active"
+    # Generation being built, or replaced by a newer one and waiting for deletion
+    Inactive = "inactive"
+    # Current generation, left out of the searches by an admin
+    Disabled = "disabled"
+
+
+class SearchModeEnum(str, Enum):
+    # Cosine similarity only
+    Vector = "vector"
+    # Cosine similarity and full-text / trigram matches, merged by reciprocal rank fusion
+    Hybrid = "hybrid"
+
+
+def to_asyncpg_placeholders(query_str: str) -> str:
+    """Turn the `%s` placeholders of a psycopg2 query into `$1, $2, ...`."""
+    count = 0
+
+    def placeholder(match: re.Match) -> str:
+        nonlocal count
+        if match.group(0) == "%%":
+            return "%"
+
+        count += 1
+        return f"${count}"
+
+    return re.sub(r"%%|%s", placeholder, query_str)
+
+
+class VectorIndexTypeEnum(str, Enum):
+    HNSW = "hnsw"
+    IVFFlat = "ivfflat"
+    Disabled = "none"
+
+
+class VectorIndexConfig(BaseModel):
+    """ANN index settings. Ref: https://github.com/pgvector/pgvector#indexing
+
+    - `m`, `ef_construction`: build parameters of HNSW.
+    - `lists`: build parameter of IVFFlat.
+    - `ef_search`, `probes`: default per-query search parameters of HNSW / IVFFlat.
+    - `exact_search_max_rows`: a search whose filter matches at most this many rows
+      reads them with the B-tree indexes and computes their exact distance, instead
+      of scanning the ANN index (see `_nearest_query`).
+    """
+
+    index_type: VectorIndexTypeEnum = VectorIndexTypeEnum.HNSW
+    m: int = 16
+    ef_construction: int = 64
+    lists: int = 100
+    ef_search: int = 40
+    probes: int = 1
+    exact_search_max_rows: int = 10000
+
+
 class VectorStoreRepo(DbConnectBase):
+    # B-tree indexes for the filters used by the search and delete queries.
+    _BTREE_INDEX_COLUMNS = ["namespace", "document", "status", "vector_id"]
+    # The 'simple' configuration of the lexical search does no stemming: the
+    # documents are in many languages.
+    _TSVECTOR_EXPRESSION = "to_tsvector('simple', content)"
+    # Limit of the UTF-8 size of the content of a chunk
+    _MAX_CONTENT_BYTES = 40000
+    # Constant of the reciprocal rank fusion: score = sum(1 / (k + rank))
+    _RRF_K = 60
+    # Columns of the search results, before `distance`
+    _RESULT_COLUMNS = "namespace, document, content, page_number, section"
+    # Rows of the legacy `metadata` column moved per transaction
+    _METADATA_BATCH_SIZE = 5000
+    # Statuses of the current generation of a document
+    _CURRENT_STATUSES = [VectorStatusEnum.Active.value, VectorStatusEnum.Disabled.value]
+
     def __init__(
         self,
         table_name: str,
         vector_size: int,
+        index_config: VectorIndexConfig | None = None,
     ):
         self._TABLE_NAME = table_name
         self._VECTOR_SIZE = vector_size
+        self._index_config = index_config or VectorIndexConfig()
+        # The async searches only set the settings that differ from these defaults
+        set_async_server_settings(self._search_settings(None, None, 0))
         self._create_table()
+        self._drop_invalid_indexes()
+        self._create_startup_indexes()
 
     def _create_table(self):
         self._execute(
@@ -43,11 +205,313 @@ class VectorStoreRepo(DbConnectBase):
                 namespace VARCHAR(255),
                 document VARCHAR(255),
                 vector_id VARCHAR(255),
-                metadata TEXT,
+                content TEXT,
+                page_number INTEGER,
+                section TEXT,
                 vector vector({self._VECTOR_SIZE}),
-                status VARCHAR(20)
+                status VARCHAR(20),
+                fingerprint VARCHAR(64),
+                generation INTEGER NOT NULL DEFAULT 0
             )""",
         )
+        # Columns added after the first version of the table
+        self._execute(
+            f"""
+            ALTER TABLE {self._TABLE_NAME}
+            ADD COLUMN IF NOT EXISTS fingerprint VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS content TEXT,
+            ADD COLUMN IF NOT EXISTS page_number INTEGER,
+            ADD COLUMN IF NOT EXISTS section TEXT
+            """
+        )
+        self._migrate_metadata_column()
+
+    def _has_metadata_column(self) -> bool:
+        results = self._execute(
+            """
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'metadata'
+            """,
+            (self._TABLE_NAME,),
+        )
+        return bool(results)
+
+    def _migrate_metadata_column(self):
+        """The first version of the table stored `VectorMetadata` as JSON text in
+        `metadata`. Move it to the `content` and `page_number` columns in batches of
+        `_METADATA_BATCH_SIZE` rows, one transaction each, then drop it (with its
+        indexes). An interrupted migration resumes from the rows left.
+
+        The api and worker processes run this at the same time: each transaction
+        holds an advisory lock and checks the column again under it."""
+        if not self._has_metadata_column():
+            return
+
+        while True:
+            with get_db().connection_context(), get_db().atomic():
+                self._execute(
+                    "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                    (f"{self._TABLE_NAME}.metadata",),
+                )
+                if not self._has_metadata_column():
+                    return
+
+                ((migrated,),) = self._execute(
+                    f"""
+                    WITH batch AS (
+                        UPDATE {self._TABLE_NAME}
+                        SET
+                            content = metadata::jsonb ->> 'content',
+                            page_number = (metadata::jsonb ->> 'page_number')::integer,
+                            metadata = NULL
+                        WHERE ctid IN (
+                            SELECT ctid FROM {self._TABLE_NAME}
+                            WHERE metadata IS NOT NULL
+                            LIMIT %s
+                        )
+                        RETURNING 1
+                    )
+                    SELECT count(*) FROM batch
+                    """,
+                    (self._METADATA_BATCH_SIZE,),
+                )
+                if migrated < self._METADATA_BATCH_SIZE:
+                    self._execute(
+                        f"ALTER TABLE {self._TABLE_NAME} DROP COLUMN metadata"
+                    )
+                    return
+
+    def _drop_invalid_indexes(self):
+        """An interrupted `CREATE INDEX CONCURRENTLY` leaves an INVALID index, which
+        the queries do not use and `IF NOT EXISTS` keeps. Drop them (except the ones
+        being built) so they are created again."""
+        results = self._execute(
+            """
+            SELECT c.relname
+            FROM pg_index AS i
+            JOIN pg_class AS c ON c.oid = i.indexrelid
+            WHERE i.indrelid = %s::regclass AND NOT i.indisvalid AND i.indexrelid
+                NOT IN (SELECT index_relid FROM pg_stat_progress_create_index)
+            """,
+            (self._TABLE_NAME,),
+        )
+        for (index_name,) in results or []:
+            print(f"Dropping invalid index {index_name}")
+            self._execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+
+    def _create_startup_indexes(self):
+        """B-tree and text indexes of a new table, created on startup while it is
+        empty. Building them on a large table blocks its writes for a while: the
+        indexes of an existing table are built by `build_indexes`, without blocking,
+        and the searches work without them until then.
+
+        The api and worker processes run this at the same time, hence the lock."""
+        with get_db().connection_context(), get_db().atomic():
+            self._execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                (f"{self._TABLE_NAME}.indexes",),
+            )
+            # The hybrid search uses the functions of pg_trgm, index or not
+            self._execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            if self._execute(f"SELECT 1 FROM {self._TABLE_NAME} LIMIT 1"):
+                return
+
+            self._create_btree_indexes()
+            self._create_text_indexes()
+
+    def _create_btree_indexes(self, concurrently: bool = False):
+        _concurrently = "CONCURRENTLY" if concurrently else ""
+        for column in self._BTREE_INDEX_COLUMNS:
+            self._execute(
+                f"""
+                CREATE INDEX {_concurrently} IF NOT EXISTS {self._TABLE_NAME}_{column}_idx
+                ON {self._TABLE_NAME} ({column})
+                """
+            )
+
+    def _create_text_indexes(self, concurrently: bool = False):
+        """GIN indexes of the hybrid search: full-text for words, trigrams for
+        identifiers and the languages written without spaces (Japanese, Thai)."""
+        _concurrently = "CONCURRENTLY" if concurrently else ""
+        self._execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        self._execute(
+            f"""
+            CREATE INDEX {_concurrently} IF NOT EXISTS {self._TABLE_NAME}_content_tsv_idx
+            ON {self._TABLE_NAME} USING gin ({self._TSVECTOR_EXPRESSION})
+            """
+        )
+        self._execute(
+            f"""
+            CREATE INDEX {_concurrently} IF NOT EXISTS {self._TABLE_NAME}_content_trgm_idx
+            ON {self._TABLE_NAME} USING gin (content gin_trgm_ops)
+            """
+        )
+
+    def _vector_index_name(self) -> str:
+        return f"{self._TABLE_NAME}_vector_idx"
+
+    def _vector_index_definition(self, index_name: str, concurrently: bool) -> str:
+        config = self._index_config
+        _concurrently = "CONCURRENTLY" if concurrently else ""
+
+        # cosine distant ops to match the `<=>` operator used in searches.
+        if config.index_type == VectorIndexTypeEnum.HNSW:
+            method = "hnsw"
+            params = (
+                f"m = {int(config.m)}, ef_construction = {int(config.ef_construction)}"
+            )
+        elif config.index_type == VectorIndexTypeEnum.IVFFlat:
+            method = "ivfflat"
+            params = f"lists = {int(config.lists)}"
+        else:
+            raise Exception(f"unsupported vector index type {config.index_type}")
+
+        return f"""
+            CREATE INDEX {_concurrently} IF NOT EXISTS {index_name}
+            ON {self._TABLE_NAME}
+            USING {method} (vector vector_cosine_ops)
+            WITH ({params})
+            """
+
+    def build_indexes(self, concurrently: bool = True):
+        """Create the B-tree, text and ANN indexes if they do not exist yet.
+
+        `CONCURRENTLY` does not block writes on the table, but it cannot run inside
+        a transaction so every statement is executed on its own. The invalid indexes
+        left by an interrupted build are built again.
+        """
+        self._drop_invalid_indexes()
+        self._create_btree_indexes(concurrently=concurrently)
+        self._create_text_indexes(concurrently=concurrently)
+
+        if self._index_config.index_type == VectorIndexTypeEnum.Disabled:
+            return
+
+        self._execute(
+            self._vector_index_definition(self._vector_index_name(), concurrently)
+        )
+
+    def rebuild_vector_index(self):
+        """Rebuild the ANN index with the current `VectorIndexConfig` without blocking
+        searches: build a new index next to the old one, then swap them.
+        """
+        index_name = self._vector_index_name()
+        new_index_name = f"{index_name}_new"
+
+        self._execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_index_name}")
+
+        if self._index_config.index_type == VectorIndexTypeEnum.Disabled:
+            self._execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+            return
+
+        self._execute(self._vector_index_definition(new_index_name, concurrently=True))
+        self._execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+        self._execute(f"ALTER INDEX {new_index_name} RENAME TO {index_name}")
+
+    def list_indexes(self):
+        results = (
+            self._execute(
+                """
+                SELECT indexname, indexdef
+                FROM pg_indexes
+                WHERE tablename = %s
+                """,
+                (self._TABLE_NAME,),
+            )
+            or []
+        )
+        return [
+            {"name": name, "definition": definition} for (name, definition) in results
+        ]
+
+    def _search_settings(
+        self, ef_search: Optional[int], probes: Optional[int], limit: int
+    ) -> dict[str, int]:
+        """Per-query ANN settings. An HNSW scan returns at most `ef_search` rows."""
+        config = self._index_config
+        if config.index_type == VectorIndexTypeEnum.HNSW:
+            return {"hnsw.ef_search": max(ef_search or config.ef_search, limit)}
+
+        if config.index_type == VectorIndexTypeEnum.IVFFlat:
+            return {"ivfflat.probes": probes or config.probes}
+
+        return {}
+
+    def _search_settings_sql(
+        self, ef_search: Optional[int], probes: Optional[int], limit: int
+    ) -> tuple[str, tuple]:
+        """`SET LOCAL` only lives until the end of the transaction. The settings and the
+        search are sent as one multi-statement query, which Postgres runs in a single
+        implicit transaction, so this does not cost an extra round trip.
+        """
+        settings = self._search_settings(ef_search, probes, limit)
+        settings_str = "".join(f"SET LOCAL {name} = %s;" for name in settings)
+        return settings_str, tuple(settings.values())
+
+    def _nearest_query(
+        self,
+        columns: str,
+        where: str,
+        where_args: tuple,
+        query_vector: list[float],
+        limit: int,
+    ) -> tuple[str, tuple]:
+        """The `limit` rows matching `where` nearest to `query_vector`, with their
+        cosine `distance`, ordered by it.
+
+        The ANN index returns the `ef_search` nearest rows of the whole table and
+        `where` is applied to them: with a selective filter (a few documents of a
+        large table) few or none of them match. So when at most
+        `exact_search_max_rows` rows match `where`, they are read with the B-tree
+        indexes and sorted by their exact distance instead, which is exact and fast
+        for small sets. The matching rows are counted (up to the limit) by the same
+        query, and only one of the two branches runs. The count costs one index scan
+        of up to `exact_search_max_rows` rows.
+        """
+        max_rows = self._index_config.exact_search_max_rows
+        # cosine distant. Ref: https://github.com/pgvector/pgvector
+        distance = "vector <=> %s::vector"
+        # NOTE: `+ 0` makes the exact branch order by an expression the ANN index
+        # cannot serve. The ANN branch orders by the distance ascending so the index
+        # can be used.
+        query_str = f"""
+        WITH matching AS (
+            SELECT count(*) AS n
+            FROM (SELECT 1 FROM {self._TABLE_NAME} WHERE {where} LIMIT %s) AS m
+        )
+        SELECT * FROM (
+            (
+                SELECT {columns}, {distance} AS distance
+                FROM {self._TABLE_NAME}
+                WHERE {where} AND (SELECT n FROM matching) <= %s
+                ORDER BY ({distance}) + 0 LIMIT %s
+            )
+            UNION ALL
+            (
+                SELECT {columns}, {distance} AS distance
+                FROM {self._TABLE_NAME}
+                WHERE {where} AND (SELECT n FROM matching) > %s
+                ORDER BY distance LIMIT %s
+            )
+        ) AS nearest
+        ORDER BY distance
+        """
+        query_args = (
+            *where_args,
+            max_rows + 1,
+            query_vector,
+            *where_args,
+            max_rows,
+            query_vector,
+            limit,
+            query_vector,
+            *where_args,
+            max_rows,
+            limit,
+        )
+        return query_str, query_args
 
     def _drop_table(self):
         self._execute(
@@ -68,17 +532,174 @@ class VectorStoreRepo(DbConnectBase):
 
         self._execute(query_str, query_args)
 
-    def set_vector_status_by_ids(self, vector_ids: list[str], status: str):
-        # TODO: this does not yet handle multiple consecutive UPDATEs
-        query_str = ""
-        query_args = ()
-        for vector_id in vector_ids:
-            query_str += f"""
-                UPDATE {self._TABLE_NAME}
-                SET status = '{status}'
-                WHERE vector_id = %s;
-                """
-            query_args += (vector_id,)
+    def get_document_fingerprints(
+        self, namespace: str, document: str
+    ) -> list[tuple[str, str | None]]:
+        """(vector_id, fingerprint) of the current vectors of a document. The
+        fingerprint is None for the vectors inserted before fingerprints existed."""
+        results = self._execute(
+            f"""
+            SELECT vector_id, fingerprint
+            FROM {self._TABLE_NAME}
+            WHERE namespace = %s AND document = %s AND status = ANY(%s)
+            """,
+            (namespace, document, self._CURRENT_STATUSES),
+        )
+        return [(vector_id, fingerprint) for (vector_id, fingerprint) in results or []]
+
+    def get_vectors_by_ids(self, vector_ids: list[str]) -> dict[str, np.ndarray]:
+        if len(vector_ids) == 0:
+            return {}
+
+        results = self._execute(
+            f"""
+            SELECT vector_id, vector
+            FROM {self._TABLE_NAME}
+            WHERE vector_id = ANY(%s)
+            """,
+            (vector_ids,),
+        )
+        return {vector_id: vector for (vector_id, vector) in results or []}
+
+    def copy_document_vectors(
+        self,
+        source_namespace: str,
+        source_document: str,
+        namespace: str,
+        document: str,
+        vector_ids: Optional[list[str]] = None,
+        generation: int = 0,
+        status: VectorStatusEnum = VectorStatusEnum.Active,
+    ):
+        """Copy the current vectors of a document (only `vector_ids` if given) to
+        `generation` of another one, inside the database."""
+        query_str = f"""
+            INSERT INTO {self._TABLE_NAME} (
+                namespace,
+                document,
+                vector_id,
+                content,
+                page_number,
+                section,
+                vector,
+                status,
+                fingerprint,
+                generation
+            )
+            SELECT
+                %s,
+                %s,
+                gen_random_uuid()::text,
+                content,
+                page_number,
+                section,
+                vector,
+                %s,
+                fingerprint,
+                %s
+            FROM {self._TABLE_NAME}
+            WHERE namespace = %s AND document = %s AND status = ANY(%s)
+            """
+        query_args = (
+            namespace,
+            document,
+            status.value,
+            generation,
+            source_namespace,
+            source_document,
+            self._CURRENT_STATUSES,
+        )
+        if vector_ids is not None:
+            query_str += " AND vector_id = ANY(%s)"
+            query_args += (vector_ids,)
+
+        self._execute(query_str, query_args)
+
+    def next_generation(self, namespace: str, document: str) -> int:
+        results = self._execute(
+            f"""
+            SELECT COALESCE(MAX(generation), 0) + 1
+            FROM {self._TABLE_NAME}
+            WHERE namespace = %s AND document = %s
+            """,
+            (namespace, document),
+        )
+        return results[0][0]
+
+    def activate_generation(self, namespace: str, document: str, generation: int):
+        """Make `generation` the vectors of the document. A single UPDATE, so searches
+        see either the previous generation or the new one, never both or none. The new
+        generation stays disabled when the previous one was."""
+        self._execute(
+            f"""
+            UPDATE {self._TABLE_NAME}
+            SET status = CASE
+                WHEN generation <> %s THEN %s
+                WHEN EXISTS (
+                    SELECT 1 FROM {self._TABLE_NAME}
+                    WHERE namespace = %s AND document = %s AND status = %s
+                ) THEN %s
+                ELSE %s
+            END
+            WHERE namespace = %s AND document = %s
+                AND (generation = %s OR status = ANY(%s))
+            """,
+            (
+                generation,
+                VectorStatusEnum.Inactive.value,
+                namespace,
+                document,
+                VectorStatusEnum.Disabled.value,
+                VectorStatusEnum.Disabled.value,
+                VectorStatusEnum.Active.value,
+                namespace,
+                document,
+                generation,
+                self._CURRENT_STATUSES,
+            ),
+        )
+
+    def delete_old_generations(self, namespace: str, document: str, generation: int):
+        """Delete the inactive vectors of the generations before `generation`: the
+        replaced ones and the ones of failed processing."""
+        self._execute(
+            f"""
+            DELETE FROM {self._TABLE_NAME}
+            WHERE namespace = %s AND document = %s AND status = %s AND generation < %s
+            """,
+            (namespace, document, VectorStatusEnum.Inactive.value, generation),
+        )
+
+    def set_vector_status_by_ids(
+        self, vector_ids: list[str], status: VectorStatusEnum | str
+    ):
+        if len(vector_ids) == 0:
+            return
+
+        self._execute(
+            f"UPDATE {self._TABLE_NAME} SET status = %s WHERE vector_id = ANY(%s)",
+            (VectorStatusEnum(status).value, vector_ids),
+        )
+
+    def set_vector_status_in_document(
+        self, namespace: str, status: VectorStatusEnum | str, document: str = ""
+    ):
+        """Enable (`active`) or disable (`disabled`) the current vectors of a namespace,
+        or of one of its documents. The inactive generations are left as they are, and
+        a document processed again keeps its status (see `activate_generation`).
+        Raise ValueError for `inactive`."""
+        status = VectorStatusEnum(status)
+        if status == VectorStatusEnum.Inactive:
+            raise ValueError("status must be active or disabled")
+
+        query_str = f"""
+        UPDATE {self._TABLE_NAME} SET status = %s
+        WHERE namespace = %s AND status = ANY(%s)
+        """
+        query_args = (status.value, namespace, self._CURRENT_STATUSES)
+        if document != "":
+            query_str += " AND document = %s"
+            query_args += (document,)
 
         self._execute(query_str, query_args)
 
@@ -89,49 +710,69 @@ class VectorStoreRepo(DbConnectBase):
         vectors: list[list[float]],
         metadatas: list[VectorMetadata],
         vector_ids: Optional[list[str]] = None,
+        generation: int = 0,
+        status: VectorStatusEnum = VectorStatusEnum.Active,
     ):
+        """Insert the vectors of a document. Each row stores the `make_fingerprint`
+        of its metadata."""
         if len(vectors) != len(metadatas):
             raise Exception("len(vectors) must match len(metadata)")
 
         if vector_ids is not None and len(vector_ids) != len(vectors):
             raise Exception("len(vector_ids) must match len(vectors)")
 
-        _metadatas: list[str] = []
         for m in metadatas:
-            metadata_str = m.json()
-            if len(metadata_str) > 40000:
-                raise Exception("metadata greater than 40kb")
+            if len(m.content.encode("utf-8")) > self._MAX_CONTENT_BYTES:
+                raise Exception("content greater than 40kb")
 
-            _metadatas.append(metadata_str)
+        _fingerprints = [make_fingerprint(m) for m in metadatas]
 
         _vector_ids: list[str] = (
             vector_ids if vector_ids is not None else [str(uuid4()) for _ in vectors]
         )
-        vectors_and_metadata = list(zip(_vector_ids, vectors, _metadatas))
-        vectors_and_metadata_len = len(vectors_and_metadata)
-        inserted = 0
-        _CHUNK_SIZE = 20
-        for chunk in make_chunks(vectors_and_metadata, _CHUNK_SIZE):
-            query_str = ""
-            query_args = ()
-            for vector_id, vector, metadata in chunk:
-                query_str += f"""
-                    INSERT INTO {self._TABLE_NAME}
-                        (namespace, document, vector_id, vector, metadata, status)
-                    VALUES (%s, %s, %s, %s, %s, 'active');
-                    """
-                query_args += (
-                    namespace,
-                    document,
-                    vector_id,
-                    vector,
-                    metadata,
-                )
 
-            self._execute(query_str, query_args)
+        for vector in vectors:
+            if len(vector) != self._VECTOR_SIZE:
+                raise Exception(f"len(vector) must be {self._VECTOR_SIZE}")
 
-            inserted += len(chunk)
-            print(f">>> inserted {inserted} / {vectors_and_metadata_len}")
+        # Binary COPY: one round trip and one transaction per document, and the floats
+        # are sent as float4 instead of being formatted as text.
+        copy_data = make_copy_binary(
+            (
+                namespace,
+                document,
+                vector_id,
+                metadata.content,
+                metadata.page_number,
+                metadata.section,
+                vector,
+                status.value,
+                fingerprint,
+                generation,
+            )
+            for vector_id, vector, metadata, fingerprint in zip(
+                _vector_ids, vectors, metadatas, _fingerprints
+            )
+        )
+        inserted = self._copy_expert(
+            f"""
+            COPY {self._TABLE_NAME} (
+                namespace,
+                document,
+                vector_id,
+                content,
+                page_number,
+                section,
+                vector,
+                status,
+                fingerprint,
+                generation
+            )
+            FROM STDIN WITH (FORMAT binary)
+            """,
+            copy_data,
+        )
+        print(f">>> inserted {inserted} / {len(_vector_ids)}")
 
         return _vector_ids
 
@@ -141,9 +782,11 @@ class VectorStoreRepo(DbConnectBase):
             namespace,
             document,
             vector_id,
-            metadata
+            content,
+            page_number,
+            section
         FROM {self._TABLE_NAME}
-        WHERE namespace = %s
+        WHERE NOT status = 'inactive' AND namespace = %s
         """
         query_args = (namespace,)
 
@@ -153,13 +796,20 @@ class VectorStoreRepo(DbConnectBase):
 
         results = self._execute(query_str, query_args) or []
         return [
-            Vector(
+            Vector.construct(
                 namespace=namespace,
                 document=document,
                 vector_id=vector_id,
-                metadata=VectorMetadata.parse_raw(metadata),
+                metadata=make_metadata(content, page_number, section),
             )
-            for (namespace, document, vector_id, metadata) in results
+            for (
+                namespace,
+                document,
+                vector_id,
+                content,
+                page_number,
+                section,
+            ) in results
         ]
 
     def similarity_search_by_namespace(
@@ -168,39 +818,38 @@ class VectorStoreRepo(DbConnectBase):
         namespace: str,
         document: str = "",
         limit: int = 5,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
     ):
-        # cosine distant. Ref: https://github.com/pgvector/pgvector
-        _distant_search_method = "<=>"
-
-        query_str = f"""
-        SELECT 
-            namespace,
-            document,
-            vector_id,
-            metadata,
-            1 - (vector {_distant_search_method} %s::vector) AS similarity
-        FROM {self._TABLE_NAME}
-        WHERE NOT status = 'inactive' AND namespace = %s
-        """
+        settings_str, settings_args = self._search_settings_sql(
+            ef_search, probes, limit
+        )
 
-        query_args = (query_vector, namespace)
+        where = "status = 'active' AND namespace = %s"
+        where_args: tuple = (namespace,)
         if document != "":
-            query_str += " AND document = %s"
-            query_args += (document,)
-
-        query_str += " ORDER BY similarity DESC LIMIT %s"
-        query_args += (limit,)
+            where += " AND document = %s"
+            where_args += (document,)
 
-        results = self._execute(query_str, query_args) or []
+        query_str, query_args = self._nearest_query(
+            self._RESULT_COLUMNS, where, where_args, query_vector, limit
+        )
+        results = (
+            self._execute(settings_str + query_str, settings_args + query_args) or []
+        )
 
         return [
-            VectorQueryResult(
-                namespace=namespace,
-                document=document,
-                metadata=VectorMetadata.parse_raw(metadata),
-                similarity=similarity,
+            make_query_result(
+                namespace, document, content, page_number, section, distance
             )
-            for (namespace, document, _, metadata, similarity) in results
+            for (
+                namespace,
+                document,
+                content,
+                page_number,
+                section,
+                distance,
+            ) in results
         ]
 
     def similarity_search_by_documents(
@@ -208,32 +857,215 @@ class VectorStoreRepo(DbConnectBase):
         query_vector: list[float],
         documents: list[str],
         limit: int = 5,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
     ):
-        # cosine distant. Ref: https://github.com/pgvector/pgvector
-        _distant_search_method = "<=>"
+        settings_str, settings_args = self._search_settings_sql(
+            ef_search, probes, limit
+        )
+        query_str, query_args = self._nearest_query(
+            self._RESULT_COLUMNS,
+            "status = 'active' AND document = ANY(%s)",
+            (documents,),
+            query_vector,
+            limit,
+        )
+
+        results = (
+            self._execute(settings_str + query_str, settings_args + query_args) or []
+        )
+
+        return [
+            make_query_result(
+                namespace, document, content, page_number, section, distance
+            )
+            for (
+                namespace,
+                document,
+                content,
+                page_number,
+                section,
+                distance,
+            ) in results
+        ]
+
+    async def asimilarity_search_by_documents(
+        self,
+        query_vector: list[float],
+        documents: list[str],
+        limit: int = 5,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
+        """Async version of `similarity_search_by_documents`."""
+        query_str, query_args = self._nearest_query(
+            self._RESULT_COLUMNS,
+            "status = 'active' AND document = ANY(%s)",
+            (documents,),
+            query_vector,
+            limit,
+        )
+
+        results = await self._aexecute(
+            to_asyncpg_placeholders(query_str),
+            *query_args,
+            settings=self._search_settings(ef_search, probes, limit),
+        )
+
+        return [
+            make_query_result(
+                r["namespace"],
+                r["document"],
+                r["content"],
+                r["page_number"],
+                r["section"],
+                r["distance"],
+            )
+            for r in results
+        ]
+
+    @staticmethod
+    def _hybrid_candidates(limit: int, candidates: Optional[int]) -> int:
+        return candidates or max(limit * 4, 20)
 
+    def _hybrid_search_query(
+        self,
+        query_vector: list[float],
+        query_text: str,
+        documents: list[str],
+        limit: int,
+        candidates: Optional[int],
+    ) -> tuple[str, tuple]:
+        """Reciprocal rank fusion of the `candidates` nearest vectors (see
+        `_nearest_query`) and the `candidates` best lexical matches (full-text rank +
+        trigram word similarity). `distance` is still the cosine distance, for the
+        similarity of the results.
+        """
+        _candidates = self._hybrid_candidates(limit, candidates)
+        semantic_str, semantic_args = self._nearest_query(
+            "vector_id",
+            "status = 'active' AND document = ANY(%s)",
+            (documents,),
+            query_vector,
+            _candidates,
+        )
         query_str = f"""
-        SELECT 
-            namespace,
-            document,
-            vector_id,
-            metadata,
-            1 - (vector {_distant_search_method} %s::vector) AS similarity
-        FROM {self._TABLE_NAME}
-        WHERE NOT status = 'inactive' AND document = ANY(%s)
-        ORDER BY similarity DESC LIMIT %s
+        WITH semantic AS (
+            SELECT vector_id, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+            FROM ({semantic_str}) AS s
+        ),
+        lexical AS (
+            SELECT vector_id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT
+                    vector_id,
+                    ts_rank_cd(
+                        {self._TSVECTOR_EXPRESSION}, plainto_tsquery('simple', %s)
+                    ) + word_similarity(%s, content) AS score
+                FROM {self._TABLE_NAME}
+                WHERE status = 'active' AND document = ANY(%s) AND (
+                    {self._TSVECTOR_EXPRESSION} @@ plainto_tsquery('simple', %s)
+                    OR %s <%% content
+                )
+                ORDER BY score DESC LIMIT %s
+            ) AS l
+        )
+        SELECT
+            t.namespace,
+            t.document,
+            t.content,
+            t.page_number,
+            t.section,
+            t.vector <=> %s::vector AS distance,
+            COALESCE(1.0 / (%s + semantic.rank), 0)
+                + COALESCE(1.0 / (%s + lexical.rank), 0) AS score
+        FROM semantic
+        FULL OUTER JOIN lexical USING (vector_id)
+        JOIN {self._TABLE_NAME} AS t USING (vector_id)
+        ORDER BY score DESC LIMIT %s
         """
+        query_args = (
+            *semantic_args,
+            query_text,
+            query_text,
+            documents,
+            query_text,
+            query_text,
+            _candidates,
+            query_vector,
+            self._RRF_K,
+            self._RRF_K,
+            limit,
+        )
+        return query_str, query_args
 
-        query_args = (query_vector, documents, limit)
+    def hybrid_search_by_documents(
+        self,
+        query_vector: list[float],
+        query_text: str,
+        documents: list[str],
+        limit: int = 5,
+        candidates: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
+        settings_str, settings_args = self._search_settings_sql(
+            ef_search, probes, self._hybrid_candidates(limit, candidates)
+        )
+        query_str, query_args = self._hybrid_search_query(
+            query_vector, query_text, documents, limit, candidates
+        )
 
-        results = self._execute(query_str, query_args) or []
+        results = (
+            self._execute(settings_str + query_str, settings_args + query_args) or []
+        )
 
         return [
-            VectorQueryResult(
-                namespace=namespace,
-                document=document,
-                metadata=VectorMetadata.parse_raw(metadata),
-                similarity=similarity,
+            make_query_result(
+                namespace, document, content, page_number, section, distance
+            )
+            for (
+                namespace,
+                document,
+                content,
+                page_number,
+                section,
+                distance,
+                _,
+            ) in results
+        ]
+
+    async def ahybrid_search_by_documents(
+        self,
+        query_vector: list[float],
+        query_text: str,
+        documents: list[str],
+        limit: int = 5,
+        candidates: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
+        """Async version of `hybrid_search_by_documents`."""
+        query_str, query_args = self._hybrid_search_query(
+            query_vector, query_text, documents, limit, candidates
+        )
+
+        results = await self._aexecute(
+            to_asyncpg_placeholders(query_str),
+            *query_args,
+            settings=self._search_settings(
+                ef_search, probes, self._hybrid_candidates(limit, candidates)
+            ),
+        )
+
+        return [
+            make_query_result(
+                r["namespace"],
+                r["document"],
+                r["content"],
+                r["page_number"],
+                r["section"],
+                r["distance"],
             )
-            for (namespace, document, _, metadata, similarity) in results
+            for r in results
         ]
@@ -4,6 +4,7 @@ from .usage_router import usage_router
 from .document_router import document_router
 from .ai_router import ai_router
 from .workspace_router import workspace_router
+from .admin_router import admin_router
 
 
 def router_attach(app: FastAPI):
@@ -12,3 +13,4 @@ def router_attach(app: FastAPI):
     app.include_router(document_router)
     app.include_router(ai_router)
     app.include_router(workspace_router)
+    app.include_router(admin_router)
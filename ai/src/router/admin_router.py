@@ -0,0 +1,105 @@
+from typing import Annotated
+
+from fastapi import APIRouter, BackgroundTasks, Depends
+from pydantic import BaseModel
+from repository import admin_repo, auth_repo
+from repository.auth_repo import LineUserInfo
+from repository.document_parser import ChunkingConfig
+from repository.vector_store_repo import VectorStatusEnum
+
+admin_router = APIRouter(prefix="/admin")
+
+
+@admin_router.get("/vector_index")
+def list_vector_indexes(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+):
+    admin_repo.check_admin_or_forbidden(user)
+    return admin_repo.list_vector_indexes()
+
+
+@admin_router.post("/vector_index/build")
+def build_vector_indexes(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    background_tasks: BackgroundTasks,
+):
+    admin_repo.check_admin_or_forbidden(user)
+
+    # Index builds on a large table take minutes. Run it after the response is sent.
+    background_tasks.add_task(admin_repo.build_vector_indexes)
+
+    return "success"
+
+
+@admin_router.post("/vector_index/rebuild")
+def rebuild_vector_index(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    background_tasks: BackgroundTasks,
+):
+    admin_repo.check_admin_or_forbidden(user)
+    background_tasks.add_task(admin_repo.rebuild_vector_index)
+
+    return "success"
+
+
+class SetVectorStatus(BaseModel):
+    namespace: str
+    document: str = ""
+    status: VectorStatusEnum
+
+
+@admin_router.post("/vector_status")
+def set_vector_status(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    body: SetVectorStatus,
+):
+    """Enable (`active`) or disable (`disabled`) the vectors of a namespace or a
+    document in the searches. A disabled document stays disabled when processed
+    again."""
+    admin_repo.check_admin_or_forbidden(user)
+    admin_repo.set_vector_status(body.namespace, body.status, body.document)
+
+    return "success"
+
+
+@admin_router.get("/chunking/{namespace}")
+def get_chunking_config(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    namespace: str,
+):
+    admin_repo.check_admin_or_forbidden(user)
+    return admin_repo.get_chunking_config(namespace)
+
+
+@admin_router.put("/chunking/{namespace}")
+def set_chunking_config(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    namespace: str,
+    body: ChunkingConfig,
+):
+    """Chunking of the documents of a namespace processed from now on. Sizes are in
+    tokens, or in characters with the `characters` strategy."""
+    admin_repo.check_admin_or_forbidden(user)
+    admin_repo.set_chunking_config(namespace, body)
+
+    return body
+
+
+@admin_router.delete("/chunking/{namespace}")
+def delete_chunking_config(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    namespace: str,
+):
+    """Go back to the default chunking."""
+    admin_repo.check_admin_or_forbidden(user)
+    admin_repo.delete_chunking_config(namespace)
+
+    return "success"
+
+
+@admin_router.get("/db_pool")
+def db_pool_stats(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+):
+    admin_repo.check_admin_or_forbidden(user)
+    return admin_repo.get_db_pool_stats()
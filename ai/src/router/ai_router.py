@@ -1,10 +1,14 @@
+import json
+import traceback
 from typing import Annotated, List
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
 
 
 from repository import auth_repo, simple_ai_system
 from repository.auth_repo import LineUserInfo
+from repository.vector_store_repo import SearchModeEnum
 
 ai_router = APIRouter(prefix="/ai")
 
@@ -12,15 +16,35 @@ ai_router = APIRouter(prefix="/ai")
 class SimpleExtract(BaseModel):
     documents: List[str]
     question: str
+    search_mode: SearchModeEnum = SearchModeEnum.Vector
 
 
 @ai_router.post("/simple_extract")
-def simple_extract(
+async def simple_extract(
     user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
     body: SimpleExtract,
 ):
-    result = simple_ai_system.extract(
-        body.question, body.documents
+    result = await simple_ai_system.aextract(
+        body.question, body.documents, body.search_mode
     )
 
     return result
+
+
+@ai_router.post("/simple_extract_stream")
+async def simple_extract_stream(
+    user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
+    body: SimpleExtract,
+):
+    async def event_generator():
+        try:
+            async for event in simple_ai_system.astream_extract(
+                body.question, body.documents, body.search_mode
+            ):
+                yield event
+
+        except Exception as e:
+            print(traceback.format_exc())
+            yield {"event": "error", "data": json.dumps(str(e))}
+
+    return EventSourceResponse(event_generator())
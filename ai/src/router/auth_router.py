@@ -11,7 +11,7 @@ class VerifyAccessToken(BaseModel):
 
 
 @auth_router.post("/verify_access_token")
-async def verify_access_token(body: VerifyAccessToken):
+def verify_access_token(body: VerifyAccessToken):
     return auth_repo.verify_access_token(body.token)
 
 
@@ -21,4 +21,4 @@ class VerifyIdToken(BaseModel):
 
 @auth_router.post("/verify_id_token")
 async def verify_id_token(body: VerifyIdToken):
-    return auth_repo.verify_id_token(body.token)
+    return await auth_repo.averify_id_token(body.token)
@@ -1,22 +1,29 @@
 import io
-import os
-import tempfile
+from email.utils import format_datetime
 from typing import Annotated, List
 
 from fastapi import (
     APIRouter,
-    BackgroundTasks,
     Depends,
     File,
     Form,
     HTTPException,
+    Request,
+    Response,
     UploadFile,
     status,
 )
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from repository import auth_repo, document_download, document_parser, document_repo
+from repository import (
+    auth_repo,
+    document_download,
+    document_parser,
+    document_repo,
+    job_queue_repo,
+)
 from repository.auth_repo import LineUserInfo
+from repository.helpers import parse_byte_range
 from repository.document_repo import (
     DocumentMetadata,
     DocumentSourceTypeEnum,
@@ -50,7 +57,6 @@ def upload_file(
     visibility: Annotated[
         DocumentVisibilityEnum, Form(description="Metadata for file")
     ],
-    background_tasks: BackgroundTasks,
 ):
     filename = file.filename
     content_type = file.content_type
@@ -97,10 +103,8 @@ def upload_file(
         ),
     )
 
-    background_tasks.add_task(
-        document_repo.process_vector_and_summary,
-        doc_id=doc_id,
-    )
+    if not document_repo.reuse_processed_content(doc_id):
+        job_queue_repo.enqueue(doc_id)
 
     return doc_id
 
@@ -116,7 +120,6 @@ class UploadText(BaseModel):
 def upload_text(
     user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
     body: UploadText,
-    background_tasks: BackgroundTasks,
 ):
     if len(body.text) == 0:
         raise HTTPException(
@@ -148,10 +151,8 @@ def upload_text(
         ),
     )
 
-    background_tasks.add_task(
-        document_repo.process_vector_and_summary,
-        doc_id=doc_id,
-    )
+    if not document_repo.reuse_processed_content(doc_id):
+        job_queue_repo.enqueue(doc_id)
 
     return doc_id
 
@@ -166,7 +167,6 @@ class UploadLandpress(BaseModel):
 def upload_landpress(
     user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
     body: UploadLandpress,
-    background_tasks: BackgroundTasks,
 ):
     doc = document_download.landpress_or_none(body.url)
     if doc is None:
@@ -181,30 +181,48 @@ def upload_landpress(
         )
 
     text_encode = doc.body.encode(encoding="utf-8")
+    metadata = DocumentMetadata(
+        source_type=DocumentSourceTypeEnum.Landpress,
+        source_link=body.url,
+        source_metadata=dict(
+            create_by=doc.create_by,
+            create_at=doc.create_at,
+            update_at=doc.update_at,
+        ),
+    )
 
-    doc_id = document_repo.create(
+    # A page imported again updates its document, so only the changed chunks
+    # are processed.
+    existing = document_repo.find_document_by_source(
         namespace=body.namespace,
-        filename=doc.title,
-        content_type="text/markdown",
-        blob=io.BytesIO(text_encode),
-        bytesize=len(text_encode),
         upload_by=user.sub,
-        visibility=body.visibility,
-        metadata=DocumentMetadata(
-            source_type=DocumentSourceTypeEnum.Landpress,
-            source_link=body.url,
-            source_metadata=dict(
-                create_by=doc.create_by,
-                create_at=doc.create_at,
-                update_at=doc.update_at,
-            ),
-        ),
+        source_type=DocumentSourceTypeEnum.Landpress,
+        source_link=body.url,
     )
+    if existing is not None:
+        doc_id = existing.doc_id
+        document_repo.replace_content(
+            doc_id=doc_id,
+            filename=doc.title,
+            content_type="text/markdown",
+            blob=io.BytesIO(text_encode),
+            bytesize=len(text_encode),
+            metadata=metadata,
+        )
+    else:
+        doc_id = document_repo.create(
+            namespace=body.namespace,
+            filename=doc.title,
+            content_type="text/markdown",
+            blob=io.BytesIO(text_encode),
+            bytesize=len(text_encode),
+            upload_by=user.sub,
+            visibility=body.visibility,
+            metadata=metadata,
+        )
 
-    background_tasks.add_task(
-        document_repo.process_vector_and_summary,
-        doc_id=doc_id,
-    )
+    if not document_repo.reuse_processed_content(doc_id):
+        job_queue_repo.enqueue(doc_id)
 
     return doc_id
 
@@ -222,41 +240,64 @@ def parse_html_page(
     return text
 
 
-def remove_temp_file(path: str):
-    os.remove(path)
-
-
 @document_router.get("/get_object/{document_id}")
-def get_object(document_id: str, background_tasks: BackgroundTasks):
+def get_object(document_id: str, request: Request):
     doc = document_repo.get_doc_or_not_found(document_id)
-    blob = document_repo.get_file_or_not_found(document_id)
-
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-
-    with open(temp_file.name, "wb") as f:
-        f.write(blob)
+    stat = document_repo.stat_file_or_not_found(doc)
+
+    etag = f'"{stat.etag}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": "inline",
+    }
+    if stat.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(stat.last_modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and (
+        if_none_match.strip() == "*"
+        or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    ):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_byte_range(range_header, stat.size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**headers, "Content-Range": f"bytes */{stat.size}"},
+            )
+
+    if byte_range is None:
+        headers["Content-Length"] = str(stat.size)
+        return StreamingResponse(
+            document_repo.stream_file(doc),
+            media_type=doc.content_type,
+            headers=headers,
+        )
 
-    resp = FileResponse(
-        path=temp_file.name,
-        filename=doc.filename,
-        headers={"Content-Disposition": "inline"},
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.size}"
+    return StreamingResponse(
+        document_repo.stream_file(doc, offset=start, length=end - start + 1),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=doc.content_type,
+        headers=headers,
     )
 
-    background_tasks.add_task(remove_temp_file, temp_file.name)
-
-    return resp
-
 
 @document_router.post("/do_process/{doc_id}")
 def do_process(
     user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
     doc_id: str,
-    background_tasks: BackgroundTasks,
 ):
-    background_tasks.add_task(
-        document_repo.process_vector_and_summary,
-        doc_id=doc_id,
-    )
+    job_queue_repo.enqueue(doc_id)
 
     return "success"
 
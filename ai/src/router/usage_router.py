@@ -18,7 +18,7 @@ class RecordUsage(BaseModel):
 
 
 @usage_router.post("/record")
-async def record_usage(
+def record_usage(
     user: Annotated[LineUserInfo, Depends(auth_repo.get_current_user)],
     body: RecordUsage,
 ):
@@ -33,7 +33,7 @@ async def record_usage(
 
 
 @usage_router.get("/list_by_timestamp/")
-async def list_by_timestamp(
+def list_by_timestamp(
     skip: int = 0,
     limit: int = 10,
 ):
@@ -42,6 +42,6 @@ async def list_by_timestamp(
 
 
 @usage_router.delete("/delete/{usage_id}")
-async def delete_by_usage_id(usage_id: str):
+def delete_by_usage_id(usage_id: str):
     usage_repo.delete_by_id(usage_id)
     return "success"
@@ -1,12 +1,23 @@
+import json
 from datetime import datetime
-from typing import List, TypeVar
+from typing import AsyncGenerator, List, Tuple, TypeVar
 
 import yaml
+from fastapi import HTTPException, status
+from langchain.schema import BaseMessage
 from pydantic import BaseModel
 from repository.document_repo import Document, DocumentRepo
-from repository.helpers import cprint_cyan, cprint_green, get_timestamp, messages_to_str
-from repository.llm_facade import ChatModelEnum, LLMFacade
+from repository.helpers import (
+    cprint_cyan,
+    cprint_green,
+    get_timestamp,
+    get_token_encoding,
+    messages_to_str,
+    num_tokens_from_messages,
+)
+from repository.llm_facade import CHAT_CONTEXT_TOKENS, ChatModelEnum, LLMFacade
 from repository.vector_store_repo import (
+    SearchModeEnum,
     VectorMetadata,
     VectorQueryResult,
     VectorStoreRepo,
@@ -48,13 +59,19 @@ class ExtractResult(BaseModel):
 
 
 class SimpleAISystem:
+    _EXTRACT_MODEL = ChatModelEnum.Chat_4
+    # A reference is truncated to fit the prompt only if this much of it is left
+    _MIN_REFERENCE_TOKENS = 100
+
     def __init__(
         self,
         llm: LLMFacade,
         document_repo: DocumentRepo,
         vector_store_repo: VectorStoreRepo,
+        extract_max_answer_tokens: int = 1024,
     ):
         self._llm = llm
+        self._extract_max_answer_tokens = extract_max_answer_tokens
         self._document_repo = document_repo
         self._vector_store_repo = vector_store_repo
 
@@ -76,27 +93,128 @@ class SimpleAISystem:
             for ref in references
         ]
 
-    def extract(self, question: str, documents: List[str]) -> ExtractResult:
-        start_ts = get_timestamp()
+    async def _aget_result_references(
+        self, references: List[VectorQueryResult]
+    ) -> List[ExtractResultReference]:
+        doc_ids = [r.document for r in references]
+        docs = {}
+        for d in await self._document_repo.aget_docs_or_raise_not_found(doc_ids):
+            docs[d.doc_id] = d
+
+        return [
+            ExtractResultReference.from_reference(docs[ref.document], ref)
+            for ref in references
+        ]
+
+    def _search_references(
+        self, question: str, documents: List[str], search_mode: SearchModeEnum
+    ) -> List[VectorQueryResult]:
         query_vector = self._llm.openai_embeddings(question)
-        references = self._vector_store_repo.similarity_search_by_documents(
+        if search_mode == SearchModeEnum.Hybrid:
+            return self._vector_store_repo.hybrid_search_by_documents(
+                query_vector, question, documents, limit=5
+            )
+
+        return self._vector_store_repo.similarity_search_by_documents(
             query_vector, documents, limit=5
         )
-        result_references = self._get_result_references(references)
 
+    async def _asearch_references(
+        self, question: str, documents: List[str], search_mode: SearchModeEnum
+    ) -> List[VectorQueryResult]:
+        query_vector = await self._llm.aopenai_embeddings(question)
+        if search_mode == SearchModeEnum.Hybrid:
+            return await self._vector_store_repo.ahybrid_search_by_documents(
+                query_vector, question, documents, limit=5
+            )
+
+        return await self._vector_store_repo.asimilarity_search_by_documents(
+            query_vector, documents, limit=5
+        )
+
+    def _format_extract_messages(
+        self, question: str, information: str
+    ) -> List[BaseMessage]:
+        return self._extract_prompt.format_prompt(
+            information=information,
+            question=question,
+        ).to_messages()
+
+    def _get_extract_messages(
+        self, question: str, result_references: List[ExtractResultReference]
+    ) -> Tuple[List[BaseMessage], List[ExtractResultReference]]:
+        """The Extract prompt, with the references (most similar first) that fit in
+        the context of the chat model next to the question and the answer. The content
+        of the last reference is truncated if needed. Returns the messages and the
+        references used, as sent to the model."""
+        budget = (
+            CHAT_CONTEXT_TOKENS[self._EXTRACT_MODEL]
+            - self._extract_max_answer_tokens
+            - num_tokens_from_messages(self._format_extract_messages(question, ""))
+        )
+        if budget <= 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="question is too long",
+            )
+
+        encoding = get_token_encoding()
         information_str = ""
+        used_references: List[ExtractResultReference] = []
         for r in result_references:
             title = r.filename
+            if r.metadata.section:
+                title += f" > {r.metadata.section}"
+            header = "\n---\n" + f"# Document: {title}\n\n"
             content = r.metadata.content
-            information_str += "\n---\n" + f"# Document: {title}\n\n{content}\n"
+            # + 1: the newline after the content
+            header_size = len(encoding.encode_ordinary(header)) + 1
+            content_tokens = encoding.encode_ordinary(content)
+            if header_size + len(content_tokens) > budget:
+                if budget < self._MIN_REFERENCE_TOKENS:
+                    break
 
-        messages_prompt = self._extract_prompt.format_prompt(
-            information=information_str,
-            question=question,
-        ).to_messages()
+                # The reference returned is the truncated one sent to the model
+                content = encoding.decode_bytes(
+                    content_tokens[: budget - header_size]
+                ).decode("utf-8", errors="ignore")
+                content_tokens = encoding.encode_ordinary(content)
+                r = r.copy(
+                    update={"metadata": r.metadata.copy(update={"content": content})}
+                )
+
+            information_str += f"{header}{content}\n"
+            budget -= header_size + len(content_tokens)
+            used_references.append(r)
+            if budget <= 0:
+                break
+
+        messages_prompt = self._format_extract_messages(question, information_str)
         cprint_green(messages_to_str(messages_prompt))
 
-        chat = self._llm.create_chat(ChatModelEnum.Chat_4, temperature=0.1)
+        return messages_prompt, used_references
+
+    def _create_extract_chat(self):
+        return self._llm.create_chat(
+            self._EXTRACT_MODEL,
+            temperature=0.1,
+            max_tokens=self._extract_max_answer_tokens,
+        )
+
+    def extract(
+        self,
+        question: str,
+        documents: List[str],
+        search_mode: SearchModeEnum = SearchModeEnum.Vector,
+    ) -> ExtractResult:
+        start_ts = get_timestamp()
+        references = self._search_references(question, documents, search_mode)
+        result_references = self._get_result_references(references)
+        messages_prompt, result_references = self._get_extract_messages(
+            question, result_references
+        )
+
+        chat = self._create_extract_chat()
         planning_res = chat(messages_prompt).content
 
         cprint_cyan(planning_res)
@@ -108,6 +226,85 @@ class SimpleAISystem:
             question=question,
             result=planning_res,
             references=result_references,
-            duration_ms=int((start_ts - end_ts).microseconds / 1000),
+            duration_ms=int((end_ts - start_ts).total_seconds() * 1000),
+            timestamp=get_timestamp(),
+        )
+
+    async def aextract(
+        self,
+        question: str,
+        documents: List[str],
+        search_mode: SearchModeEnum = SearchModeEnum.Vector,
+    ) -> ExtractResult:
+        """Async version of `extract`. No thread is blocked while waiting for
+        OpenAI or Postgres."""
+        start_ts = get_timestamp()
+        references = await self._asearch_references(question, documents, search_mode)
+        result_references = await self._aget_result_references(references)
+        messages_prompt, result_references = self._get_extract_messages(
+            question, result_references
+        )
+
+        chat = self._create_extract_chat()
+        planning_res = (await chat.apredict_messages(messages_prompt)).content
+
+        cprint_cyan(planning_res)
+        cprint_cyan("-" * 80)
+
+        end_ts = get_timestamp()
+
+        return ExtractResult(
+            question=question,
+            result=planning_res,
+            references=result_references,
+            duration_ms=int((end_ts - start_ts).total_seconds() * 1000),
+            timestamp=get_timestamp(),
+        )
+
+    async def astream_extract(
+        self,
+        question: str,
+        documents: List[str],
+        search_mode: SearchModeEnum = SearchModeEnum.Vector,
+    ) -> AsyncGenerator[dict, None]:
+        """Streaming version of `aextract` as server-sent events:
+
+        - `references`: the references used to answer, sent before the LLM call.
+        - `token`: JSON string of each answer token.
+        - `done`: the full `ExtractResult`, with `duration_ms`.
+        """
+        start_ts = get_timestamp()
+        references = await self._asearch_references(question, documents, search_mode)
+        result_references = await self._aget_result_references(references)
+        messages_prompt, result_references = self._get_extract_messages(
+            question, result_references
+        )
+        yield {
+            "event": "references",
+            "data": json.dumps([json.loads(r.json()) for r in result_references]),
+        }
+
+        chat = self._create_extract_chat()
+
+        tokens: List[str] = []
+        async for chunk in chat.astream(messages_prompt):
+            if chunk.content == "":
+                continue
+
+            tokens.append(chunk.content)
+            # JSON encoded so that newlines in a token do not break the SSE framing.
+            yield {"event": "token", "data": json.dumps(chunk.content)}
+
+        planning_res = "".join(tokens)
+        cprint_cyan(planning_res)
+        cprint_cyan("-" * 80)
+
+        end_ts = get_timestamp()
+        result = ExtractResult(
+            question=question,
+            result=planning_res,
+            references=result_references,
+            duration_ms=int((end_ts - start_ts).total_seconds() * 1000),
             timestamp=get_timestamp(),
         )
+        yield {"event": "done", "data": result.json()}
@@ -0,0 +1,109 @@
+"""Document processing worker.
+
+Polls the ingestion job queue and runs `DocumentRepo.process_vector_and_summary`
+outside of the HTTP workers. Run from `src`:
+
+    python worker.py
+"""
+import os
+import signal
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from fastapi import HTTPException, status
+
+from repository import document_repo, job_queue_repo
+from repository.document_repo import DocumentProcessStatusEnum
+from repository.helpers import cprint_cyan
+from repository.job_queue_repo import IngestionJob
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "2"))
+WORKER_POLL_INTERVAL_SECONDS = float(
+    os.environ.get("WORKER_POLL_INTERVAL_SECONDS", "2")
+)
+WORKER_HEARTBEAT_SECONDS = int(os.environ.get("WORKER_HEARTBEAT_SECONDS", "30"))
+WORKER_STALE_AFTER_SECONDS = int(os.environ.get("WORKER_STALE_AFTER_SECONDS", "300"))
+
+
+class Worker:
+    def __init__(self, concurrency: int) -> None:
+        self._worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="job"
+        )
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        cprint_cyan(f"worker {self._worker_id} stopping")
+        self._stop.set()
+
+    def _run_job(self, job: IngestionJob):
+        try:
+            cprint_cyan(f"job {job.job_id} doc_id={job.doc_id} attempt={job.attempts}")
+            process_status = document_repo.process_vector_and_summary(job.doc_id)
+            if process_status == DocumentProcessStatusEnum.Processed:
+                job_queue_repo.complete(job)
+            else:
+                job_queue_repo.fail(job, f"process_status={process_status.value}")
+
+        except HTTPException as e:
+            # The document or its file was deleted. Retrying does not help.
+            retry = e.status_code != status.HTTP_404_NOT_FOUND
+            job_queue_repo.fail(job, str(e.detail), retry=retry)
+
+        except Exception as e:
+            print(traceback.format_exc())
+            job_queue_repo.fail(job, str(e))
+
+        finally:
+            self._slots.release()
+
+    def _heartbeat_loop(self):
+        stale_after = timedelta(seconds=WORKER_STALE_AFTER_SECONDS)
+        while not self._stop.wait(WORKER_HEARTBEAT_SECONDS):
+            try:
+                job_queue_repo.heartbeat(self._worker_id)
+                recovered = job_queue_repo.recover_stale(stale_after)
+                if recovered > 0:
+                    cprint_cyan(f"recovered {recovered} stale jobs")
+
+            except Exception:
+                print(traceback.format_exc())
+
+    def run(self):
+        cprint_cyan(f"worker {self._worker_id} started")
+        job_queue_repo.recover_stale(timedelta(seconds=WORKER_STALE_AFTER_SECONDS))
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+        while not self._stop.is_set():
+            # Only claim a job when there is a free slot to run it.
+            if not self._slots.acquire(timeout=WORKER_POLL_INTERVAL_SECONDS):
+                continue
+
+            try:
+                job = job_queue_repo.claim(self._worker_id)
+            except Exception:
+                print(traceback.format_exc())
+                job = None
+
+            if job is None:
+                self._slots.release()
+                self._stop.wait(WORKER_POLL_INTERVAL_SECONDS)
+                continue
+
+            self._executor.submit(self._run_job, job)
+
+        # Let the running jobs finish. Jobs of a killed worker are recovered by
+        # `recover_stale` of the other workers.
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    worker = Worker(concurrency=WORKER_CONCURRENCY)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+from playhouse.pool import MaxConnectionsExceeded
+from repository.base_db import (
+    DB_HOST,
+    DB_NAME,
+    DB_PASSWORD,
+    DB_PORT,
+    DB_USER,
+    PooledDatabase,
+)
+
+
+def make_db(max_connections: int, timeout: float) -> PooledDatabase:
+    return PooledDatabase(
+        DB_NAME,
+        max_connections=max_connections,
+        timeout=timeout,
+        idle_check=30,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+    )
+
+
+def hold_connection(db: PooledDatabase, connected: threading.Event, seconds: float):
+    """Exhaust the pool from another thread, then give the connection back."""
+    db.connect()
+    connected.set()
+    time.sleep(seconds)
+    db.close()
+
+
+def test_pool_waiter_gets_released_connection():
+    db = make_db(max_connections=1, timeout=10)
+    connected = threading.Event()
+    holder = threading.Thread(target=hold_connection, args=(db, connected, 0.5))
+    holder.start()
+    connected.wait()
+
+    start = time.monotonic()
+    assert db.execute_sql("SELECT 1").fetchone() == (1,)
+    elapsed = time.monotonic() - start
+    holder.join()
+
+    # The holder closes while we wait: no wait up to the timeout
+    assert elapsed < 5
+    assert db.pool_stats()["wait_timeouts"] == 0
+    assert db.pool_stats()["size"] == 1
+    db.close_all()
+
+
+def test_pool_exhausted_times_out():
+    db = make_db(max_connections=1, timeout=1)
+    connected = threading.Event()
+    holder = threading.Thread(target=hold_connection, args=(db, connected, 2))
+    holder.start()
+    connected.wait()
+
+    with pytest.raises(MaxConnectionsExceeded):
+        db.connect()
+
+    holder.join()
+    assert db.pool_stats()["wait_timeouts"] == 1
+    db.close_all()
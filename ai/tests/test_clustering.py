@@ -0,0 +1,53 @@
+import numpy as np
+from repository.clustering import SummaryClusteringConfig, get_representative_indices
+
+
+def make_embeddings(points_per_topic: int) -> np.ndarray:
+    """Three tight groups around orthogonal directions."""
+    rng = np.random.default_rng(0)
+    centers = np.eye(3, 8, dtype=np.float32)
+    return np.concatenate(
+        [
+            center + rng.normal(scale=0.01, size=(points_per_topic, 8))
+            for center in centers
+        ]
+    ).astype(np.float32)
+
+
+def test_num_clusters_scales_with_chunks():
+    config = SummaryClusteringConfig(
+        min_clusters=5, max_clusters=20, chunks_per_cluster=100
+    )
+
+    assert config.num_clusters(3) == 3
+    assert config.num_clusters(300) == 5
+    assert config.num_clusters(1001) == 11
+    assert config.num_clusters(10000) == 20
+
+
+def test_get_representative_indices_one_per_group():
+    embeddings = make_embeddings(points_per_topic=20)
+    config = SummaryClusteringConfig(min_clusters=3, max_clusters=3)
+
+    indices = get_representative_indices(embeddings.tolist(), config)
+
+    assert indices == sorted(indices)
+    assert sorted(i // 20 for i in indices) == [0, 1, 2]
+
+
+def test_get_representative_indices_minibatch():
+    embeddings = make_embeddings(points_per_topic=200)
+    config = SummaryClusteringConfig(
+        min_clusters=3, max_clusters=3, minibatch_threshold=100, batch_size=64
+    )
+
+    indices = get_representative_indices(embeddings, config)
+
+    assert sorted(i // 200 for i in indices) == [0, 1, 2]
+
+
+def test_get_representative_indices_fewer_chunks_than_clusters():
+    config = SummaryClusteringConfig()
+
+    assert get_representative_indices([], config) == []
+    assert get_representative_indices([[1.0, 0.0]], config) == [0]
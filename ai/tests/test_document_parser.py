@@ -0,0 +1,192 @@
+import io
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from repository.document_parser import (
+    ChunkingConfig,
+    ChunkStrategyEnum,
+    DocumentParser,
+)
+from repository.helpers import num_tokens_from_string
+
+document_parser = DocumentParser("", "text/plain")
+
+
+def test_simple_parse_keeps_all_elements():
+    elements = [
+        {
+            "text": f"Paragraph {i}:\tsome\n\n  text " * 20,
+            "metadata": {"page_number": i},
+        }
+        for i in range(1, 101)
+    ]
+    chunks = document_parser.simple_parse(
+        elements, ChunkingConfig(chunk_size=300, overlap=50)
+    )
+
+    text = "\n".join(c.text for c in chunks)
+    for e in elements:
+        assert " ".join(e["text"].split()) in text
+
+    assert chunks[0].metadata == {"page_number": 1, "section": None}
+    # The whitespaces are collapsed
+    assert "\t" not in text and "  " not in text
+    # Only the merged last chunk can exceed the budget
+    for c in chunks[:-1]:
+        assert num_tokens_from_string(c.text) <= 300 + 10
+
+
+def test_simple_parse_overlap():
+    elements = [{"text": f"sentence number {i}."} for i in range(200)]
+    chunks = document_parser.simple_parse(
+        elements, ChunkingConfig(chunk_size=100, overlap=20)
+    )
+
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # The chunk starts with the end of the previous one
+        assert chunk.text.split("\n\n")[0] in previous.text
+
+
+def test_simple_parse_merges_small_last_chunk():
+    elements = [{"text": "word " * 90}, {"text": "word " * 90}, {"text": "end " * 20}]
+    chunks = document_parser.simple_parse(
+        elements, ChunkingConfig(chunk_size=100, overlap=0)
+    )
+
+    assert len(chunks) == 2
+    assert chunks[-1].text.endswith("end " * 19 + "end")
+
+
+def test_simple_parse_splits_large_element():
+    text = "日本語のテキスト。" * 500
+    chunks = document_parser.simple_parse(
+        [{"text": text}], ChunkingConfig(chunk_size=100, overlap=0)
+    )
+
+    assert len(chunks) > 1
+    assert "".join(c.text for c in chunks).replace("\n\n", "") == text
+
+
+def test_simple_parse_empty():
+    assert document_parser.simple_parse([{"text": " \n "}, {}]) == []
+
+
+def test_simple_parse_characters():
+    elements = [{"text": "abcdefghij" * 3} for _ in range(10)]
+    config = ChunkingConfig(
+        strategy=ChunkStrategyEnum.Characters, chunk_size=100, overlap=10
+    )
+    chunks = document_parser.simple_parse(elements, config)
+
+    assert len(chunks) > 1
+    for c in chunks[:-1]:
+        assert len(c.text) <= 100 + 2
+
+
+def test_simple_parse_sentences():
+    elements = [{"text": "First sentence. Second one! 三番目の文。四番目の文。"}] * 30
+    config = ChunkingConfig(
+        strategy=ChunkStrategyEnum.Sentences, chunk_size=30, overlap=0
+    )
+    chunks = document_parser.simple_parse(elements, config)
+
+    assert len(chunks) > 1
+    for c in chunks:
+        assert c.text.endswith((".", "!", "。"))
+
+
+def test_simple_parse_headings():
+    elements = [
+        {"text": "Introduction", "type": "Title"},
+        {"text": "word " * 30, "type": "NarrativeText"},
+        {"text": "Usage", "type": "Title"},
+        {"text": "word " * 10, "type": "NarrativeText"},
+    ]
+    config = ChunkingConfig(
+        strategy=ChunkStrategyEnum.Headings, chunk_size=200, overlap=20
+    )
+    chunks = document_parser.simple_parse(elements, config)
+
+    assert [c.text.split("\n\n")[0] for c in chunks] == ["Introduction", "Usage"]
+
+
+def test_chunking_config_check():
+    with pytest.raises(ValueError):
+        ChunkingConfig(chunk_size=100, overlap=100).check()
+
+    with pytest.raises(ValueError):
+        ChunkingConfig(chunk_size=10000, overlap=0).check()
+
+
+def test_split_pdf():
+    writer = PdfWriter()
+    for _ in range(25):
+        writer.add_blank_page(100, 100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+
+    page_ranges = document_parser._split_pdf("doc", buffer.getvalue(), 10)
+
+    assert [first_page for (first_page, _) in page_ranges] == [1, 11, 21]
+    assert [len(PdfReader(io.BytesIO(b)).pages) for (_, b) in page_ranges] == [
+        10,
+        10,
+        5,
+    ]
+    assert document_parser._split_pdf("doc", buffer.getvalue(), 30) == []
+    assert document_parser._split_pdf("doc", b"not a pdf", 10) == []
+
+
+def test_parse_elements_markdown():
+    markdown = (
+        "# Guide\n\nIntro.\n\n## Install\n\n- step one\n- step two\n\n"
+        "```\n# not a title\n```\n"
+    )
+    elements = document_parser.parse_elements("doc", markdown.encode(), "text/markdown")
+
+    assert [(e["type"], e["text"]) for e in elements] == [
+        ("Title", "Guide"),
+        ("NarrativeText", "Intro."),
+        ("Title", "Install"),
+        ("ListItem", "- step one"),
+        ("ListItem", "- step two"),
+        ("NarrativeText", "```\n# not a title\n```"),
+    ]
+    assert elements[-1]["metadata"]["section"] == "Guide > Install"
+
+    chunks = document_parser.simple_parse(elements)
+    assert chunks[0].metadata["section"] == "Guide"
+
+
+def test_parse_elements_text_charset():
+    elements = document_parser.parse_elements(
+        "doc", "première\n\nligne".encode("latin-1"), "text/plain; charset=ISO-8859-1"
+    )
+    assert [e["text"] for e in elements] == ["première", "ligne"]
+
+
+def test_parse_elements_html_line_breaks():
+    # Long enough for the main extraction of trafilatura, without its fallbacks
+    intro = "The office answers the letters and the calls in a few days. " * 6
+    html = (
+        f"<html><body><article><h1>Contact</h1><p>{intro}</p>"
+        "<p>Line one<br>line two<br>line three of the address of the office.</p>"
+        "<ul><li>Item one<ul><li>sub a</li><li>sub b</li></ul></li>"
+        "<li>Item two</li></ul>"
+        "<table><tr><td>Day</td><td>Hours</td></tr>"
+        "<tr><td>Monday</td><td>9-17</td></tr></table>"
+        f"<p>{intro}</p></article></body></html>"
+    )
+    elements = document_parser.parse_elements("doc", html.encode(), "text/html")
+
+    assert [(e["type"], e["text"]) for e in elements[2:-1]] == [
+        (
+            "NarrativeText",
+            "Line one\nline two\nline three of the address of the office.",
+        ),
+        ("ListItem", "Item one\nsub a\nsub b"),
+        ("ListItem", "Item two"),
+        ("NarrativeText", "Day Hours\nMonday 9-17"),
+    ]
+    assert elements[-1]["metadata"]["section"] == "Contact"
@@ -0,0 +1,74 @@
+import os
+from typing import List
+
+import yaml
+from langchain.schema import AIMessage, BaseMessage
+from repository.document_repo import DocumentRepo
+from repository.helpers import num_tokens_from_messages
+from repository.llm_facade import CHAT_CONTEXT_TOKENS, ChatModelEnum
+from systems.base_ai_ystem import BaseAISystem
+
+PROMPTS_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "src", "prompts", "simple.yaml"
+)
+
+
+class FakeChat:
+    def __init__(self, llm: "FakeLLM", max_tokens: int | None):
+        self._llm = llm
+        self._max_tokens = max_tokens
+
+    def __call__(self, messages: List[BaseMessage]) -> AIMessage:
+        self._llm.prompts.append((num_tokens_from_messages(messages), self._max_tokens))
+        # Three paragraphs, like the answers of the Summary prompt
+        return AIMessage(content="\n\n".join(["The summary says a lot. " * 40] * 3))
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts: List[tuple[int, int | None]] = []
+
+    def create_chat(self, model, temperature, request_timeout=None, max_tokens=None):
+        assert model == ChatModelEnum.Chat_3_5
+        return FakeChat(self, max_tokens)
+
+
+def make_document_repo(llm: FakeLLM) -> DocumentRepo:
+    document_repo = DocumentRepo.__new__(DocumentRepo)
+    document_repo._llm = llm
+    document_repo._summary_concurrency = 4
+    document_repo._summary_timeout_seconds = 10
+    with open(PROMPTS_PATH) as f:
+        config = yaml.safe_load(f)
+    document_repo._summary_all_prompt = BaseAISystem.load_messages(config, "SummaryAll")
+    return document_repo
+
+
+def test_combined_summary_of_20_clusters_fits_the_context():
+    llm = FakeLLM()
+    document_repo = make_document_repo(llm)
+    # The map summaries of a document with 20 clusters, ~600 tokens each
+    summaries = [
+        "\n\n".join([f"Cluster {i} is about this. " * 40] * 3) for i in range(20)
+    ]
+
+    summary = document_repo._get_combined_summary(summaries)
+
+    assert summary.startswith("The summary says a lot.")
+    # Reduced in groups, then once more
+    assert len(llm.prompts) > 1
+    context = CHAT_CONTEXT_TOKENS[ChatModelEnum.Chat_3_5]
+    for prompt_tokens, max_tokens in llm.prompts:
+        assert max_tokens is not None
+        assert prompt_tokens + max_tokens <= context
+
+
+def test_combined_summary_cuts_a_summary_longer_than_the_context():
+    llm = FakeLLM()
+    document_repo = make_document_repo(llm)
+
+    document_repo._get_combined_summary(["word " * 10000, "short"])
+
+    assert len(llm.prompts) == 1
+    prompt_tokens, max_tokens = llm.prompts[0]
+    assert prompt_tokens + max_tokens <= CHAT_CONTEXT_TOKENS[ChatModelEnum.Chat_3_5]
@@ -0,0 +1,69 @@
+import hashlib
+import io
+
+import pytest
+from repository.helpers import (
+    HashingReader,
+    LRUCache,
+    make_token_batches,
+    parse_byte_range,
+)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache: LRUCache[int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Touch "a" so "b" becomes the least recently used
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_make_token_batches():
+    texts = ["hello world", "hello world", "hello world", "a " * 100]
+
+    # "hello world" is 2 tokens
+    assert make_token_batches(texts, max_tokens=4, max_items=10) == [[0, 1], [2], [3]]
+    assert make_token_batches(texts, max_tokens=1000, max_items=2) == [[0, 1], [2, 3]]
+
+    # Too long for a single input: its own batch, to be split
+    assert make_token_batches(
+        ["hello world", "a " * 100, "hello world"],
+        max_tokens=1000,
+        max_items=10,
+        max_item_tokens=50,
+    ) == [[0], [1], [2]]
+
+
+def test_parse_byte_range():
+    assert parse_byte_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_byte_range("bytes=900-", 1000) == (900, 999)
+    assert parse_byte_range("bytes=900-5000", 1000) == (900, 999)
+    assert parse_byte_range("bytes=-100", 1000) == (900, 999)
+    assert parse_byte_range("bytes=-5000", 1000) == (0, 999)
+
+    # Not a single byte range: serve the whole object
+    assert parse_byte_range("bytes=0-1,5-6", 1000) is None
+    assert parse_byte_range("items=0-1", 1000) is None
+    assert parse_byte_range("bytes=abc", 1000) is None
+
+    with pytest.raises(ValueError):
+        parse_byte_range("bytes=1000-", 1000)
+    with pytest.raises(ValueError):
+        parse_byte_range("bytes=-0", 1000)
+
+
+def test_hashing_reader():
+    data = b"hello world" * 1000
+    reader = HashingReader(io.BytesIO(data))
+    while len(reader.read(4096)) > 0:
+        pass
+
+    assert reader.bytes_read == len(data)
+    assert reader.hexdigest() == hashlib.sha256(data).hexdigest()
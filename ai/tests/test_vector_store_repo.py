@@ -1,13 +1,80 @@
+import hashlib
+import struct
+import threading
+import numpy as np
 import pytest
 from typing import List
 from repository import llm_facade
-from repository.vector_store_repo import VectorMetadata, VectorStoreRepo
+from repository.vector_store_repo import (
+    VectorIndexConfig,
+    VectorMetadata,
+    VectorStatusEnum,
+    VectorStoreRepo,
+    make_copy_binary,
+    make_fingerprint,
+    make_query_result,
+    to_asyncpg_placeholders,
+)
 
 
 def test_always_passes():
     assert True
 
 
+def test_make_copy_binary():
+    data = make_copy_binary([("ns", [1.0, 2.0])]).getvalue()
+
+    header = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+    assert data.startswith(header)
+    assert data.endswith(struct.pack("!h", -1))
+
+    row = data[len(header) : -2]
+    assert row == (
+        struct.pack("!h", 2)
+        + struct.pack("!i", 2)
+        + b"ns"
+        + struct.pack("!ihh", 4 + 8, 2, 0)
+        + struct.pack("!ff", 1.0, 2.0)
+    )
+
+
+def test_make_copy_binary_null_and_int():
+    data = make_copy_binary([(None, 7)]).getvalue()
+    assert data[19:-2] == (
+        struct.pack("!h", 2) + struct.pack("!i", -1) + struct.pack("!ii", 4, 7)
+    )
+
+
+def test_make_fingerprint():
+    a = VectorMetadata(content="hello", page_number=1)
+    assert make_fingerprint(a) == make_fingerprint(a.copy())
+    assert make_fingerprint(a) != make_fingerprint(a.copy(update={"page_number": 2}))
+    assert len(make_fingerprint(a)) == 64
+    # Unchanged for the chunks without section
+    assert (
+        make_fingerprint(a)
+        == hashlib.sha256(a.json(exclude={"section"}).encode("utf-8")).hexdigest()
+    )
+    assert make_fingerprint(a) == make_fingerprint(a.copy(update={"section": None}))
+    assert make_fingerprint(a) != make_fingerprint(a.copy(update={"section": "Intro"}))
+
+
+def test_make_query_result():
+    result = make_query_result("ns", "doc", "hello", None, None, 0.25)
+    assert result.similarity == 0.75
+    assert result.metadata == VectorMetadata(content="hello", page_number=None)
+    assert make_fingerprint(result.metadata) == make_fingerprint(
+        VectorMetadata(content="hello", page_number=None)
+    )
+
+
+def test_to_asyncpg_placeholders():
+    assert (
+        to_asyncpg_placeholders("SELECT %s WHERE a = %s AND b <%% c LIMIT %s")
+        == "SELECT $1 WHERE a = $2 AND b <% c LIMIT $3"
+    )
+
+
 test_store_namespace = "test-store"
 test_document_name = "test-document"
 
@@ -72,3 +139,233 @@ def test_vector_store(initialize_vector_store):
             assert result.similarity > results[i + 1].similarity
 
         assert result.metadata.content == expect_texts_order[i]
+
+
+def random_vectors(rng: np.random.Generator, count: int) -> List[List[float]]:
+    vectors = rng.normal(size=(count, 1536)).astype(np.float32)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).tolist()
+
+
+@pytest.fixture
+def indexed_vector_store():
+    """HNSW-indexed table with one small document among many other vectors."""
+    vector_store = VectorStoreRepo(
+        "vector_store_index_test",
+        1536,
+        VectorIndexConfig(ef_search=10, exact_search_max_rows=100),
+    )
+    rng = np.random.default_rng(42)
+    for document, count in [("other", 2000), ("target", 8)]:
+        vector_store.insert_vectors(
+            test_store_namespace,
+            document,
+            random_vectors(rng, count),
+            metadatas=[
+                VectorMetadata(content=f"{document} {i}", page_number=i)
+                for i in range(count)
+            ],
+        )
+    vector_store.build_indexes(concurrently=False)
+    yield vector_store
+    vector_store._drop_table()
+
+
+def test_similarity_search_selective_filter(indexed_vector_store):
+    vector_store: VectorStoreRepo = indexed_vector_store
+    query_vector = random_vectors(np.random.default_rng(0), 1)[0]
+
+    # Filtered after an HNSW scan, the 10 candidates would miss the 8 target rows:
+    # the exact nearest ones are expected.
+    target_vectors = np.array(random_vectors(np.random.default_rng(42), 2008)[2000:])
+    expected = np.argsort(-(target_vectors @ np.array(query_vector)))[:5]
+
+    results = vector_store.similarity_search_by_documents(
+        query_vector, ["target"], limit=5
+    )
+    assert [r.metadata.page_number for r in results] == expected.tolist()
+
+    # Not selective: the ANN index, with ef_search raised to the limit
+    results = vector_store.similarity_search_by_namespace(
+        query_vector, test_store_namespace, limit=20
+    )
+    assert len(results) == 20
+
+
+def test_hybrid_search_selective_filter(indexed_vector_store):
+    vector_store: VectorStoreRepo = indexed_vector_store
+    query_vector = random_vectors(np.random.default_rng(0), 1)[0]
+    target_vectors = np.array(random_vectors(np.random.default_rng(42), 2008)[2000:])
+    expected = np.argsort(-(target_vectors @ np.array(query_vector)))[:5]
+
+    # No lexical match: the ranking is the one of the semantic candidates
+    results = vector_store.hybrid_search_by_documents(
+        query_vector, "qqqq", ["target"], limit=5
+    )
+    assert [r.metadata.page_number for r in results] == expected.tolist()
+
+
+def test_build_indexes_replaces_invalid_index(indexed_vector_store):
+    vector_store: VectorStoreRepo = indexed_vector_store
+    index_name = f"{vector_store._TABLE_NAME}_document_idx"
+    # What an interrupted CREATE INDEX CONCURRENTLY leaves behind
+    vector_store._execute(
+        "UPDATE pg_index SET indisvalid = false WHERE indexrelid = %s::regclass",
+        (index_name,),
+    )
+
+    vector_store.build_indexes()
+
+    results = vector_store._execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = %s::regclass",
+        (index_name,),
+    )
+    assert results == [(True,)]
+
+
+def test_disabled_document_stays_disabled_when_processed_again(
+    indexed_vector_store,
+):
+    vector_store: VectorStoreRepo = indexed_vector_store
+    rng = np.random.default_rng(1)
+    query_vector = random_vectors(rng, 1)[0]
+    # A failed processing left an inactive generation behind
+    vector_store.insert_vectors(
+        test_store_namespace,
+        "target",
+        random_vectors(rng, 2),
+        metadatas=[VectorMetadata(content="failed", page_number=0)] * 2,
+        generation=1,
+        status=VectorStatusEnum.Inactive,
+    )
+
+    vector_store.set_vector_status_in_document(
+        test_store_namespace, VectorStatusEnum.Disabled, "target"
+    )
+    assert vector_store.similarity_search_by_documents(query_vector, ["target"]) == []
+
+    # Processed again: the kept chunks are copied, a new one is inserted
+    generation = vector_store.next_generation(test_store_namespace, "target")
+    vector_store.copy_document_vectors(
+        test_store_namespace,
+        "target",
+        test_store_namespace,
+        "target",
+        generation=generation,
+        status=VectorStatusEnum.Inactive,
+    )
+    vector_store.insert_vectors(
+        test_store_namespace,
+        "target",
+        random_vectors(rng, 1),
+        metadatas=[VectorMetadata(content="new", page_number=8)],
+        generation=generation,
+        status=VectorStatusEnum.Inactive,
+    )
+    vector_store.activate_generation(test_store_namespace, "target", generation)
+    assert vector_store.similarity_search_by_documents(query_vector, ["target"]) == []
+
+    # Enabled again: only the current generation
+    vector_store.set_vector_status_in_document(
+        test_store_namespace, VectorStatusEnum.Active, "target"
+    )
+    results = vector_store.similarity_search_by_documents(
+        query_vector, ["target"], limit=20
+    )
+    assert len(results) == 9
+    assert "failed" not in [r.metadata.content for r in results]
+
+    with pytest.raises(ValueError):
+        vector_store.set_vector_status_in_document(
+            test_store_namespace, VectorStatusEnum.Inactive
+        )
+
+
+def test_migrate_metadata_column_concurrently(monkeypatch):
+    """The api and worker processes migrate a table of the first version at once."""
+    table_name = "vector_store_migrate_test"
+    monkeypatch.setattr(VectorStoreRepo, "_METADATA_BATCH_SIZE", 10)
+    vector_store = VectorStoreRepo.__new__(VectorStoreRepo)
+    vector_store._TABLE_NAME = table_name
+    vector_store._execute(f"DROP TABLE IF EXISTS {table_name}")
+    # The first version of the table, with the columns added by `_create_table`
+    vector_store._execute(
+        f"""
+        CREATE TABLE {table_name} (
+            namespace VARCHAR(255),
+            document VARCHAR(255),
+            vector_id VARCHAR(255),
+            metadata TEXT,
+            vector vector(3),
+            status VARCHAR(20),
+            content TEXT,
+            page_number INTEGER
+        );
+        INSERT INTO {table_name}
+        SELECT 'ns', 'doc', i::text,
+            json_build_object('content', 'chunk ' || i, 'page_number', i)::text,
+            '[1, 0, 0]', 'active'
+        FROM generate_series(0, 24) AS i;
+        """
+    )
+
+    errors = []
+
+    def migrate():
+        try:
+            vector_store._migrate_metadata_column()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=migrate) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert not vector_store._has_metadata_column()
+    results = vector_store._execute(
+        f"SELECT vector_id, content, page_number FROM {table_name}"
+    )
+    assert sorted(results, key=lambda row: int(row[0])) == [
+        (str(i), f"chunk {i}", i) for i in range(25)
+    ]
+    vector_store._drop_table()
+
+
+def test_startup_indexes_only_on_empty_table():
+    def index_names(vector_store: VectorStoreRepo) -> set:
+        return {index["name"] for index in vector_store.list_indexes()}
+
+    # New table: the indexes are created on startup
+    vector_store = VectorStoreRepo("vector_store_startup_test", 3)
+    assert {
+        "vector_store_startup_test_vector_id_idx",
+        "vector_store_startup_test_content_trgm_idx",
+    } <= index_names(vector_store)
+    vector_store._drop_table()
+
+    # Existing rows: left to `build_indexes`, the hybrid search works without them
+    vector_store._execute(
+        """
+        CREATE TABLE vector_store_startup_test (
+            namespace VARCHAR(255),
+            document VARCHAR(255),
+            vector_id VARCHAR(255),
+            content TEXT,
+            vector vector(3),
+            status VARCHAR(20)
+        );
+        INSERT INTO vector_store_startup_test
+        VALUES ('ns', 'doc', 'v1', 'invoice ABC-123', '[1, 0, 0]', 'active');
+        """
+    )
+    vector_store = VectorStoreRepo("vector_store_startup_test", 3)
+    assert index_names(vector_store) == set()
+
+    results = vector_store.hybrid_search_by_documents([0, 1, 0], "ABC-123", ["doc"])
+    assert [r.metadata.content for r in results] == ["invoice ABC-123"]
+
+    vector_store.build_indexes(concurrently=True)
+    assert "vector_store_startup_test_content_trgm_idx" in index_names(vector_store)
+    vector_store._drop_table()